@@ -1,4 +1,3 @@
-from collections import defaultdict
 from enum import IntEnum
 from json import dumps
 from os import path, PathLike
@@ -10,8 +9,11 @@ from lib.consts import *
 from lib.io_helpers import *
 
 from lib.tokens import Tokens, Token, TokenType, lex, regex_chunk_lines
-from lib.name_visitor import AnnotatedName
+from lib.regions import RegionWriter
+from lib.name_visitor import AnnotatedName, name_cache
+from lib.generate_test import test_file_cache
 from lib.autograde import AutograderConfig, autograders, PythonAutograder
+from lib.timing import Timings, NoTimings
 
 def parse_blanks(source_path: str, tkn: Token, blank_re: Pattern):
     itr = regex_chunk_lines(blank_re, tkn.text, line_number=tkn.lineno)
@@ -31,14 +33,23 @@ def parse_blanks(source_path: str, tkn: Token, blank_re: Pattern):
             yield (chunk, chunk)
 
 
-def parse_fpp_regions(tokens: Tokens):
+def stream_fpp_regions(tokens: Tokens) -> dict[str, RegionWriter]:
+    """ Splits tokens into regions, each normalised line-by-line as it is
+        written, so a region can be read as a string with `getvalue()`
+        or line-by-line by iterating over it.
+    """
     if 'blankDelimiter' in tokens.metadata:
         blank_re = make_blank_re(tokens.metadata['blankDelimiter'])
     else:
         blank_re = DEFAULT_BLANK_PATTERN
 
-    r_texts: dict[str, list[str]] = defaultdict(list)
-    answer, prompt = r_texts['answer_code'], r_texts['prompt_code']
+    r_texts: dict[str, RegionWriter] = {}
+    def region(name: str) -> RegionWriter:
+        if name not in r_texts:
+            r_texts[name] = RegionWriter(skip_blank_lines=name == 'prompt_code')
+        return r_texts[name]
+
+    answer, prompt = region('answer_code'), region('prompt_code')
 
     class DocstringState(IntEnum):
         Accepting = 0
@@ -52,46 +63,46 @@ def parse_fpp_regions(tokens: Tokens):
 
         if tkn.region:
             if tkn.region == 'question_text' and docstring_state == DocstringState.FollowWithNewline:
-                r_texts[tkn.region].append('\n')
+                region(tkn.region).write('\n')
                 docstring_state = DocstringState.Finished
-            r_texts[tkn.region].append(tkn.text)
+            region(tkn.region).write(tkn.text)
             continue
 
         if tkn.type == TokenType.DOCSTRING:
             if docstring_state == DocstringState.Accepting:
-                qs = r_texts['question_text']
+                qs = region('question_text')
                 if qs:
-                    qs.append('\n')
+                    qs.write('\n')
                     docstring_state = DocstringState.Finished
                 else:
                     docstring_state = DocstringState.FollowWithNewline
-                qs.append(tkn.text[3:-3])
+                qs.write(tkn.text[3:-3])
             else:
-                prompt.append(tkn.text)
-                answer.append(tkn.text)
+                prompt.write(tkn.text)
+                answer.write(tkn.text)
         elif tkn.type == TokenType.COMMENT:
             target = prompt if test(SPECIAL_COMMENT_PATTERN, tkn.text) \
                 else answer
-            target.append(tkn.text)
+            target.write(tkn.text)
         elif tkn.type == TokenType.STRING:
-            prompt.append(tkn.text)
-            answer.append(tkn.text)
+            prompt.write(tkn.text)
+            answer.write(tkn.text)
         elif tkn.type == TokenType.UNMATCHED:
             for ans, prmpt in parse_blanks(tokens.source_path, tkn, blank_re):
-                answer.append(ans)
-                prompt.append(prmpt)
+                answer.write(ans)
+                prompt.write(prmpt)
         else:
             raise Exception("Unreachable! Inexhaustive token types: " + str(tkn.type))
 
         docstring_state = docstring_state or DocstringState.Skipped
 
+    return r_texts
+
+
+def parse_fpp_regions(tokens: Tokens):
     out = { 'metadata': tokens.metadata }
-    for k, region_list in r_texts.items():
-        ls = ''.join(region_list)
-        ls = map(str.rstrip, ls.splitlines())
-        if k == 'prompt_code':
-            ls = filter(bool, ls)
-        out[k] = '\n'.join(ls).strip()
+    for k, writer in stream_fpp_regions(tokens).items():
+        out[k] = writer.getvalue()
 
     return out
 
@@ -170,10 +181,17 @@ def generate_fpp_question(
     force_generate_json: bool = False,
     no_parse: bool = False,
     log_details: bool = True,
+    timings: Optional[Timings] = None,
+    finish: bool = True,
 ):
     """ Takes a path of a well-formatted source (see `extract_prompt_ans`),
         then generates and populates a question directory of the same name.
+        Records how long each stage takes in `timings`, if given.
+        Unless `finish` is False, waits for work the autograder runs in the
+        background (e.g. gem installs), so the question is complete on return;
+        a batch can instead call the autograders' `finish` once at the end.
     """
+    timings = timings or NoTimings()
     Bcolors.info('Generating from source', source_path)
 
     source_path = resolve_path(source_path)
@@ -185,9 +203,10 @@ def generate_fpp_question(
     if log_details:
         print('- Extracting from source...')
 
-    with open(source_path, 'r') as source:
+    with timings.span('lex'), open(source_path, 'r') as source:
         source_code = ''.join(source)
         tokens = lex(source_code, source_path=source_path)
+    with timings.span('parse_regions'):
         regions = parse_fpp_regions(tokens)
 
     def remove_region(key, default=''):
@@ -212,12 +231,13 @@ def generate_fpp_question(
         print('- Creating destination directories...')
 
     test_dir = path.join(question_dir, 'tests')
-    make_if_absent(test_dir)
-
     copy_dest_path = path.join(question_dir, 'source.py')
-    if log_details:
-        print('- Copying {} to {} ...'.format(path.basename(source_path), copy_dest_path))
-    copyfile(source_path, copy_dest_path)
+    with timings.span('write_files'):
+        make_if_absent(test_dir)
+
+        if log_details:
+            print('- Copying {} to {} ...'.format(path.basename(source_path), copy_dest_path))
+        copyfile(source_path, copy_dest_path)
 
     if log_details:
         print('- Populating {} ...'.format(question_dir))
@@ -226,11 +246,12 @@ def generate_fpp_question(
     answer_code = remove_region('answer_code')
 
     server_code = remove_region('server')
-    gen_server_code, setup_names, answer_names = autograder.generate_server(
-        setup_code=setup_code,
-        answer_code=answer_code,
-        no_ast=no_parse
-    )
+    with timings.span('generate_server'):
+        gen_server_code, setup_names, answer_names = autograder.generate_server(
+            setup_code=setup_code,
+            answer_code=answer_code,
+            no_ast=no_parse
+        )
     server_code = server_code or gen_server_code
 
     prompt_code = remove_region('prompt_code')
@@ -244,37 +265,40 @@ def generate_fpp_question(
         # answer_names=answer_names if show_required else None
     )
 
-    write_to(question_dir, 'question.html', question_html)
+    with timings.span('write_files'):
+        write_to(question_dir, 'question.html', question_html)
 
-    write_to(question_dir, 'solution', answer_code)
+        write_to(question_dir, 'solution', answer_code)
 
-    json_path = path.join(question_dir, 'info.json')
-    json_region = remove_region('info.json')
-    missing_json = not path.exists(json_path)
-    if force_generate_json or json_region or missing_json:
-        json_text = json_region or generate_info_json(question_name, autograder)
-        write_to(question_dir, 'info.json', json_text)
-        if not missing_json:
-            Bcolors.warn('  - Overwriting', json_path,
-                         'using \"info.json\" region...' if json_region else '...')
+        json_path = path.join(question_dir, 'info.json')
+        json_region = remove_region('info.json')
+        missing_json = not path.exists(json_path)
+        if force_generate_json or json_region or missing_json:
+            json_text = json_region or generate_info_json(question_name, autograder)
+            write_to(question_dir, 'info.json', json_text)
+            if not missing_json:
+                Bcolors.warn('  - Overwriting', json_path,
+                             'using \"info.json\" region...' if json_region else '...')
 
-    write_to(question_dir, 'server.py', server_code)
+        write_to(question_dir, 'server.py', server_code)
 
     if log_details:
         print('- Populating {} ...'.format(test_dir))
 
     test_region = remove_region('test')
 
-    autograder.populate_tests_dir(
-        test_dir,
-        answer_code,
-        setup_code,
-        test_region,
-        log_details = log_details
-    )
+    with timings.span('generate_tests'):
+        autograder.populate_tests_dir(
+            test_dir,
+            answer_code,
+            setup_code,
+            test_region,
+            log_details = log_details
+        )
 
     if metadata:
-        write_to(question_dir, 'metadata.json', dumps(metadata))
+        with timings.span('write_files'):
+            write_to(question_dir, 'metadata.json', dumps(metadata))
 
     if regions:
         Bcolors.warn('- Writing unrecognized regions:')
@@ -294,9 +318,14 @@ def generate_fpp_question(
         Bcolors.warn('  -', final_path, '...')
 
         # write files
-        write_to(question_dir, raw_path, data)
-    
-    autograder.clean_tests_dir(test_dir)
+        with timings.span('write_files'):
+            write_to(question_dir, raw_path, data)
+
+    with timings.span('package_gems'):
+        autograder.clean_tests_dir(test_dir)
+        # the autograder has already reported why
+        if finish and autograder.finish():
+            raise OSError(f'Could not finish setting up `{test_dir}`')
 
     Bcolors.printf(Bcolors.OK_GREEN, 'Done.')
 
@@ -305,14 +334,24 @@ def generate_many(args: Namespace):
     if not args.source_paths:
         args.source_paths = auto_detect_sources()
 
+    timings = Timings() if args.timings or args.trace else NoTimings()
+    if args.no_name_cache:
+        name_cache.root = None
+    if args.no_test_cache:
+        test_file_cache.root = None
+    name_cache.extended = args.extended_names
+
     def generate_one(source_path, force_json=False):
         try:
-            generate_fpp_question(
-                source_path,
-                force_generate_json=force_json,
-                no_parse=args.no_parse,
-                log_details=not args.quiet
-            )
+            with timings.question(source_path):
+                generate_fpp_question(
+                    source_path,
+                    force_generate_json=force_json,
+                    no_parse=args.no_parse,
+                    log_details=not args.quiet,
+                    timings=timings,
+                    finish=False
+                )
             return True
         except SyntaxError as e:
             Bcolors.fail('SyntaxError:', e.msg)
@@ -335,6 +374,12 @@ def generate_many(args: Namespace):
         else:
             failures += 1
 
+    # finish work the autograders left running in the background, e.g. shared gem installs
+    with timings.question('<batch>'), timings.span('package_gems'):
+        for autograder in autograders.values():
+            failed = autograder.finish()
+            successes, failures = successes - len(failed), failures + len(failed)
+
     # print batch feedback
     if successes + failures > 1:
         def n_files(n): return str(n) + ' file' + ('' if n == 1 else 's')
@@ -347,6 +392,13 @@ def generate_many(args: Namespace):
         else:
             Bcolors.fail('Batch failed on all', n_files(failures))
 
+    if args.timings:
+        write_to('.', args.timings, timings.to_json())
+        Bcolors.info('Wrote stage timings to', args.timings)
+    if args.trace:
+        write_to('.', args.trace, timings.to_chrome_trace())
+        Bcolors.info('Wrote Chrome trace to', args.trace)
+
 
 def profile_generate_many(args: Namespace):
     from cProfile import Profile
@@ -1,12 +1,19 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
+from shutil import copy2, rmtree
+from subprocess import CalledProcessError, run
+from tempfile import mkdtemp
+from threading import Lock
+from typing import Dict, Optional, Union
 from json import loads, dumps
-from os import makedirs, path, popen
+from os import link, listdir, makedirs, path, rename, unlink
 
 from lib.name_visitor import AnnotatedName, generate_server, SERVER_DEFAULT
 from lib.consts import TEST_DEFAULT
 from lib.io_helpers import write_to, Bcolors
-from lib.generate_test import make_test_file
+from lib.generate_test import GRADER_TIMEOUT, make_test_file
+from lib.reference_outputs import FIXTURE_NAME, write_reference_outputs
 
 DEFAULT_GEMFILE = """source 'https://www.rubygems.org'
 
@@ -14,6 +21,128 @@ gem 'rspec'
 gem 'json'
 """
 RUBY_SETUP_CMD = """bundle package"""
+# the tools whose versions decide what `bundle package` vendors, so they are part of each cache key
+RUBY_VERSION_CMDS = ['ruby --version', 'bundle --version']
+GEM_CACHE_DIR = path.join(path.expanduser('~'), '.cache', 'pl-faded-parsons', 'gems')
+
+
+class GemCache:
+    """ Vendors the gems for each distinct Gemfile once, in the background,
+        then hard-links (or copies) them into every app dir with that Gemfile.
+        Call `wait` to finish the installs and fill in the app dirs.
+    """
+
+    def __init__(self, root: str = GEM_CACHE_DIR, command: list[str] = RUBY_SETUP_CMD.split(), workers: int = 4):
+        self.root = root
+        self.command = command
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = Lock()
+        self.builds: dict[str, Future] = {}
+        self.pending: list[tuple[str, Future]] = []
+        self.versions: Optional[str] = None
+
+    def tool_versions(self) -> str:
+        """The output of each of `RUBY_VERSION_CMDS` (empty for missing tools), read once"""
+        if self.versions is None:
+            outputs = []
+            for command in RUBY_VERSION_CMDS:
+                try:
+                    outputs.append(run(command.split(), capture_output=True, text=True).stdout.strip())
+                except OSError:
+                    outputs.append('')
+            self.versions = '\0'.join(outputs)
+        return self.versions
+
+    def key(self, gemfile: str) -> str:
+        salt = ' '.join(self.command) + '\0' + self.tool_versions() + '\0'
+        return sha256((salt + gemfile).encode()).hexdigest()[:24]
+
+    def build(self, key: str, gemfile: str) -> str:
+        """ Runs the setup command in a fresh directory holding only the Gemfile,
+            then moves the result to the cache entry for `key` and returns its path.
+        """
+        entry = path.join(self.root, key)
+        if path.isdir(entry):
+            return entry
+        makedirs(self.root, exist_ok=True)
+        staging = mkdtemp(dir=self.root, prefix='.' + key)
+        try:
+            write_to(staging, 'Gemfile', gemfile)
+            run(self.command, cwd=staging, check=True, capture_output=True, text=True)
+            try:
+                rename(staging, entry)
+            except OSError:
+                # another generator filled this entry first; theirs is just as good
+                if not path.isdir(entry):
+                    raise
+        finally:
+            rmtree(staging, ignore_errors=True)
+        return entry
+
+    def install(self, app_dir: str) -> None:
+        with open(path.join(app_dir, 'Gemfile')) as f:
+            gemfile = f.read()
+        key = self.key(gemfile)
+        with self.lock:
+            if key not in self.builds:
+                self.builds[key] = self.pool.submit(self.build, key, gemfile)
+            self.pending.append((app_dir, self.builds[key]))
+
+    @staticmethod
+    def remove(file_path: str) -> None:
+        if path.isdir(file_path) and not path.islink(file_path):
+            rmtree(file_path)
+        elif path.lexists(file_path):
+            unlink(file_path)
+
+    @staticmethod
+    def link_tree(src: str, dst: str, prune: bool = False) -> None:
+        """ Links every file of `src` into `dst`, replacing what is there.
+            If `prune`, files in `dst` that are not in `src` are removed too;
+            this holds for every directory below the app dir (e.g. vendor/cache),
+            but not the app dir itself, which also holds the question's code.
+        """
+        if not path.isdir(dst):
+            GemCache.remove(dst)
+            makedirs(dst)
+        names = listdir(src)
+        if prune:
+            # gems left from an earlier Gemfile's install
+            for name in set(listdir(dst)) - set(names):
+                GemCache.remove(path.join(dst, name))
+        for name in names:
+            s, d = path.join(src, name), path.join(dst, name)
+            if path.isdir(s):
+                GemCache.link_tree(s, d, prune=True)
+                continue
+            if name == 'Gemfile':
+                continue
+            # files from an earlier Gemfile's install give way to this entry's
+            GemCache.remove(d)
+            try:
+                link(s, d)
+            except OSError:
+                copy2(s, d)
+
+    def wait(self) -> list[str]:
+        """ Waits for every queued install and links its gems into place.
+            Returns the app dirs whose installs failed, after reporting why.
+        """
+        failed = []
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for app_dir, build in pending:
+            try:
+                self.link_tree(build.result(), app_dir)
+            except CalledProcessError as e:
+                Bcolors.fail(f'* `{" ".join(e.cmd)}` failed for `{app_dir}` with exit code {e.returncode}:')
+                Bcolors.fail((e.stderr or e.stdout or '').strip())
+                failed.append(app_dir)
+            except OSError as e:
+                Bcolors.fail(f'* Could not install gems in `{app_dir}`:', e)
+                failed.append(app_dir)
+        return failed
+
 
 class AutograderConfig(ABC):
 
@@ -26,7 +155,14 @@ class AutograderConfig(ABC):
         pass
 
     def clean_tests_dir(self, test_dir: str) -> None:
-        return 
+        return
+
+    @classmethod
+    def finish(cls) -> list[str]:
+        """ Completes any work `clean_tests_dir` left running in the background.
+            Returns the test dirs it failed for.
+        """
+        return []
 
     def generate_server(self, setup_code: str, answer_code: str, *,
                     no_ast: bool = False, tab: str = '    ') -> tuple[str, list[AnnotatedName], list[AnnotatedName]]:
@@ -51,7 +187,7 @@ class PythonAutograder(AutograderConfig):
                 'enabled': True,
                 'image': 'prairielearn/grader-python',
                 'entrypoint': '/python_autograder/run.sh',
-                'timeout': 5
+                'timeout': GRADER_TIMEOUT
             }
         }
 
@@ -61,23 +197,41 @@ class PythonAutograder(AutograderConfig):
         try:
             try:
                 json = loads(test_region)
+            except ValueError:
+                json = None
+            if isinstance(json, dict):
+                # invalid tests or cases raise SyntaxError, reported below
                 success, test_file = True, make_test_file(json)
-            except Exception as e:
+            else:
                 success, test_file = False, test_region
 
             if success and log_details:
                 Bcolors.info('  - Generating tests/test.py from json test region')
                 write_to(test_dir, 'test_source.json', test_region)
         except SyntaxError as e:
-            if log_details:
-                Bcolors.fail('    * Generating tests from json failed with error:', e.msg)
-                Bcolors.warn('    - Recovering by using test region as python file')
-            test_file = test_region
+            Bcolors.fail('    * Generating tests from json failed with error:', e.msg)
+            Bcolors.warn('    - Recovering by using test region as python file')
+            success, test_file = False, test_region
+        except Exception as e:
+            # e.g. a malformed test object; this question gets no tests, but the batch goes on
+            Bcolors.fail('    * Generating tests from json failed with error:', f'{e.__class__.__name__}: {e}')
+            Bcolors.warn('    - Skipping tests/test.py')
+            success, test_file = False, None
 
-        write_to(test_dir, 'test.py', test_file)
+        if test_file is not None:
+            write_to(test_dir, 'test.py', test_file)
+        elif path.exists(path.join(test_dir, 'test.py')):
+            # a test.py from an earlier run would grade against the old tests
+            unlink(path.join(test_dir, 'test.py'))
         write_to(test_dir, 'ans.py', answer_code)
         write_to(test_dir, 'setup_code.py', setup_code)
 
+        precomputed, skipped = write_reference_outputs(test_dir, json if success else None)
+        if precomputed and log_details:
+            Bcolors.info(f'  - Precomputed reference outputs for {precomputed} test(s) in {FIXTURE_NAME}')
+        for reason in skipped:
+            Bcolors.warn('    - Reference outputs will be computed while grading for', reason)
+
     def generate_server(self, setup_code: str, answer_code: str, *,
                     no_ast: bool = False, tab: str = '    ') -> tuple[str, list[AnnotatedName], list[AnnotatedName]]:
         return generate_server(setup_code, answer_code, no_ast=no_ast, tab=tab)
@@ -122,14 +276,21 @@ class RubyAutograder(AutograderConfig):
         write_to(test_dir, 'meta.json', metadata)
         write_to(test_dir, 'solution', answer_code)
 
+    # made on first use, so runs without ruby questions never start its workers
+    gem_cache: Optional[GemCache] = None
+
     def clean_tests_dir(self, test_dir: str) -> None:
         app_dir = path.join(path.dirname(f"{test_dir}/"), "app")
-        print(f"Installing gems locally in `{app_dir}` with `{RUBY_SETUP_CMD}` ... ", end="")
-        with popen(f"cd {app_dir} && " + RUBY_SETUP_CMD) as out:
-            out.read()
-            # this print is here to join the thread that runs the command and 
-            #   prevent the generator from exiting before gems are installed
-            print("Done") 
+        print(f"Installing gems locally in `{app_dir}` with `{RUBY_SETUP_CMD}` (cached per Gemfile) ...")
+        if RubyAutograder.gem_cache is None:
+            RubyAutograder.gem_cache = GemCache()
+        RubyAutograder.gem_cache.install(app_dir)
+
+    @classmethod
+    def finish(cls) -> list[str]:
+        if cls.gem_cache is None:
+            return []
+        return [path.dirname(app_dir) for app_dir in cls.gem_cache.wait()]
 
     def generate_server(self, setup_code: str, answer_code: str, *,
                     no_ast: bool = False, tab: str = '    ') -> tuple[str, list[AnnotatedName], list[AnnotatedName]]:
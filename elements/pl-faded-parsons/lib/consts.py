@@ -152,6 +152,7 @@ PROGRAM_DESCRIPTION: Final[str] = Bcolors.f(Bcolors.OK_GREEN, ' A tool for gener
          implicit: `answer_code` `prompt_code` `question_text`
      - Code in `setup_code` will be parsed to extract exposed names unless the --no-parse
        flag is set. Type annotations and function docstrings are used to fill out server.py
+       (add --extended-names to also expose classes, imports, and unpacked or loop targets)
      - Any custom region that clashes with an automatically generated file name
        will overwrite the automatically generated code
  - Import regions allow for the contents of arbitrary files to be loaded as regions
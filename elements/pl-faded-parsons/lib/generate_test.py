@@ -1,28 +1,135 @@
-from io import StringIO
-from typing import Final
+from ast import parse
+from hashlib import sha256
+from json import dumps
+from os import makedirs, path, replace
+from string import ascii_lowercase
+from tempfile import NamedTemporaryFile
+from typing import Final, Optional
 
+from lib.consts import Bcolors
 
+TEST_CACHE_DIR = path.join(path.expanduser('~'), '.cache', 'pl-faded-parsons', 'tests')
+# bump whenever make_test_file's output changes outside of STUB and CASE_GENERATOR,
+# so cached test files are not reused
+TESTS_VERSION = 1
+
+
+# seconds the python grader may run for (externalGradingOptions.timeout in info.json)
+GRADER_TIMEOUT: Final[int] = 5
+# seconds any one case may run for, unless the test json sets "caseTimeout"
+DEFAULT_CASE_TIMEOUT: Final[float] = 1.0
+
+SPEC_TYPES: Final[tuple[str, ...]] = ('int', 'float', 'bool', 'choice', 'str', 'list', 'tuple')
+
+# formatted with `%` by `make_stub`
 STUB: Final[str] = """
+import copy
+import pickle
+import random
+import signal
+import threading
+import time
+from hashlib import sha256
+from itertools import chain
+from os import path
+
 from pl_helpers import name, points
 from pl_unit_test import PLTestCase
 from code_feedback import Feedback
 
+# externalGradingOptions.timeout in info.json, less time to start up and report
+GRADING_BUDGET = 0.8 * %(grading_timeout)r
+# the most time any one case may take
+CASE_TIMEOUT = %(case_timeout)r
+GRADING_DEADLINE = time.monotonic() + GRADING_BUDGET
+
+
+def load_reference_outputs():
+    \""" Returns the reference outputs of each test, precomputed when this file was
+        generated, or {} if they are missing or ans.py or setup_code.py has changed since
+    \"""
+    tests_dir = path.dirname(path.abspath(__file__))
+    try:
+        digest = sha256()
+        for file_name in ('setup_code.py', 'ans.py'):
+            with open(path.join(tests_dir, file_name), 'rb') as f:
+                digest.update(f.read() + b'\\0')
+        with open(path.join(tests_dir, 'reference_outputs.pickle'), 'rb') as f:
+            fixture = pickle.load(f)
+        return fixture['outputs'] if fixture['digest'] == digest.hexdigest() else {}
+    except Exception:
+        return {}
+
+
+REFERENCE_OUTPUTS = load_reference_outputs()
+
 
-def score_cases(student_fn, ref_fn, *cases):
+%(case_generator)s
+
+
+class CaseTimeout(BaseException):
+    \""" Interrupts a student's function that runs past its case's time budget.
+        Not an Exception, so `Feedback.call_user` lets it through.
+    \"""
+
+
+def raise_case_timeout(signum, frame):
+    raise CaseTimeout()
+
+
+def call_with_budget(fn, case, budget):
+    \""" Calls `fn(*case)` for the student, interrupting it after `budget` seconds
+        (where SIGALRM is available; otherwise slow cases just count against the deadline)
+    \"""
+    alarm = hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+    if alarm:
+        previous = signal.signal(signal.SIGALRM, raise_case_timeout)
+        signal.setitimer(signal.ITIMER_REAL, budget)
+    try:
+        return Feedback.call_user(fn, *case)
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def score_cases(student_fn, ref_fn, *cases, expected=None, generated=()):
     \""" Compares the results of `student_fn` to `ref_fn` over each case,
-        and sets the feedback score to the ratio of cases that had the
-        correct result over the total number of cases
+        then over each `generated` case, and sets the feedback score to the
+        ratio of cases that had the correct result over the total number of cases.
+        If given, `expected` holds the results of `ref_fn` for each case.
+
+        Each case may run for CASE_TIMEOUT seconds, and once the grading
+        deadline passes the remaining cases are skipped and scored as wrong,
+        so a slow case costs its own points rather than the whole test's feedback.
+        Generated cases past their own test's time budget are not counted.
     \"""
-    correct = 0
-    for case in cases:
-        user_val = Feedback.call_user(student_fn, *case)
-        ref_val = ref_fn(*case)
+    correct, messages, out_of_time = 0, [], False
+    total = len(cases) + len(generated)
+    for i, case in enumerate(chain(cases, generated)):
+        remaining = GRADING_DEADLINE - time.monotonic()
+        if remaining <= 0:
+            messages.append(f'Stopped after {i} of {total} cases: out of time.')
+            out_of_time = True
+            break
+        budget = min(CASE_TIMEOUT, remaining)
+        try:
+            user_val = call_with_budget(student_fn, case, budget)
+        except CaseTimeout:
+            messages.append(f'Case {i + 1} took longer than {budget:.2g}s.')
+            continue
+        ref_val = ref_fn(*case) if expected is None else expected[i]
         if user_val == ref_val:
             correct += 1
 
-    # set_score must be in range 0.0 to 1.0
-    if cases:
-        Feedback.set_score(correct / len(cases))
+    # feedback is written once, however many cases needed it
+    if messages:
+        Feedback.add_feedback('\\n'.join(messages))
+
+    # set_score must be in range 0.0 to 1.0; only the test's own budget ending early drops cases
+    scored = total if out_of_time else len(cases) + getattr(generated, 'produced', 0)
+    if scored:
+        Feedback.set_score(correct / scored)
     else:
         Feedback.set_score(1.0)
 
@@ -31,19 +138,61 @@ class Test(PLTestCase):
 """.strip()
 
 
-class Writer:
-    def __init__(self) -> None:
-        self.indent = 0
-        self.indent_text = '    '
-        self.stream = StringIO()
+# included in the generated test.py, and run by `lib.reference_outputs` to precompute generated cases
+CASE_GENERATOR: Final[str] = """
+class GeneratedCases:
+    \""" Lazily draws `count` argument tuples from `specs` (see `generate_test.clean_spec`),
+        the same ones on every python for the same seed, as it only uses `Random.random`.
+        Stops early once `budget` seconds have passed since the first case.
+    \"""
+
+    def __init__(self, seed, count, specs, budget=None):
+        self.seed, self.count, self.specs, self.budget = seed, count, specs, budget
+        self.produced = 0
+
+    def __len__(self):
+        return self.count
+
+    def draw(self, rng, spec):
+        kind = spec['type']
+        if kind == 'int':
+            return spec['min'] + min(int(rng.random() * (spec['max'] - spec['min'] + 1)), spec['max'] - spec['min'])
+        if kind == 'float':
+            return spec['min'] + rng.random() * (spec['max'] - spec['min'])
+        if kind == 'bool':
+            return rng.random() < 0.5
+        if kind == 'choice':
+            return copy.deepcopy(self.pick(rng, spec['values']))
+        if kind == 'tuple':
+            return tuple(self.draw(rng, s) for s in spec['of'])
+        low, high = spec['size']
+        size = low + min(int(rng.random() * (high - low + 1)), high - low)
+        if kind == 'str':
+            return ''.join(self.pick(rng, spec['alphabet']) for _ in range(size))
+        return [self.draw(rng, spec['of']) for _ in range(size)]
 
-    def writeln(self, text: str = '\n') -> None:
-        """Writes lines of text to stream at current indent level"""
-        ind = self.indent * self.indent_text
-        self.stream.writelines(f'{ind}{line}\n' for line in text.splitlines())
+    @staticmethod
+    def pick(rng, values):
+        return values[min(int(rng.random() * len(values)), len(values) - 1)]
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        self.produced = 0
+        stop = None if self.budget is None else time.monotonic() + self.budget
+        for _ in range(self.count):
+            if stop is not None and time.monotonic() > stop:
+                return
+            self.produced += 1
+            yield tuple(self.draw(rng, spec) for spec in self.specs)
+""".strip()
 
-    def __str__(self) -> str:
-        return self.stream.getvalue()
+
+def make_stub(case_timeout: float = DEFAULT_CASE_TIMEOUT) -> str:
+    return STUB % {
+        'grading_timeout': GRADER_TIMEOUT,
+        'case_timeout': case_timeout,
+        'case_generator': CASE_GENERATOR,
+    }
 
 
 def expect_type(clz: type, obj: object, context: str):
@@ -61,13 +210,149 @@ def expect_value(obj: dict, key: str, clz: type, context: str):
 
 def clean_input_iter(inputs: list, context: str):
     for i, inp in enumerate(inputs):
-        inp: str = expect_type(str, inp.strip(), f'input {i} in {context}')
+        inp: str = expect_type(str, inp, f'input {i} in {context}').strip()
         # format into tuple if necessary
         if not inp.startswith('(') and not inp.endswith(')'):
             inp = f'({inp},)'
         yield inp
 
-def make_test_file(json: dict) -> str:
+def check_cases(cases: list[str], context: str) -> list[str]:
+    """ Checks that each case is exactly one argument to `score_cases`:
+        a python expression, or a `*`-unpacked iterable of cases.
+        Returns an error message for each case that is not.
+    """
+    # one parse covers a whole test unless something is wrong with it
+    try:
+        call = parse('_(\n' + ',\n'.join(cases) + '\n)', mode='eval').body
+        if len(call.args) == len(cases) and not call.keywords:
+            return []
+    except SyntaxError:
+        pass
+
+    errors = []
+    for i, case in enumerate(cases):
+        try:
+            call = parse(f'_({case})', mode='eval').body
+        except SyntaxError as e:
+            errors.append(f'input {i} in {context} is not valid python ({e.msg}): {case}')
+            continue
+        if len(call.args) != 1 or call.keywords:
+            errors.append(f'input {i} in {context} is not a single expression: {case}')
+    return errors
+
+def clean_size(size, context: str) -> list[int]:
+    """A size is a fixed length, or an inclusive [min, max] range of lengths"""
+    if size.__class__ == int:
+        size = [size, size]
+    if size.__class__ != list or len(size) != 2 or any(n.__class__ != int or n < 0 for n in size) \
+            or size[0] > size[1]:
+        raise SyntaxError(f'"size" in {context} expected a length or [min, max] lengths, got {size!r}')
+    return size
+
+def clean_spec(spec: dict, context: str) -> dict:
+    """ Checks one argument's generator spec and fills in its defaults:
+        ```
+        {"type": "int" | "float", "min": number (default 0), "max": number (default 100)}
+        {"type": "bool"}
+        {"type": "choice", "values": list}
+        {"type": "str", "alphabet": str (default a-z), "size": size (default [0, 10])}
+        {"type": "list", "of": spec, "size": size (default [0, 10])}
+        {"type": "tuple", "of": list[spec]}
+        ```
+    """
+    expect_type(dict, spec, context)
+    kind = expect_value(spec, 'type', str, context)
+    if kind in ('int', 'float'):
+        number_types = (int,) if kind == 'int' else (int, float)
+        low, high = spec.get('min', 0), spec.get('max', 100)
+        if low.__class__ not in number_types or high.__class__ not in number_types or low > high:
+            raise SyntaxError(f'{context} expected {kind}s "min" <= "max", got {low!r} and {high!r}')
+        return { 'type': kind, 'min': low, 'max': high }
+    if kind == 'bool':
+        return { 'type': kind }
+    if kind == 'choice':
+        values = expect_value(spec, 'values', list, context)
+        if not values:
+            raise SyntaxError(f'"values" in {context} must not be empty')
+        return { 'type': kind, 'values': values }
+    if kind == 'str':
+        alphabet = expect_type(str, spec.get('alphabet', ascii_lowercase), f'"alphabet" in {context}')
+        if not alphabet:
+            raise SyntaxError(f'"alphabet" in {context} must not be empty')
+        return { 'type': kind, 'alphabet': alphabet, 'size': clean_size(spec.get('size', [0, 10]), context) }
+    if kind == 'list':
+        of = clean_spec(expect_value(spec, 'of', dict, context), f'"of" in {context}')
+        return { 'type': kind, 'of': of, 'size': clean_size(spec.get('size', [0, 10]), context) }
+    if kind == 'tuple':
+        of = expect_value(spec, 'of', list, context)
+        return { 'type': kind, 'of': [clean_spec(s, f'item {i} of "of" in {context}') for i, s in enumerate(of)] }
+    raise SyntaxError(f'{context} has unknown type "{kind}" (expected one of {", ".join(SPEC_TYPES)})')
+
+def clean_generator(generate: dict, context: str) -> tuple[int, int, list[dict]]:
+    """ Checks a test's "generate" object, `{"seed": int (default 0), "count": int, "args": list[spec]}`,
+        returning its seed, count and a cleaned spec for each argument
+    """
+    context = f'"generate" in {context}'
+    expect_type(dict, generate, context)
+    seed = expect_type(int, generate.get('seed', 0), f'"seed" in {context}')
+    count = expect_value(generate, 'count', int, context)
+    if count < 1:
+        raise SyntaxError(f'"count" in {context} must be at least 1')
+    args = expect_value(generate, 'args', list, context)
+    return seed, count, [clean_spec(spec, f'arg {i} in {context}') for i, spec in enumerate(args)]
+
+class TestFileCache:
+    """ Remembers the test file made from each distinct test json as one file per hash
+        in `root` (if set), so unchanged tests are not rebuilt by the next run.
+        Errors are never cached.
+    """
+
+    def __init__(self, root: Optional[str] = TEST_CACHE_DIR):
+        self.root = root
+
+    @staticmethod
+    def key(json: dict) -> str:
+        # the stub is part of every test file, so any change to it makes new entries
+        salt = f'{TESTS_VERSION}.{GRADER_TIMEOUT}\0{STUB}\0{CASE_GENERATOR}\0'
+        return sha256((salt + dumps(json, sort_keys=True)).encode()).hexdigest()[:24]
+
+    def get_test_file(self, json: dict) -> str:
+        if not self.root:
+            return build_test_file(json)
+        try:
+            key = self.key(json)
+        except (TypeError, ValueError):
+            # not plain json, so it has no stable key
+            return build_test_file(json)
+
+        test_file = self.load(key)
+        if test_file is None:
+            test_file = build_test_file(json)
+            self.save(key, test_file)
+        return test_file
+
+    def load(self, key: str) -> Optional[str]:
+        try:
+            with open(path.join(self.root, key + '.py')) as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key: str, test_file: str) -> None:
+        try:
+            makedirs(self.root, exist_ok=True)
+            with NamedTemporaryFile('w', dir=self.root, prefix='.' + key, delete=False) as f:
+                f.write(test_file)
+            # concurrent generators may race to save the same key; either result is fine
+            replace(f.name, path.join(self.root, key + '.py'))
+        except OSError as e:
+            Bcolors.warn('Could not cache test file:', e)
+
+
+test_file_cache = TestFileCache()
+
+
+def make_test_file(json: dict, cache: Optional[TestFileCache] = None) -> str:
     """ Expects a dict with the following structure:
         ```
         {
@@ -75,11 +360,25 @@ def make_test_file(json: dict) -> str:
             "tests": list[{
                 "name": str,
                 "points": number,
-                "cases": list[str of fn arguments]
-            }]
+                "cases": list[str of fn arguments],
+                "generate": { "seed": int, "count": int, "args": list[spec] } (optional)
+            }],
+            "precompute": bool (optional, default true),
+            "caseTimeout": number of seconds (optional, default 1)
         }
         ```
+        Cases are generated lazily at grading time from each "generate" spec
+        (see `clean_spec`), for as long as the test's share of the time allows.
+        If "precompute" is true, the reference outputs can be written
+        to a fixture next to the tests by `lib.reference_outputs`.
+        Every case is checked before any output is made.
+        Output is cached on disk by `cache` (default: `test_file_cache`),
+        so an unchanged json is only generated once.
     """
+    return (cache or test_file_cache).get_test_file(json)
+
+def build_test_file(json: dict) -> str:
+    """Makes the test file described by `json` (see `make_test_file`)"""
     context = 'top-level object'
     fn_name = expect_value(json, 'functionName', str, context)
     tests = expect_value(json, 'tests', list, context)
@@ -87,30 +386,56 @@ def make_test_file(json: dict) -> str:
     def make_decorator(obj: dict, key: str, clz: type, context: str):
         return f'@{key}({repr(expect_value(obj, key, clz, context))})'
 
-    w = Writer()
-    w.writeln(STUB)
-    w.indent = 1
     expect_type(list, tests, context)
     if not tests:
         raise SyntaxError('tests are required to generate file')
+    case_timeout = json.get('caseTimeout', DEFAULT_CASE_TIMEOUT)
+    if case_timeout.__class__ not in (int, float) or case_timeout <= 0:
+        raise SyntaxError(f'key "caseTimeout" in {context} expected a positive number of seconds, got {case_timeout!r}')
+
+    # validate everything first, so that all the bad cases are reported together
+    checked, errors = [], []
     for i, test in enumerate(tests):
         context = f'test {i}'
         expect_type(dict, test, context)
-        w.writeln(make_decorator(test, 'name', str, context))
+        name = make_decorator(test, 'name', str, context)
         context = f'test {i} "{test["name"]}"'
-        w.writeln(make_decorator(test, 'points', int, context))
-        w.writeln(f'def test_{i}(self):')
-        w.indent += 1
-        w.writeln(f'score_cases(self.st.{fn_name}, self.ref.{fn_name},')
-        w.indent += 1
-        inputs = expect_value(test, 'inputs', list, context)
-        w.writeln(',\n'.join(clean_input_iter(inputs, context)))
-        w.indent -= 1
-        w.writeln(')')
-        w.indent -= 1
-        w.writeln()
+        points = make_decorator(test, 'points', int, context)
+        generated = None
+        if 'generate' in test:
+            generated = clean_generator(test['generate'], context)
+            inputs = expect_type(list, test.get('inputs', []), f'key "inputs" in {context}')
+        else:
+            inputs = expect_value(test, 'inputs', list, context)
+        cases = list(clean_input_iter(inputs, context))
+        errors += check_cases(cases, context)
+        checked.append((name, points, cases, generated))
+    if errors:
+        raise SyntaxError('\n'.join(errors))
+
+    ind = '    '
+    out = [make_stub(case_timeout), '\n']
+    for i, (name, points, cases, generated) in enumerate(checked):
+        out += [
+            ind, name, '\n',
+            ind, points, '\n',
+            ind, f'def test_{i}(self):\n',
+            ind * 2, f'score_cases(self.st.{fn_name}, self.ref.{fn_name},\n',
+        ]
+        case_ind = ind * 3
+        for case in cases:
+            out += [case_ind, ('\n' + case_ind).join(case.splitlines()), ',\n']
+        if generated:
+            seed, count, specs = generated
+            # each test may spend an equal share of the time on generated cases
+            out += [case_ind, f'generated=GeneratedCases({seed}, {count}, {specs!r}, GRADING_BUDGET / {len(checked)}),\n']
+        out += [
+            case_ind, f'expected=REFERENCE_OUTPUTS.get({i})\n',
+            ind * 2, ')\n',
+            ind, '\n',
+        ]
 
-    return str(w)
+    return ''.join(out)
 
 
 def __main__():
@@ -125,8 +450,11 @@ def __main__():
             "tests": list[{
                 "name": str,
                 "points": number,
-                "cases": list[str of fn arguments]
-            }]
+                "cases": list[str of fn arguments],
+                "generate": { "seed": int, "count": int, "args": list[spec] } (optional)
+            }],
+            "precompute": bool (optional, default true),
+            "caseTimeout": number of seconds (optional, default 1)
         }"""
     )
 
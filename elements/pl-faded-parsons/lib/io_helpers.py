@@ -191,10 +191,20 @@ def parse_args(arg_text: str = None) -> Namespace:
 
     parser.add_argument('--profile', action='store_true',
                         help='prints profile data after running')
+    parser.add_argument('--timings', metavar='path',
+                        help='writes the time spent in each stage of each question to a JSON file')
+    parser.add_argument('--trace', metavar='path',
+                        help='writes the stage timings as a Chrome trace (open in chrome://tracing)')
     parser.add_argument('--quiet', action='store_true',
                         help='restricts logging to warnings and errors only')
     parser.add_argument('--no-parse', action='store_true',
                         help='prevents the code from being parsed by py.ast to derive content')
+    parser.add_argument('--no-name-cache', action='store_true',
+                        help='re-parses code even if its names were cached by an earlier run')
+    parser.add_argument('--no-test-cache', action='store_true',
+                        help='regenerates test files even if they were cached by an earlier run')
+    parser.add_argument('--extended-names', action='store_true',
+                        help='also exposes classes, imports, and unpacked, loop and walrus targets in server.py')
 
     parser.add_argument('source_path', action='append', nargs='*')
     parser.add_argument('--questions-dir', action='append', metavar='path',
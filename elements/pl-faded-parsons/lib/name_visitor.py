@@ -1,10 +1,19 @@
 from ast import *
 
-from dataclasses import dataclass
-from typing import Union, Any
+from dataclasses import astuple, dataclass
+from hashlib import sha256
+from json import dumps, loads
+from os import makedirs, path, replace
+from sys import version_info
+from tempfile import NamedTemporaryFile
+from typing import Optional, Union, Any
 
 from lib.consts import Bcolors, SERVER_DEFAULT
 
+NAME_CACHE_DIR = path.join(path.expanduser('~'), '.cache', 'pl-faded-parsons', 'names')
+# bump whenever GlobalNameVisitor's output changes, so cached analyses are not reused
+NAMES_VERSION = 3
+
 
 @dataclass(init=True, repr=True, frozen=True)
 class AnnotatedName:
@@ -14,38 +23,121 @@ class AnnotatedName:
 
 
 class GlobalNameVisitor(NodeVisitor):
+    """ Collects the names bound at the top level of a module in a single pass.
+        Statements nested in top-level `if`/`for`/`while`/`with`/`try` blocks
+        are visited too, but function and class bodies are never entered.
+
+        By default only plain assignments and function definitions are named.
+        With `extended`, classes, unpacked and walrus targets, loop and `with`
+        targets, and imports are named too.
+    """
+
     @staticmethod
-    def get_names(code: str) -> list[AnnotatedName]:
+    def get_names(code: str, extended: bool = False) -> list[AnnotatedName]:
         if not code:
             return list()
 
-        visitor = GlobalNameVisitor()
+        visitor = GlobalNameVisitor(extended)
         visitor.visit(parse(code))
         return [AnnotatedName(n, *t) if t else AnnotatedName(n) for n, t in visitor.names.items()]
 
-    def __init__(self) -> None:
+    def __init__(self, extended: bool = False) -> None:
         super().__init__()
-        self.names: dict[str, str] = dict()
+        self.extended = extended
+        self.names: dict[str, Optional[tuple[str, str]]] = dict()
+
+    def bind(self, target: expr) -> None:
+        """Adds the plain names assigned by `target`, e.g. `a, (b, *c)`"""
+        targets = [target]
+        while targets:
+            t = targets.pop()
+            if isinstance(t, Name):
+                if t.id not in self.names:
+                    self.names[t.id] = None
+            elif not self.extended:
+                continue
+            elif isinstance(t, (Tuple, List)):
+                targets.extend(reversed(t.elts))
+            elif isinstance(t, Starred):
+                targets.append(t.value)
+
+    def visit_Module(self, node: Module) -> Any:
+        stmts = node.body[::-1]
+        while stmts:
+            stmt = stmts.pop()
+            self.visit(stmt)
+            if not isinstance(stmt, (FunctionDef, AsyncFunctionDef, ClassDef)):
+                stmts.extend(reversed(self.scan(stmt)))
+
+    def scan(self, node: stmt) -> list[stmt]:
+        """ Binds the walrus targets in `node`'s expressions (outside lambdas),
+            and returns the statements nested directly in it, in source order.
+        """
+        nested = []
+        todo = list(iter_child_nodes(node))[::-1]
+        while todo:
+            n = todo.pop()
+            if isinstance(n, stmt):
+                nested.append(n)
+            elif isinstance(n, NamedExpr) and self.extended:
+                self.bind(n.target)
+                todo.append(n.value)
+            elif not isinstance(n, Lambda):
+                todo.extend(reversed(list(iter_child_nodes(n))))
+        return nested
+
+    def generic_visit(self, node: AST) -> Any:
+        # nested statements are queued by visit_Module instead
+        pass
 
     def visit_Assign(self, node: Assign) -> Any:
         for t in node.targets:
-            if isinstance(t, Name) and t.id not in self.names:
-                self.names[t.id] = None
+            self.bind(t)
+
+    def visit_AugAssign(self, node: AugAssign) -> Any:
+        self.bind(node.target)
 
     def visit_AnnAssign(self, node: AnnAssign) -> Any:
-        key = node.target.id
+        if not isinstance(node.target, Name):
+            return
         if node.simple:
-            ann, desc = node.annotation, None
-            # if hasattr(ann, 'slice'):
-            #     if isinstance(ann.slice, Constant):
-            #         if isinstance(ann.slice.value, str):
-            #             desc = ann.slice.value
-            #             ann = ann.value
             # use unparse to stringify compound types like list[int]
             # and simple types like int
-            self.names[key] = (unparse(ann), desc)
-        elif key not in self.names:
-            self.names[key] = None
+            self.names[node.target.id] = (unparse(node.annotation), None)
+        else:
+            self.bind(node.target)
+
+    def visit_For(self, node: For) -> Any:
+        if self.extended:
+            self.bind(node.target)
+
+    def visit_AsyncFor(self, node: AsyncFor) -> Any:
+        self.visit_For(node)
+
+    def visit_With(self, node: With) -> Any:
+        if not self.extended:
+            return
+        for item in node.items:
+            if item.optional_vars:
+                self.bind(item.optional_vars)
+
+    def visit_AsyncWith(self, node: AsyncWith) -> Any:
+        self.visit_With(node)
+
+    def visit_Import(self, node: Import) -> Any:
+        if not self.extended:
+            return
+        for alias in node.names:
+            # `import a.b` binds `a`
+            self.names[alias.asname or alias.name.split('.')[0]] = (None, f'module {alias.name}')
+
+    def visit_ImportFrom(self, node: ImportFrom) -> Any:
+        if not self.extended:
+            return
+        source = '.' * node.level + (node.module or '')
+        for alias in node.names:
+            if alias.name != '*':
+                self.names[alias.asname or alias.name] = (None, f'imported from {source}')
 
     def visit_FunctionDef(self, node: FunctionDef) -> Any:
         self.names[node.name] = (
@@ -55,8 +147,68 @@ class GlobalNameVisitor(NodeVisitor):
         self.names[node.name] = (
             get_function_type(node), get_function_desc(node))
 
+    def visit_ClassDef(self, node: ClassDef) -> Any:
+        if self.extended:
+            self.names[node.name] = ('python class', get_function_desc(node))
+
+
+class NameCache:
+    """ Remembers the names `GlobalNameVisitor` extracts from each distinct code string,
+        in memory and as one JSON file per code hash in `root` (if set),
+        so setup code shared between questions is only parsed once.
+        SyntaxErrors are never cached.
+    """
+
+    def __init__(self, root: Optional[str] = NAME_CACHE_DIR, extended: bool = False):
+        self.root = root
+        # passed on to GlobalNameVisitor
+        self.extended = extended
+        self.memo: dict[str, list[AnnotatedName]] = {}
+
+    def key(self, code: str) -> str:
+        # ast output differs between python versions, so each gets its own entries
+        salt = f'{NAMES_VERSION}.{version_info.major}.{version_info.minor}.{int(self.extended)}\0'
+        return sha256((salt + code).encode()).hexdigest()[:24]
+
+    def get_names(self, code: str) -> list[AnnotatedName]:
+        if not code:
+            return list()
+
+        key = self.key(code)
+        if key not in self.memo:
+            names = self.load(key)
+            if names is None:
+                names = GlobalNameVisitor.get_names(code, self.extended)
+                self.save(key, names)
+            self.memo[key] = names
+        return list(self.memo[key])
+
+    def load(self, key: str) -> Optional[list[AnnotatedName]]:
+        if not self.root:
+            return None
+        try:
+            with open(path.join(self.root, key + '.json')) as f:
+                return [AnnotatedName(*n) for n in loads(f.read())]
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, key: str, names: list[AnnotatedName]) -> None:
+        if not self.root:
+            return
+        try:
+            makedirs(self.root, exist_ok=True)
+            with NamedTemporaryFile('w', dir=self.root, prefix='.' + key, delete=False) as f:
+                f.write(dumps([astuple(n) for n in names]))
+            # concurrent generators may race to save the same key; either result is fine
+            replace(f.name, path.join(self.root, key + '.json'))
+        except OSError as e:
+            Bcolors.warn('Could not cache extracted names:', e)
+
+
+name_cache = NameCache()
+
 
-def get_function_desc(node: Union[FunctionDef, AsyncFunctionDef]) -> str:
+def get_function_desc(node: Union[FunctionDef, AsyncFunctionDef, ClassDef]) -> str:
     doc = get_docstring(node, clean=True)
     if not doc:
         return doc
@@ -87,19 +239,23 @@ def get_function_type(node: Union[FunctionDef, AsyncFunctionDef]) -> str:
 
 
 def generate_server(setup_code: str, answer_code: str, *,
-                    no_ast: bool = False, tab: str = '    ') -> tuple[str, list[AnnotatedName], list[AnnotatedName]]:
-    """Generates a server file by performing analysis on provided code"""
+                    no_ast: bool = False, tab: str = '    ',
+                    names: Optional[NameCache] = None) -> tuple[str, list[AnnotatedName], list[AnnotatedName]]:
+    """ Generates a server file by performing analysis on provided code,
+        reusing cached analyses from `names` (default: `name_cache`)
+    """
     if no_ast:
         return (SERVER_DEFAULT, [], [])
 
+    names = names or name_cache
     try:
-        setup_names = GlobalNameVisitor.get_names(setup_code)
+        setup_names = names.get_names(setup_code)
     except SyntaxError:
         Bcolors.warn('SyntaxError: Could not extract exports from setup')
         setup_names = []
 
     try:
-        answer_names = GlobalNameVisitor.get_names(answer_code)
+        answer_names = names.get_names(answer_code)
     except SyntaxError:
         Bcolors.warn('SyntaxError: Could not extract exports from answer')
         answer_names = []
@@ -110,7 +266,8 @@ def generate_server(setup_code: str, answer_code: str, *,
     def format_annotated_name(name: AnnotatedName) -> str:
         type = name.annotation or 'python var'
         desc = name.description or ''
-        return '{"name": "' + name.id + '", "description": "' + desc + '", "type": "' + type + '"},'
+        # docstrings may hold quotes or backslashes, so let json escape every field
+        return dumps({"name": name.id, "description": desc, "type": type}) + ','
 
     lines = \
         [ (0, '# AUTO-GENERATED FILE')
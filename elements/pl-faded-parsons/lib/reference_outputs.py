@@ -0,0 +1,121 @@
+""" Precomputes the reference solution's output for every case of a json test
+    region, so the generated tests/test.py only has to call the student's code.
+
+    The fixture is built in a separate process (`python -m lib.reference_outputs
+    <tests dir>`, with the test json on stdin) that runs the tests dir's
+    setup_code.py and ans.py the way the grader does, writes the fixture,
+    and prints a json report of which tests were precomputed.
+"""
+from contextlib import redirect_stdout
+from hashlib import sha256
+from io import StringIO
+from json import dumps, load, loads
+from os import path, remove, replace
+from pickle import dumps as pickle
+from subprocess import run, TimeoutExpired
+from sys import argv, executable, stdin
+from typing import Optional
+
+from lib.generate_test import CASE_GENERATOR, clean_generator, clean_input_iter, expect_value
+
+FIXTURE_NAME = 'reference_outputs.pickle'
+# seconds allowed for computing every reference output of one question
+REFERENCE_TIMEOUT = 60
+# pickle protocol 4 loads on every python the graders use
+PICKLE_PROTOCOL = 4
+
+
+def source_digest(test_dir: str) -> str:
+    """Must match `load_reference_outputs` in the generated test.py"""
+    digest = sha256()
+    for file_name in ('setup_code.py', 'ans.py'):
+        with open(path.join(test_dir, file_name), 'rb') as f:
+            digest.update(f.read() + b'\0')
+    return digest.hexdigest()
+
+
+def reference_outputs(test_dir: str, json: dict) -> tuple[dict[int, list], list[str]]:
+    """ Runs the reference function on each test's cases, twice.
+        Returns the outputs of each test whose results were repeatable and picklable,
+        and why each other test was skipped (it will call the reference while grading).
+    """
+    namespace = { '__name__': 'ans' }
+    for file_name in ('setup_code.py', 'ans.py'):
+        with open(path.join(test_dir, file_name)) as f:
+            exec(compile(f.read(), file_name, 'exec'), namespace)
+
+    fn_name = expect_value(json, 'functionName', str, 'top-level object')
+    ref_fn = namespace[fn_name]
+
+    # the same generator the test file draws its cases from
+    generator = {}
+    exec('import copy, random, time\n' + CASE_GENERATOR, generator)
+
+    outputs, skipped = {}, []
+    for i, test in enumerate(json['tests']):
+        context = f'test {i}'
+        try:
+            cases = list(clean_input_iter(test.get('inputs', []), context))
+            generated = generator['GeneratedCases'](*clean_generator(test['generate'], context)) \
+                if 'generate' in test else ()
+            # cases are evaluated & generated afresh each run, so mutating one run cannot affect the other
+            runs = [[ref_fn(*case) for case in eval('[\n' + ',\n'.join(cases) + '\n]', {}) + list(generated)]
+                    for _ in range(2)]
+            if runs[0] != runs[1]:
+                skipped.append(f'{context}: reference outputs differ between runs')
+                continue
+            pickle(runs[0], protocol=PICKLE_PROTOCOL)
+        except Exception as e:
+            skipped.append(f'{context}: {e.__class__.__name__}: {e}')
+            continue
+        outputs[i] = runs[0]
+    return outputs, skipped
+
+
+def write_reference_outputs(test_dir: str, json: Optional[dict]) -> tuple[int, list[str]]:
+    """ Writes the reference outputs fixture for the setup_code.py and ans.py in `test_dir`,
+        replacing any old one (which is just removed if there is no test `json`).
+        Returns how many tests were precomputed, and why the rest (or all) could not be.
+    """
+    fixture = path.join(test_dir, FIXTURE_NAME)
+    if path.exists(fixture):
+        remove(fixture)
+    if not json or not json.get('precompute', True):
+        return 0, []
+
+    lib_parent = path.dirname(path.dirname(path.abspath(__file__)))
+    try:
+        result = run([executable, '-m', 'lib.reference_outputs', path.abspath(test_dir)],
+                     cwd=lib_parent, input=dumps(json), capture_output=True,
+                     text=True, timeout=REFERENCE_TIMEOUT)
+    except TimeoutExpired:
+        return 0, [f'reference outputs took over {REFERENCE_TIMEOUT}s']
+
+    try:
+        report = loads(result.stdout.splitlines()[-1])
+    except (IndexError, ValueError):
+        error = result.stderr.strip().splitlines()
+        return 0, error[-1:] or [f'exited with code {result.returncode}']
+    return report['precomputed'], report['skipped']
+
+
+def __main__():
+    test_dir = argv[1]
+    json = load(stdin)
+    # anything the reference prints must not get mixed into the report
+    with redirect_stdout(StringIO()):
+        try:
+            outputs, skipped = reference_outputs(test_dir, json)
+        except Exception as e:
+            outputs, skipped = {}, [f'could not run the reference: {e.__class__.__name__}: {e}']
+
+    if outputs:
+        fixture = path.join(test_dir, FIXTURE_NAME)
+        with open(fixture + '.tmp', 'wb') as f:
+            f.write(pickle({ 'digest': source_digest(test_dir), 'outputs': outputs }, protocol=PICKLE_PROTOCOL))
+        replace(fixture + '.tmp', fixture)
+    print(dumps({ 'precomputed': len(outputs), 'skipped': skipped }))
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,82 @@
+from io import StringIO
+from re import compile
+from typing import Iterator
+
+# the characters `str.splitlines` breaks lines on
+LINE_BREAK = compile('[\n\r\v\f\x1c-\x1e\x85\u2028\u2029]')
+
+
+class RegionWriter:
+    """ Assembles the text of one region in a `StringIO`, normalising lines
+        as they arrive instead of after the whole region is joined.
+
+        The result equals `'\\n'.join(map(str.rstrip, text.splitlines())).strip()`
+        of everything written (with blank lines dropped if `skip_blank_lines`),
+        but only the current partial line and the normalised text are held.
+    """
+
+    def __init__(self, skip_blank_lines: bool = False):
+        self.skip_blank_lines = skip_blank_lines
+        self.buffer = StringIO()
+        # pieces of text after the last complete line, kept until its line ends
+        self.partial: list[str] = []
+        # blank lines seen since the last written line, only kept if more text follows
+        self.blank_lines = 0
+        self.started = False
+        self.received = False
+
+    def __bool__(self) -> bool:
+        """True once anything has been written, even if it normalised away"""
+        return self.received
+
+    def write(self, text: str):
+        self.received = True
+        if not LINE_BREAK.search(text):
+            if text:
+                self.partial.append(text)
+            return
+        if self.partial:
+            self.partial.append(text)
+            text = ''.join(self.partial)
+        lines = text.splitlines()
+        if text[-1] == '\r':
+            # this may be the first half of a '\r\n' split across writes
+            self.partial = [lines.pop() + '\r']
+        elif LINE_BREAK.match(text[-1]):
+            self.partial = []
+        else:
+            self.partial = [lines.pop()]
+        self.write_lines(lines)
+
+    def write_lines(self, lines: list[str]):
+        """Writes complete lines, holding back blank lines until more text follows them"""
+        write = self.buffer.write
+        for line in lines:
+            line = line.rstrip()
+            if not line:
+                if self.started and not self.skip_blank_lines:
+                    self.blank_lines += 1
+            elif self.started:
+                write('\n' * (self.blank_lines + 1))
+                write(line)
+                self.blank_lines = 0
+            else:
+                write(line.lstrip())
+                self.started = True
+
+    def flush(self):
+        """Normalises any partial last line, as at the end of the region"""
+        self.write_lines(''.join(self.partial).splitlines())
+        self.partial = []
+
+    def getvalue(self) -> str:
+        self.flush()
+        return self.buffer.getvalue()
+
+    def __iter__(self) -> Iterator[str]:
+        """Yields the normalised lines of the region, without their newlines"""
+        self.flush()
+        self.buffer.seek(0)
+        for line in self.buffer:
+            yield line.rstrip('\n')
+        self.buffer.seek(0, 2)
@@ -0,0 +1,96 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from json import dumps
+from time import perf_counter
+from typing import Any, Iterator, NamedTuple, Optional
+
+
+class Span(NamedTuple):
+    """One timed stage of generating a question, in seconds since the batch started"""
+    stage: str
+    question: str
+    start: float
+    duration: float
+    depth: int
+
+
+class Timings:
+    """ Collects timing spans for each stage of each question in a batch,
+        e.g. `with timings.span('lex'): ...` inside `with timings.question(path):`.
+        Spans nest, so a question's span contains the spans of its stages.
+    """
+
+    def __init__(self):
+        self.origin = perf_counter()
+        self.spans: list[Span] = []
+        self.current_question = ''
+        self.depth = 0
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start = perf_counter()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self.spans.append(Span(stage, self.current_question,
+                                   start - self.origin, perf_counter() - start, self.depth))
+
+    @contextmanager
+    def question(self, source_path: str) -> Iterator[None]:
+        previous, self.current_question = self.current_question, str(source_path)
+        try:
+            with self.span('question'):
+                yield
+        finally:
+            self.current_question = previous
+
+    def summary(self) -> dict[str, Any]:
+        """ Returns total seconds per question and per stage of each question,
+            plus the count, total and max seconds of each stage over the batch.
+        """
+        questions: dict[str, dict[str, Any]] = defaultdict(lambda: {'total': 0.0, 'stages': defaultdict(float)})
+        stages: dict[str, dict[str, float]] = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+        for s in self.spans:
+            if s.stage == 'question':
+                questions[s.question]['total'] += s.duration
+                continue
+            questions[s.question]['stages'][s.stage] += s.duration
+            stage = stages[s.stage]
+            stage['count'] += 1
+            stage['total'] += s.duration
+            stage['max'] = max(stage['max'], s.duration)
+
+        return {
+            'total': perf_counter() - self.origin,
+            'questions': {q: {'total': v['total'], 'stages': dict(v['stages'])} for q, v in questions.items()},
+            'stages': dict(sorted(stages.items(), key=lambda kv: -kv[1]['total'])),
+        }
+
+    def to_json(self, indent: Optional[int] = 2) -> str:
+        return dumps(self.summary(), indent=indent)
+
+    def to_chrome_trace(self) -> str:
+        """ Returns the spans in the Chrome trace event format,
+            viewable in chrome://tracing or https://ui.perfetto.dev
+        """
+        events = [{
+            'name': s.stage,
+            'cat': 'fpp',
+            'ph': 'X',
+            'ts': round(s.start * 1e6, 3),
+            'dur': round(s.duration * 1e6, 3),
+            'pid': 0,
+            'tid': 0,
+            'args': { 'question': s.question },
+        } for s in sorted(self.spans, key=lambda s: (s.start, s.depth))]
+        return dumps({ 'traceEvents': events, 'displayTimeUnit': 'ms' })
+
+
+class NoTimings(Timings):
+    """Stands in for `Timings` when no timing output was requested"""
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        yield
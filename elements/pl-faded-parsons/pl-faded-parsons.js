@@ -41,6 +41,16 @@ class ParsonsCodeLine {
           blank_values   : blank_values
         }
     }
+    // `[id, indent, blank_values]`, the line's index in code_lines and its blanks' values,
+    // or the full segments for lines rendered without an id
+    asCompact () {
+        const id = parseInt(this.elem.dataset.lineId, 10);
+        if (isNaN(id)) {
+            return { content: this.asText(), indent: this.code_indent, segments: this.asSegments() };
+        }
+        const blank_values = $(this.elem).find("input").map((_, inp) => inp.value).get();
+        return [id, this.code_indent, blank_values];
+    }
     markCorrect() {}
     markIncorrectPosition() {}
     markIncorrectIndent() {}
@@ -313,26 +323,23 @@ const ParsonsGlobal = {
     widget: null,
     /*
      * When form is submitted, capture the state of the student's solution.
-     * For now we only submit the actual code, NOT the original metadata of where the blanks were etc.
+     * Each line is submitted as its id, indent and blank values; the server rebuilds the code from them.
      */
     submitHandler: function() {
       var starterCode = ParsonsGlobal.widget.getSourceLines();
       const starterElements = [];
 
-      starterCode.forEach(function(line, idx) {
-          starterElements.push({ content: line.asText(), indent: line.code_indent, index: idx, segments: line.asSegments() });
+      starterCode.forEach(function(line) {
+          starterElements.push(line.asCompact());
       });
       $('#starter-code-order').val(JSON.stringify(starterElements));
       
       var solutionCode = ParsonsGlobal.widget.getSolutionLines();
       const solutionElements = [];
-      solutionCode.forEach(function(line, idx) {
-          solutionElements.push({content: line.asText(), indent: line.code_indent, index: idx, segments: line.asSegments() });
+      solutionCode.forEach(function(line) {
+          solutionElements.push(line.asCompact());
       });
       $('#parsons-solution-order').val(JSON.stringify(solutionElements));
-      
-      let out = ParsonsGlobal.widget.solutionCode();
-      $('#student-parsons-solution').val(out[0]);
   
       ParsonsGlobal.logger && ParsonsGlobal.logger.onSubmit();
     },
@@ -6,6 +6,8 @@ import base64
 import json
 import re
 import random
+from functools import lru_cache
+from hashlib import sha256
 
 
 #
@@ -24,6 +26,7 @@ def read_file_lines(data, filename, error_if_not_found=True):
             return False
 
 
+@lru_cache(maxsize=None)
 def get_answers_name(element_html):
     # use answers-name to namespace multiple pl-faded-parsons elements on a page
     element = xml.fragment_fromstring(element_html)
@@ -58,41 +61,120 @@ class Parser:
         #     ]
         # }
 
+    def parse_line(self, line_id):
+        """ Returns the code segments between the blanks of line `line_id`,
+            the prefilled value of each blank, and how the line is placed:
+            ("given", indent), ("distractor", 0) or ("scrambled", 0)
+        """
+        segments = list(self.line_segments[line_id])
+
+        matches = re.findall(r'#blank [^#]*', segments[-1])
+        tail = re.sub(r'#blank [^#]*', '', segments[-1])
+        blank_count = len(segments) - 1
+        fills = list(map(lambda e: e.replace('#blank ', ""), matches)) + [""] * (blank_count-len(matches))
+        segments[-1] = tail
+
+        matches = re.search(r'#([0-9]+)given', tail)
+        if matches is not None:
+            segments[-1] = re.sub(r'#([0-9]+)given', '', tail).strip()
+            return segments, fills, ("given", int(matches.group(1)))
+
+        if re.match(r'#distractor', tail):
+            segments[-1] = re.sub(r'#distractor', '', tail).strip()
+            return segments, fills, ("distractor", 0)
+
+        return segments, fills, ("scrambled", 0)
+
+    def make_line(self, language, line_id, code_segments, fills):
+        parsed_segments = [{ "code" : { "content" : code_segments[0] } }]
+        for segment, fill in zip(code_segments[1:], fills):
+            width = str(len(fill)+1) if fill != "" else "4"
+            parsed_segments.append({ "blank" : { "default" : fill, "width" : width } })
+            parsed_segments.append({ "code"  : { "content" : segment } })
+
+        return { "language" : language, "id" : line_id, "segments" : parsed_segments }
+
+    def old_line(self, language, line):
+        """ Rebuilds a line as submitted, either compactly as `[id, indent, fills]`
+            (the line's index in code_lines and the values of its blanks),
+            or as the full dict of its segments that older submissions stored
+        """
+        if isinstance(line, list):
+            line_id, indent, fills = line
+            code_segments, _, _ = self.parse_line(line_id)
+            return self.make_line(language, line_id, code_segments, fills), indent
+
+        old_segments = line['segments']['given_segments']
+        segments = [{ "code" : { "content" : old_segments[0] }}]
+
+        for segment, fill in zip(old_segments[1:], line['segments']['blank_values']):
+            segments.append({ "blank" : { "default" : fill    }})
+            segments.append({ "code"  : { "content" : segment }})
+
+        return { "language" : language, "segments" : segments }, line['indent']
+
+    def line_code(self, line, indent_size=4):
+        """ Returns the code of a line submitted as for `old_line`,
+            indented and with its blanks filled
+        """
+        if isinstance(line, list):
+            line_id, indent, fills = line
+            code_segments, _, _ = self.parse_line(line_id)
+        elif isinstance(line.get('content'), str):
+            # older submissions stored each line's indented code
+            return line['content']
+        else:
+            indent = line['indent']
+            code_segments, fills = line['segments']['given_segments'], line['segments']['blank_values']
+
+        code = code_segments[0] + "".join(fill + segment for segment, fill in zip(code_segments[1:], fills))
+        return (" " * (indent * indent_size) + code).rstrip()
+
+    def check_lines(self, lines):
+        """ Returns why the submitted `lines` cannot be rebuilt by `old_line`,
+            e.g. an id from before code_lines changed, or None if they all can
+        """
+        seen = set()
+        for i, line in enumerate(lines):
+            if isinstance(line, dict):
+                segments = line.get('segments')
+                if not isinstance(segments, dict) or not isinstance(line.get('indent'), int) or \
+                        not isinstance(segments.get('given_segments'), list) or \
+                        not isinstance(segments.get('blank_values'), list) or \
+                        not all(isinstance(s, str) for s in segments['given_segments'] + segments['blank_values']):
+                    return f"line {i + 1} is missing its segments or indent"
+                continue
+
+            if not isinstance(line, list) or len(line) != 3 or \
+                    type(line[0]) is not int or type(line[1]) is not int or \
+                    not isinstance(line[2], list) or not all(isinstance(fill, str) for fill in line[2]):
+                return f"line {i + 1} is not an [id, indent, fills] list"
+
+            line_id, indent, fills = line
+            if not 0 <= line_id < len(self.line_segments) or line_id in seen:
+                return f"line {i + 1} has an unknown or repeated id {line_id}"
+            if indent < 0:
+                return f"line {i + 1} has a negative indent"
+            blanks = len(self.line_segments[line_id]) - 1
+            if len(fills) != blanks:
+                return f"line {i + 1} fills {len(fills)} blank(s), but its code line has {blanks}"
+            seen.add(line_id)
+
+        return None
+
     def old_state(self, language, old_starter, old_submission, indent_size=4):
         scrambled = []
         given = []
 
         for line in old_starter:
-            segments = []
-
-            old_segments = line['segments']['given_segments']
-            segments = [{ "code" : { "content" : old_segments[0] }}]
-
-            for segment, fill in zip(old_segments[1:], line['segments']['blank_values']):
-                segments.append({ "blank" : { "default" : fill    }})
-                segments.append({ "code"  : { "content" : segment }})
-
-            scrambled.append({
-                "language" : language,
-                "segments" : segments
-            })
+            new_line, _ = self.old_line(language, line)
+            scrambled.append(new_line)
 
         for line in old_submission:
-            segments = []
-
-            old_segments = line['segments']['given_segments']
-            segments = [{ "code" : { "content" : old_segments[0] }}]
-
-            for segment, fill in zip(old_segments[1:], line['segments']['blank_values']):
-                segments.append({ "blank" : { "default" : fill    }})
-                segments.append({ "code"  : { "content" : segment }})
+            new_line, indent = self.old_line(language, line)
+            new_line["indent"] = indent * indent_size
+            given.append(new_line)
 
-            given.append({
-                "language" : language,
-                "indent" : line['indent'] * indent_size,
-                "segments" : segments
-            })
-        
         return scrambled, given
 
     def get_scrambled_and_given(self, language, indent_size=4, max_distractors=10):
@@ -101,42 +183,17 @@ class Parser:
         given = []
         distractors = []
 
-        for segments in self.line_segments:
-            new_line = { "language": language }
-
-            matches = re.findall(r'#blank [^#]*', segments[-1])
-            tail = re.sub(r'#blank [^#]*', '', segments[-1])
-            blank_count = len(segments) - 1
-            fills = list(map(lambda e: e.replace('#blank ', ""), matches)) + [""] * (blank_count-len(matches))
-            segments[-1] = tail
-            
-            parsed_segments = [{ "code" : { "content" : segments[0] } }]
-            for segment, pre_fill in zip(segments[1:], fills):
-                width = str(len(pre_fill)+1) if pre_fill != "" else "4"
-                parsed_segments.append({ "blank" : { "default" : pre_fill, "width" : width } })
-                parsed_segments.append({ "code"  : { "content" : segment  } })
-
-            matches = re.search(r'#([0-9]+)given', tail)
-            if matches is not None:
-                indent = int(matches.group(1))
+        for line_id in range(len(self.line_segments)):
+            code_segments, fills, (placement, indent) = self.parse_line(line_id)
+            new_line = self.make_line(language, line_id, code_segments, fills)
+
+            if placement == "given":
                 new_line['indent'] = indent * indent_size
-                parsed_segments[-1] = {
-                    "code" : { "content" : re.sub(r'#([0-9]+)given', '', tail).strip() }
-                }
-                new_line['segments'] = parsed_segments
                 given.append(new_line)
-                continue
-
-            if re.match(r'#distractor', tail):
-                parsed_segments[-1] = {
-                    "code" : { "content" : re.sub(r'#distractor', '', tail).strip() }
-                }
-                new_line['segments'] = parsed_segments
+            elif placement == "distractor":
                 distractors.append(new_line)
-                continue
-
-            new_line['segments'] = parsed_segments
-            scrambled.append(new_line)
+            else:
+                scrambled.append(new_line)
         
         
         for _ in range(max_distractors):
@@ -152,6 +209,40 @@ def base64_encode(s):
     return base64.b64encode(s.encode("ascii")).decode("ascii")
 
 
+@lru_cache(maxsize=256)
+def code_artifacts(code):
+    """ The base64 file contents and sha256 of a submission's code, computed once
+        per distinct submission and stored with it, so identical ones share both
+    """
+    return base64_encode(code), sha256(code.encode()).hexdigest()
+
+
+def get_child_text_by_tag(element, tag: str) -> str:
+    """get the innerHTML of the first child of `element` that has the tag `tag`
+    default value is empty string"""
+    return next((elem.text for elem in element if elem.tag == tag), "")
+
+
+def get_code_lines(element, data):
+    code_lines = get_child_text_by_tag(element, "code-lines") or \
+        read_file_lines(data, 'code_lines.txt', error_if_not_found=False)
+
+    if not code_lines:
+        raise Exception("A non-empty code_lines.txt or <code-lines> child must be provided in right (horizontal) placement.")
+    
+    return code_lines
+
+
+def get_parser(element, data):
+    """The `Parser` for the element's code lines, which submitted line ids index into"""
+    try:
+        raw_lines = get_code_lines(element, data)
+    except:
+        raw_lines = str(element.text)
+
+    return Parser(raw_lines.strip())
+
+
 def render_question_panel(element_html, data):
     """Render the panel that displays the question (from code_lines.txt) and interaction boxes"""
     element = xml.fragment_fromstring(element_html)
@@ -167,20 +258,6 @@ def render_question_panel(element_html, data):
         "code_lines": str(element.text),
     }
 
-    def get_child_text_by_tag(element, tag: str) -> str:
-        """get the innerHTML of the first child of `element` that has the tag `tag`
-        default value is empty string"""
-        return next((elem.text for elem in element if elem.tag == tag), "")
-
-    def get_code_lines():
-        code_lines = get_child_text_by_tag(element, "code-lines") or \
-            read_file_lines(data, 'code_lines.txt', error_if_not_found=False)
-
-        if not code_lines:
-            raise Exception("A non-empty code_lines.txt or <code-lines> child must be provided in right (horizontal) placement.")
-        
-        return code_lines
-
     # pre + post text
     pre_text = get_child_text_by_tag(element, "pre-text") \
         .rstrip("\n") # trim trailing newlines
@@ -203,22 +280,14 @@ def render_question_panel(element_html, data):
             "post_text" : post,
         })
 
-    try:
-        raw_lines = get_code_lines()
-    except:
-        raw_lines = str(element.text)
-    
-    parse = Parser(raw_lines.strip())
+    parse = get_parser(element, data)
 
-    starter_lines_data_available    = 'starter-lines' in data['submitted_answers'] and \
-        data['submitted_answers']['starter-lines'] != []
-    submission_lines_data_available = 'submission-lines' in data['submitted_answers'] and \
-        data['submitted_answers']['submission-lines'] != []
+    start_lines      = data['submitted_answers'].get('starter-lines', [])
+    submission_lines = data['submitted_answers'].get('submission-lines', [])
 
-    if starter_lines_data_available or submission_lines_data_available:
-        start_lines = data['submitted_answers']['starter-lines'] if starter_lines_data_available else []
-        scrambled_lines, given_lines = parse.old_state(
-            lang, start_lines, data['submitted_answers']['submission-lines'] )
+    # lines that no longer fit the code lines (e.g. code_lines.txt was edited) get a fresh layout
+    if (start_lines or submission_lines) and parse.check_lines(start_lines + submission_lines) is None:
+        scrambled_lines, given_lines = parse.old_state(lang, start_lines, submission_lines)
     else:
         scrambled_lines, given_lines = parse.get_scrambled_and_given(lang, indent_size=4)
         if format in ("right", "bottom", ):
@@ -300,14 +369,24 @@ def parse(element_html, data):
             return json.loads(data['raw_submitted_answers'][key])
         return default
     
-    if format != "no_code":
-        starter_lines = load_json_if_present('starter-code-order')
-    submission_lines = load_json_if_present('parsons-solution-order')
-
+    parser = get_parser(element, data)
+    try:
+        starter_lines = load_json_if_present('starter-code-order') if format != "no_code" else []
+        submission_lines = load_json_if_present('parsons-solution-order')
+        error = parser.check_lines(starter_lines + submission_lines)
+    except (ValueError, TypeError) as e:
+        starter_lines, submission_lines, error = [], [], f"the lines could not be read ({e})"
+    if error:
+        # such lines were not made by this question's page, so they are not kept for rendering
+        data['format_errors']['parsons-solution-order'] = f"Your submission does not match this question: {error}."
+        starter_lines, submission_lines = [], []
+
+    # lines are submitted as `[id, indent, fills]` (older forms submitted each line's
+    # full segments and content instead), and the graded code is rebuilt from them
     submission_code = "\n".join([
-        line.get("content", "")
+        parser.line_code(line)
         for line in submission_lines
-    ]) + "\n" 
+    ]) + "\n"
 
     data['submitted_answers']['student-parsons-solution'] = submission_code
     if format != "no_code":
@@ -321,10 +400,12 @@ def parse(element_html, data):
 
     file_name = pl.get_string_attrib(element, 'file-name', 'user_code.py')
 
+    contents, code_hash = code_artifacts(submission_code)
+    data['submitted_answers']['student-parsons-solution-hash'] = code_hash
     data['submitted_answers']['_files'] = [
         {
             "name": file_name,
-            "contents": base64_encode(get_student_code(element_html, data))
+            "contents": contents
         }
     ]
 
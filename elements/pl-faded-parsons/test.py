@@ -4,14 +4,26 @@ import requests
 
 from abc import ABC
 from collections import defaultdict
+from importlib.util import module_from_spec, spec_from_file_location
 from itertools import cycle
+from os import listdir, makedirs, path, stat
+from sys import executable
+from tempfile import TemporaryDirectory
+from time import monotonic, sleep
 from json import JSONDecoder, dumps
 from unittest import TestCase, main
-from unittest.mock import patch, mock_open
+from unittest.mock import MagicMock, patch, mock_open
 
 from lib.consts import DEFAULT_BLANK_PATTERN, BLANK_SUBSTITUTE
 from lib.tokens import Lexer, lex
-from generate_fpp import parse_fpp_regions
+from lib.timing import Timings, NoTimings
+from lib.autograde import GemCache, PythonAutograder, RubyAutograder, DEFAULT_GEMFILE
+from lib.io_helpers import write_to
+from lib.regions import RegionWriter
+from lib.name_visitor import AnnotatedName, GlobalNameVisitor, NameCache, generate_server
+from lib.generate_test import TestFileCache, clean_spec, make_stub, make_test_file
+from lib.reference_outputs import FIXTURE_NAME, write_reference_outputs
+from generate_fpp import parse_fpp_regions, stream_fpp_regions
 
 def flatten_into_region_map(tokens: Lexer) -> dict[str, list[str]]:
     col = defaultdict(list)
@@ -31,6 +43,16 @@ def make_metadata_region(**metadata):
 def lines(*lines): return '\n'.join(lines)
 def n_lines(n: int, body: str): return '\n'.join(n * [body])
 
+def exec_stub(test_dir: str, feedback: object = None, **stub_args) -> dict:
+    """ Runs the top of a generated test.py, as if from `test_dir`, with stand-ins for the grader's modules """
+    graders = { m: MagicMock() for m in ('pl_helpers', 'pl_unit_test', 'code_feedback') }
+    if feedback:
+        graders['code_feedback'].Feedback = feedback
+    namespace = { '__file__': path.join(test_dir, 'test.py') }
+    with patch.dict('sys.modules', graders):
+        exec(make_stub(**stub_args) + '\n    pass\n', namespace)
+    return namespace
+
 class TestLexABC(TestCase, ABC):
     def assertLexesTo(self, src: str, *, no_region='', **output):
         lexed = lex(src)
@@ -678,4 +700,643 @@ class TestParseFPP(TestCase):
         )
 
 
+class TestRegionWriter(TestCase):
+    def assertWritesTo(self, pieces: list[str], skip_blank_lines=False):
+        writer = RegionWriter(skip_blank_lines)
+        for piece in pieces:
+            writer.write(piece)
+        lines = map(str.rstrip, ''.join(pieces).splitlines())
+        if skip_blank_lines:
+            lines = filter(bool, lines)
+        expected = '\n'.join(lines).strip()
+        self.assertEqual(expected, writer.getvalue(), msg=f'\n\nPieces: {pieces!r}')
+        self.assertListEqual(expected.split('\n') if expected else [], list(writer))
+
+    def test_normalises_like_joined_text(self):
+        """ Lines are normalised as they arrive, matching normalisation of the joined text """
+        self.assertWritesTo([])
+        self.assertWritesTo(['', '  \n', '\t'])
+        self.assertWritesTo(['\n\n  def f():  ', '\n', '\n    return 1 \n\n'])
+        self.assertWritesTo(['\n\n  def f():  ', '\n', '\n    return 1 \n\n'], skip_blank_lines=True)
+        self.assertWritesTo(['x = (', '1,', ' 2)  # comment', '\n'])
+
+    def test_line_breaks_split_across_writes(self):
+        """ A '\\r\\n' split over two writes is still one line break """
+        self.assertWritesTo(['a\r', '\nb'])
+        self.assertWritesTo(['a\r', '\r\n', 'b'])
+        self.assertWritesTo(['a\r', 'b\x0cc\u2028'])
+
+    def test_stream_regions(self):
+        """ Streamed regions iterate over the same lines parse_fpp_regions returns """
+        src = lines(
+            '"""question"""',
+            make_region('test', lines('', 'x = 1  ', '', '', 'y = 2', '')),
+            'def f():',
+            '',
+            '    return ?1?',
+        )
+        regions = stream_fpp_regions(lex(src))
+        self.assertListEqual(['def f():', '    return !BLANK'], list(regions['prompt_code']))
+        self.assertListEqual(['def f():', '', '    return 1'], list(regions['answer_code']))
+        self.assertListEqual(['x = 1', '', '', 'y = 2'], list(regions['test']))
+        parsed = parse_fpp_regions(lex(src))
+        for name, writer in regions.items():
+            self.assertEqual(parsed[name], writer.getvalue())
+
+
+class TestGlobalNameVisitor(TestCase):
+    def assertNames(self, src: str, *names: AnnotatedName, extended: bool = True):
+        self.assertListEqual(list(names), GlobalNameVisitor.get_names(src, extended), msg=f'\n\nSource:\n{src}')
+
+    def test_default_names(self):
+        """ Without `extended`, only plain assignments and functions are named """
+        self.assertNames(
+            lines(
+                'import os',
+                'from math import pi',
+                'a, b = x = 1, 2',
+                'class C: pass',
+                'for i in []:',
+                '    y = i',
+                'with open(f) as g:',
+                '    if (n := 1): pass',
+                'def f(): pass',
+            ),
+            AnnotatedName('x'), AnnotatedName('y'), AnnotatedName('f', 'python function'),
+            extended=False,
+        )
+
+    def test_unpacking_and_walrus(self):
+        """ Tuple, starred and walrus targets bind top-level names """
+        self.assertNames(
+            lines('a, (b, *c) = 1, (2, 3, 4)', 'if (n := len(c)) > 1:', '    for i, j in []: pass', 'obj.attr = 1'),
+            AnnotatedName('a'), AnnotatedName('b'), AnnotatedName('c'), AnnotatedName('n'),
+            AnnotatedName('i'), AnnotatedName('j'),
+        )
+
+    def test_imports(self):
+        """ Imports bind their alias, or the first part of a dotted module """
+        self.assertNames(
+            lines('import os.path', 'import numpy as np', 'from math import sqrt, pi as PI', 'from . import *'),
+            AnnotatedName('os', None, 'module os.path'), AnnotatedName('np', None, 'module numpy'),
+            AnnotatedName('sqrt', None, 'imported from math'), AnnotatedName('PI', None, 'imported from math'),
+        )
+
+    def test_no_nested_scopes(self):
+        """ Classes are named, but nothing inside function or class bodies is """
+        self.assertNames(
+            lines(
+                'class Point:',
+                '    """a point"""',
+                '    x: int = 0',
+                '    def norm(self): return 0',
+                'def f():',
+                '    inner = 1',
+                '    return (y := inner)',
+                'g = lambda: (z := 1)',
+            ),
+            AnnotatedName('Point', 'python class', 'a point'), AnnotatedName('f', 'python function'),
+            AnnotatedName('g'),
+        )
+
+
+class TestGenerateServer(TestCase):
+    def test_quoted_docstring(self):
+        """ Quotes and backslashes in a class docstring survive into server.py """
+        doc = 'A "quoted" point.\n\nIt\'s at C:\\origin.'
+        setup = lines('class Point:', f'    {doc!r}', 'p: Point = Point()')
+        server, _, _ = generate_server(setup, '', names=NameCache(None, extended=True))
+        scope = {}
+        exec(compile(server, 'server.py', 'exec'), scope)
+        data = scope['generate']({'params': {}})
+        self.assertListEqual([
+            {'name': 'Point', 'description': 'A "quoted" point.<br><br>It\'s at C:\\origin.', 'type': 'python class'},
+            {'name': 'p', 'description': '', 'type': 'Point'},
+        ], data['params']['names_for_user'])
+
+
+class TestNameCache(TestCase):
+    code = lines(
+        'x: int = 3',
+        'def f(a: int) -> int:',
+        '    """adds x"""',
+        '    return a + x',
+    )
+    names = [AnnotatedName('x', 'int'), AnnotatedName('f', 'python fn(int) -> int', 'adds x')]
+
+    def test_persists_between_runs(self):
+        """ Names parsed in one run are read back in the next without parsing """
+        with TemporaryDirectory() as root:
+            self.assertListEqual(self.names, NameCache(root).get_names(self.code))
+            self.assertEqual(1, len(listdir(root)))
+            with patch.object(GlobalNameVisitor, 'get_names', side_effect=AssertionError('parsed again')):
+                self.assertListEqual(self.names, NameCache(root).get_names(self.code))
+
+    def test_unreadable_entries_are_rebuilt(self):
+        """ A corrupt cache file is replaced by a fresh analysis """
+        with TemporaryDirectory() as root:
+            cache = NameCache(root)
+            with open(path.join(root, cache.key(self.code) + '.json'), 'w') as f:
+                f.write('{ not json')
+            self.assertListEqual(self.names, cache.get_names(self.code))
+            self.assertListEqual(self.names, NameCache(root).get_names(self.code))
+
+    def test_syntax_errors_are_not_cached(self):
+        """ Code that fails to parse raises every time and leaves no entry """
+        with TemporaryDirectory() as root:
+            cache = NameCache(root)
+            for _ in range(2):
+                with self.assertRaises(SyntaxError):
+                    cache.get_names('def (:')
+            self.assertListEqual([], listdir(root))
+
+
+class TestMakeTestFile(TestCase):
+    def make(self, *inputs: str) -> str:
+        return make_test_file({
+            'functionName': 'f',
+            'tests': [{ 'name': 'cases', 'points': 2, 'inputs': list(inputs) }],
+        }, TestFileCache(None))
+
+    def test_cases(self):
+        """ Cases become tuples of arguments to score_cases, one per line """
+        out = self.make('1, 2', ' (3, 4) ', '[5]')
+        self.assertIn(lines(
+            '    @name(\'cases\')',
+            '    @points(2)',
+            '    def test_0(self):',
+            '        score_cases(self.st.f, self.ref.f,',
+            '            (1, 2,),',
+            '            (3, 4),',
+            '            ([5],),',
+            '            expected=REFERENCE_OUTPUTS.get(0)',
+            '        )',
+            '',
+        ), out)
+
+    def test_invalid_cases(self):
+        """ Every case that is not one argument to score_cases is reported at once """
+        with self.assertRaises(SyntaxError) as e:
+            self.make('*((i,) for i in range(3))', '(1, ', '3', '(1), (2)', '(*xs)')
+        errors = e.exception.msg.splitlines()
+        self.assertEqual(3, len(errors))
+        for n, error in zip([1, 3, 4], errors):
+            self.assertTrue(error.startswith(f'input {n} in test 0 "cases"'), error)
+
+    def test_unexpected_error(self):
+        """ Any other error generating one question's tests is reported, and no test.py is written """
+        json = dumps({ 'functionName': 'f', 'tests': [{ 'name': 'cases', 'points': 1, 'inputs': ['1'] }] })
+        with TemporaryDirectory() as test_dir, \
+                patch('lib.autograde.make_test_file', side_effect=KeyError('name')), \
+                patch('builtins.print') as printed:
+            write_to(test_dir, 'test.py', '# from an earlier run\n')
+            PythonAutograder().populate_tests_dir(test_dir, 'def f(x):\n    return x\n', '', json)
+            self.assertNotIn('test.py', listdir(test_dir))
+            self.assertIn('ans.py', listdir(test_dir))
+        self.assertTrue(any("KeyError: 'name'" in str(call) for call in printed.call_args_list))
+
+
+class TestCachedTestFiles(TestCase):
+    json = { 'functionName': 'f', 'tests': [{ 'name': 'cases', 'points': 1, 'inputs': ['1', '2'] }] }
+
+    def test_persists_between_runs(self):
+        """ A test file made in one run is read back in the next without rebuilding """
+        with TemporaryDirectory() as root:
+            out = make_test_file(self.json, TestFileCache(root))
+            self.assertEqual(1, len(listdir(root)))
+            with patch('lib.generate_test.build_test_file', side_effect=AssertionError('built again')):
+                # key order does not matter
+                self.assertEqual(out, make_test_file(dict(reversed(self.json.items())), TestFileCache(root)))
+
+    def test_stub_changes_make_new_entries(self):
+        """ Changing the stub invalidates every cached test file """
+        key = TestFileCache.key(self.json)
+        with patch('lib.generate_test.STUB', 'changed'):
+            self.assertNotEqual(key, TestFileCache.key(self.json))
+
+    def test_errors_are_not_cached(self):
+        """ Invalid tests raise every time and leave no entry """
+        with TemporaryDirectory() as root:
+            for _ in range(2):
+                with self.assertRaises(SyntaxError):
+                    make_test_file({ 'functionName': 'f', 'tests': [] }, TestFileCache(root))
+            self.assertListEqual([], listdir(root))
+
+
+class TestGeneratedCases(TestCase):
+    specs = [
+        { 'type': 'int', 'min': -3, 'max': 3 },
+        { 'type': 'list', 'of': { 'type': 'float', 'min': 0, 'max': 1 }, 'size': [0, 4] },
+        { 'type': 'tuple', 'of': [{ 'type': 'bool' }, { 'type': 'choice', 'values': [[1], None] }] },
+        { 'type': 'str', 'alphabet': 'ab', 'size': 2 },
+    ]
+
+    def make(self, **generate):
+        return make_test_file({ 'functionName': 'f', 'tests': [{ 'name': 'n', 'points': 1, 'generate': generate }] })
+
+    def test_seeded_cases(self):
+        """ Generated cases follow their specs and repeat for the same seed """
+        GeneratedCases = exec_stub('.')['GeneratedCases']
+        specs = [clean_spec(spec, 'arg') for spec in self.specs]
+        self.assertIn(f'generated=GeneratedCases(3, 50, {specs!r}, GRADING_BUDGET / 1),',
+                      self.make(seed=3, count=50, args=self.specs))
+        cases = list(GeneratedCases(3, 50, specs))
+        self.assertEqual(50, len(cases))
+        self.assertListEqual(cases, list(GeneratedCases(3, 50, specs)))
+        self.assertNotEqual(cases, list(GeneratedCases(4, 50, specs)))
+        for n, floats, (flag, choice), text in cases:
+            self.assertIn(n, range(-3, 4))
+            self.assertLessEqual(len(floats), 4)
+            self.assertTrue(all(0 <= x <= 1 for x in floats))
+            self.assertIsInstance(flag, bool)
+            self.assertIn(choice, [[1], None])
+            self.assertEqual(2, len(text))
+            self.assertLessEqual(set(text), {'a', 'b'})
+
+    def test_budget(self):
+        """ Generated cases stop once their time budget is spent, and only the ones run are scored """
+        feedback = TestScoreCases.Feedback()
+        stub = exec_stub('.', feedback)
+        generated = stub['GeneratedCases'](0, 100, [{ 'type': 'bool' }], -1)
+        stub['score_cases'](lambda x: x, lambda x: x, (True,), generated=generated)
+        self.assertEqual(0, generated.produced)
+        self.assertEqual(1.0, feedback.score)
+
+    def test_invalid_specs(self):
+        """ Bad generator specs are reported when the test file is made """
+        for generate in [
+            { 'args': [] },
+            { 'count': 0, 'args': [] },
+            { 'count': 1, 'args': [{ 'type': 'complex' }] },
+            { 'count': 1, 'args': [{ 'type': 'int', 'min': 2, 'max': 1 }] },
+            { 'count': 1, 'args': [{ 'type': 'list', 'of': { 'type': 'bool' }, 'size': [3, 1] }] },
+            { 'count': 1, 'args': [{ 'type': 'choice', 'values': [] }] },
+        ]:
+            with self.subTest(generate=generate), self.assertRaises(SyntaxError):
+                self.make(**generate)
+
+
+class TestReferenceOutputs(TestCase):
+    def write_question(self, test_dir: str, answer_code: str, setup_code: str = 'OFFSET = 1\n'):
+        write_to(test_dir, 'setup_code.py', setup_code)
+        write_to(test_dir, 'ans.py', answer_code)
+
+    def load_in_test_file(self, test_dir: str):
+        """ Runs the generated test.py's fixture loader as the grader would """
+        return exec_stub(test_dir)['REFERENCE_OUTPUTS']
+
+    def test_precomputes_each_test(self):
+        """ Repeatable, picklable outputs are precomputed per test; others are left to the grader """
+        json = { 'functionName': 'f', 'tests': [
+            { 'inputs': ['1', '*((i,) for i in range(3))'] },
+            { 'inputs': ['(object(),)'] },
+            { 'inputs': ['"x"'] },
+        ] }
+        with TemporaryDirectory() as test_dir:
+            self.write_question(test_dir, 'def f(x):\n    print(x)\n    return x + OFFSET if isinstance(x, str) else x\n')
+            precomputed, skipped = write_reference_outputs(test_dir, json)
+            self.assertEqual(1, precomputed)
+            self.assertEqual(2, len(skipped))
+            self.assertTrue(skipped[0].startswith('test 1: reference outputs differ'), skipped[0])
+            self.assertTrue(skipped[1].startswith('test 2: TypeError'), skipped[1])
+            self.assertDictEqual({ 0: [1, 0, 1, 2] }, self.load_in_test_file(test_dir))
+
+            # generated cases are precomputed too, in the order the test file draws them
+            generated = { 'count': 20, 'args': [{ 'type': 'int', 'min': 0, 'max': 9 }] }
+            json['tests'] = [{ 'inputs': ['-1'], 'generate': generated }]
+            self.assertEqual((1, []), write_reference_outputs(test_dir, json))
+            outputs = self.load_in_test_file(test_dir)[0]
+            self.assertEqual(21, len(outputs))
+            self.assertEqual(-1, outputs[0])
+            self.assertTrue(all(0 <= n <= 9 for n in outputs[1:]))
+
+            # the fixture no longer applies once the reference changes
+            self.write_question(test_dir, 'def f(x):\n    return -x\n')
+            self.assertDictEqual({}, self.load_in_test_file(test_dir))
+
+    def test_no_fixture(self):
+        """ Opting out, or a reference that cannot run, leaves no fixture behind """
+        json = { 'functionName': 'f', 'tests': [{ 'inputs': ['1'] }] }
+        with TemporaryDirectory() as test_dir:
+            self.write_question(test_dir, 'def f(x):\n    return x\n')
+            self.assertEqual((1, []), write_reference_outputs(test_dir, json))
+            self.assertEqual((0, []), write_reference_outputs(test_dir, { **json, 'precompute': False }))
+            self.assertNotIn(FIXTURE_NAME, listdir(test_dir))
+
+            self.write_question(test_dir, 'raise ValueError("no")\n')
+            precomputed, skipped = write_reference_outputs(test_dir, json)
+            self.assertEqual(0, precomputed)
+            self.assertIn('ValueError: no', skipped[0])
+            self.assertNotIn(FIXTURE_NAME, listdir(test_dir))
+
+
+class TestScoreCases(TestCase):
+    class Feedback:
+        def __init__(self):
+            self.score, self.feedback = None, []
+        def call_user(self, fn, *args): return fn(*args)
+        def add_feedback(self, text): self.feedback.append(text)
+        def set_score(self, score): self.score = score
+
+    def setUp(self):
+        self.feedback = self.Feedback()
+        self.stub = exec_stub('.', self.feedback, case_timeout=0.05)
+
+    def test_slow_cases_score_zero(self):
+        """ A case that runs past its budget is interrupted and scored as wrong """
+        def student(x):
+            if x == 2:
+                sleep(1)
+            return x
+        started = monotonic()
+        self.stub['score_cases'](student, lambda x: x, (1,), (2,), (3,), (4,))
+        self.assertLess(monotonic() - started, 0.5)
+        self.assertEqual(0.75, self.feedback.score)
+        self.assertListEqual(['Case 2 took longer than 0.05s.'], self.feedback.feedback)
+
+    def test_stops_at_deadline(self):
+        """ Once the grading deadline passes, the remaining cases score zero """
+        calls = []
+        def student(x):
+            calls.append(x)
+            if x == 2:
+                self.stub['GRADING_DEADLINE'] = monotonic()
+            return x
+        self.stub['score_cases'](student, None, (1,), (2,), (3,), (4,), expected=[1, 2, 3, 4])
+        self.assertListEqual([1, 2], calls)
+        self.assertEqual(0.5, self.feedback.score)
+        self.assertListEqual(['Stopped after 2 of 4 cases: out of time.'], self.feedback.feedback)
+
+    def test_deadline_counts_generated_cases(self):
+        """ Generated cases the deadline cut off score zero, whether or not any were drawn """
+        def stop_at(n):
+            def student(x):
+                if x == n:
+                    self.stub['GRADING_DEADLINE'] = monotonic()
+                return x
+            return student
+
+        generated = self.stub['GeneratedCases'](0, 4, [{ 'type': 'int', 'min': 10, 'max': 10 }])
+        self.stub['score_cases'](stop_at(1), lambda x: x, (1,), (2,), generated=generated)
+        self.assertEqual(1 / 6, self.feedback.score)
+
+        self.stub['GRADING_DEADLINE'] = monotonic() + 60
+        generated = self.stub['GeneratedCases'](0, 4, [{ 'type': 'int', 'min': 10, 'max': 10 }])
+        self.stub['score_cases'](stop_at(10), lambda x: x, (1,), generated=generated)
+        self.assertEqual(2 / 5, self.feedback.score)
+
+
+def load_element():
+    """ Imports pl-faded-parsons.py with stand-ins for PrairieLearn's modules """
+    modules = { m: MagicMock() for m in ('prairielearn', 'chevron', 'lxml', 'lxml.html') }
+    spec = spec_from_file_location('pl_faded_parsons', 'pl-faded-parsons.py')
+    element = module_from_spec(spec)
+    with patch.dict('sys.modules', modules):
+        spec.loader.exec_module(element)
+    element.pl.get_string_attrib = lambda _, name, default=None: default
+    return element
+
+
+class TestSubmissionLines(TestCase):
+    CODE_LINES = 'def f(x): #0given\nreturn !BLANK + !BLANK #blank x\nx = 1'
+
+    def setUp(self):
+        self.element = load_element()
+        self.element.xml.fragment_fromstring = lambda _: MagicMock(text=self.CODE_LINES)
+        self.parser = self.element.Parser(self.CODE_LINES)
+
+    def submit(self, starter: list, solution: list) -> dict:
+        data = { 'raw_submitted_answers': {
+            'starter-code-order': dumps(starter),
+            'parsons-solution-order': dumps(solution),
+        }, 'submitted_answers': {}, 'format_errors': {}, 'options': { 'question_path': '.' } }
+        self.element.parse('<pl-faded-parsons/>', data)
+        return data
+
+    def test_parse_line(self):
+        """ Each code line splits into the code around its blanks, their prefills, and its placement """
+        self.assertEqual((['def f(x):'], [], ('given', 0)), self.parser.parse_line(0))
+        self.assertEqual((['return ', ' + ', ' '], ['x', ''], ('scrambled', 0)), self.parser.parse_line(1))
+        # parsing does not change the lines it parses
+        self.assertEqual(self.parser.parse_line(1), self.parser.parse_line(1))
+
+    def test_round_trip(self):
+        """ Lines submitted as [id, indent, fills] rebuild the lines they were rendered from """
+        scrambled, given = self.parser.get_scrambled_and_given('py')
+        fills = lambda line: [s['blank']['default'] for s in line['segments'] if 'blank' in s]
+        starter = [[line['id'], 0, fills(line)] for line in scrambled]
+        solution = [[line['id'], line['indent'] // 4, fills(line)] for line in given]
+        self.assertIsNone(self.parser.check_lines(starter + solution))
+        self.assertEqual((scrambled, given), self.parser.old_state('py', starter, solution))
+
+        line = self.parser.old_line('py', [1, 2, ['a', 'b']])[0]
+        self.assertEqual(self.parser.make_line('py', 1, ['return ', ' + ', ' '], ['a', 'b']), line)
+
+    def test_bad_lines(self):
+        """ Ids out of range or repeated, wrong fill counts and malformed lines are all refused """
+        for lines in ([[3, 0, []]], [[-1, 0, []]], [[1, 0, ['a']]], [[2, 0, ['a']]],
+                      [[2, 0, []], [2, 1, []]], [[2, -1, []]], [[2, 0]], [['2', 0, []]], [[1, 0, [1, 2]]], [{}]):
+            self.assertIsNotNone(self.parser.check_lines(lines), lines)
+        legacy = { 'indent': 1, 'segments': { 'given_segments': ['x = 1'], 'blank_values': [] } }
+        self.assertIsNone(self.parser.check_lines([legacy, [1, 0, ['a', 'b']]]))
+
+    def test_parse(self):
+        """ Valid lines are stored compactly; others are reported and not stored """
+        data = self.submit([[2, 0, []]], [[0, 0, []], [1, 1, ['x', 'y']]])
+        self.assertDictEqual({}, data['format_errors'])
+        self.assertEqual([[2, 0, []]], data['submitted_answers']['starter-lines'])
+        self.assertEqual([[0, 0, []], [1, 1, ['x', 'y']]], data['submitted_answers']['submission-lines'])
+        self.assertEqual('def f(x):\n    return x + y\n', data['submitted_answers']['student-parsons-solution'])
+
+        for solution in ([[7, 0, []]], [[1, 0, ['x']]]):
+            data = self.submit([], solution)
+            self.assertIn('parsons-solution-order', data['format_errors'])
+            self.assertEqual([], data['submitted_answers']['submission-lines'])
+            self.assertEqual('\n', data['submitted_answers']['student-parsons-solution'])
+        data = self.submit([], [])
+        data['raw_submitted_answers']['parsons-solution-order'] = '{'
+        self.element.parse('<pl-faded-parsons/>', data)
+        self.assertIn('parsons-solution-order', data['format_errors'])
+
+    def test_submission_code(self):
+        """ The graded code is rebuilt from the lines, whatever code the page sends with them """
+        data = self.submit([], [[0, 0, []], [1, 1, ['x', 'import os']], [2, 1, []]])
+        data['raw_submitted_answers']['student-parsons-solution'] = 'import os\n'
+        self.element.parse('<pl-faded-parsons/>', data)
+        self.assertEqual('def f(x):\n    return x + import os\n    x = 1\n', data['submitted_answers']['student-parsons-solution'])
+
+        # older submissions sent each line's content, or only its segments
+        legacy = [
+            { 'content': 'def f(x):', 'indent': 0, 'segments': { 'given_segments': ['def f(x):'], 'blank_values': [] } },
+            { 'indent': 1, 'segments': { 'given_segments': ['return ', ' + ', ' '], 'blank_values': ['x', 'x'] } },
+        ]
+        data = self.submit([], legacy)
+        self.assertDictEqual({}, data['format_errors'])
+        self.assertEqual('def f(x):\n    return x + x\n', data['submitted_answers']['student-parsons-solution'])
+
+    def test_render_stale_lines(self):
+        """ Stored lines that no longer fit the code lines are rendered as a fresh layout """
+        def render(submitted: dict) -> dict:
+            data = { 'panel': 'question', 'submitted_answers': submitted, 'options': { 'question_path': '.' } }
+            self.element.render('<pl-faded-parsons/>', data)
+            return self.element.chevron.render.call_args[0][1]
+
+        params = render({ 'starter-lines': [[2, 0, []]], 'submission-lines': [[1, 1, ['x', 'y']]] })
+        self.assertEqual([2], [line['id'] for line in params['scrambled']['lines']])
+        self.assertEqual([1], [line['id'] for line in params['given']['lines']])
+
+        params = render({ 'starter-lines': [], 'submission-lines': [[9, 1, []]] })
+        self.assertEqual([1, 2], sorted(line['id'] for line in params['scrambled']['lines']))
+        self.assertEqual([0], [line['id'] for line in params['given']['lines']])
+
+
+class TestTimings(TestCase):
+    def test_nested_spans(self):
+        """ Stage spans are attributed to the question they run in """
+        timings = Timings()
+        timings.origin = 0.0
+        clock = iter([0.0, 1.0, 1.5, 2.5, 3.0, 4.0, 5.0, 7.0, 7.5, 9.0, 10.0])
+        with patch('lib.timing.perf_counter', side_effect=lambda: next(clock)):
+            with timings.question('a.py'):          # 0.0 - 4.0
+                with timings.span('lex'):           # 1.0 - 1.5
+                    pass
+                with timings.span('lex'):           # 2.5 - 3.0
+                    pass
+            with timings.question('b.py'):          # 5.0 - 9.0
+                with timings.span('write_files'):   # 7.0 - 7.5
+                    pass
+            summary = timings.summary()             # 10.0
+
+        self.assertEqual(summary['total'], 10.0)
+        self.assertEqual(summary['questions']['a.py'], { 'total': 4.0, 'stages': { 'lex': 1.0 } })
+        self.assertEqual(summary['questions']['b.py'], { 'total': 4.0, 'stages': { 'write_files': 0.5 } })
+        self.assertEqual(summary['stages']['lex'], { 'count': 2, 'total': 1.0, 'max': 0.5 })
+        self.assertEqual(list(summary['stages']), ['lex', 'write_files'])
+
+    def test_chrome_trace(self):
+        """ Spans become complete ("X") events in microseconds, parents first """
+        timings = Timings()
+        with timings.question('a.py'):
+            with timings.span('lex'):
+                pass
+        events = JSONDecoder().decode(timings.to_chrome_trace())['traceEvents']
+        self.assertEqual([e['name'] for e in events], ['question', 'lex'])
+        for e in events:
+            self.assertEqual(e['ph'], 'X')
+            self.assertEqual(e['args'], { 'question': 'a.py' })
+        self.assertLessEqual(events[0]['ts'], events[1]['ts'])
+        self.assertGreaterEqual(events[0]['dur'], events[1]['dur'])
+
+    def test_no_timings(self):
+        """ NoTimings records nothing """
+        timings = NoTimings()
+        with timings.question('a.py'):
+            with timings.span('lex'):
+                pass
+        self.assertEqual(timings.spans, [])
+
+
+class TestGemCache(TestCase):
+    # stands in for `bundle package`: vendors one gem & counts how often it runs
+    FAKE_SETUP = """
+import os
+os.makedirs(os.path.join('vendor', 'cache'))
+with open(os.path.join('vendor', 'cache', 'rspec.gem'), 'w') as f: f.write(open('Gemfile').read())
+with open('Gemfile.lock', 'w') as f: f.write('lock')
+with open({count!r}, 'a') as f: f.write('x')
+"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.count = path.join(self.tmp.name, 'count')
+        command = [executable, '-c', self.FAKE_SETUP.format(count=self.count)]
+        self.cache = GemCache(root=path.join(self.tmp.name, 'cache'), command=command)
+        self.cache.versions = 'ruby 3.2.0\0Bundler version 2.4.0'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_app(self, name: str, gemfile: str) -> str:
+        app_dir = path.join(self.tmp.name, name, 'app')
+        makedirs(app_dir)
+        with open(path.join(app_dir, 'Gemfile'), 'w') as f:
+            f.write(gemfile)
+        return app_dir
+
+    def runs(self) -> int:
+        return len(open(self.count).read()) if path.exists(self.count) else 0
+
+    def test_identical_gemfiles_install_once(self):
+        """ Apps with the same Gemfile share one install, linked into each """
+        apps = [self.make_app(f'q{i}', DEFAULT_GEMFILE) for i in range(3)]
+        for app_dir in apps:
+            self.cache.install(app_dir)
+        self.assertEqual(self.cache.wait(), [])
+        self.assertEqual(self.runs(), 1)
+        for app_dir in apps:
+            self.assertEqual(sorted(listdir(app_dir)), ['Gemfile', 'Gemfile.lock', 'vendor'])
+            gem = path.join(app_dir, 'vendor', 'cache', 'rspec.gem')
+            self.assertEqual(open(gem).read(), DEFAULT_GEMFILE)
+        self.assertEqual(stat(path.join(apps[0], 'Gemfile.lock')).st_ino,
+                         stat(path.join(apps[1], 'Gemfile.lock')).st_ino)
+
+    def test_distinct_gemfiles_and_later_runs(self):
+        """ Each distinct Gemfile installs once, and later batches reuse the cache """
+        self.cache.install(self.make_app('a', DEFAULT_GEMFILE))
+        self.cache.install(self.make_app('b', DEFAULT_GEMFILE + "gem 'rake'\n"))
+        self.assertEqual(self.cache.wait(), [])
+        self.assertEqual(self.runs(), 2)
+
+        later = GemCache(root=self.cache.root, command=self.cache.command)
+        later.versions = self.cache.versions
+        later.install(self.make_app('c', DEFAULT_GEMFILE))
+        self.assertEqual(later.wait(), [])
+        self.assertEqual(self.runs(), 2)
+
+    def test_changed_gemfile_replaces_old_install(self):
+        """ Regenerating after a Gemfile change links every file of the new install over the old """
+        app_dir = self.make_app('a', DEFAULT_GEMFILE)
+        self.cache.install(app_dir)
+        self.assertEqual(self.cache.wait(), [])
+
+        gemfile = DEFAULT_GEMFILE + "gem 'rake'\n"
+        with open(path.join(app_dir, 'Gemfile'), 'w') as f:
+            f.write(gemfile)
+        write_to(app_dir, path.join('vendor', 'cache', 'old.gem'), 'from an earlier install')
+        write_to(app_dir, 'script.rb', 'puts 1')
+        self.cache.install(app_dir)
+        self.assertEqual(self.cache.wait(), [])
+        self.assertEqual(self.runs(), 2)
+
+        entry = path.join(self.cache.root, self.cache.key(gemfile))
+        for name in ('Gemfile.lock', path.join('vendor', 'cache', 'rspec.gem')):
+            self.assertEqual(stat(path.join(app_dir, name)).st_ino, stat(path.join(entry, name)).st_ino)
+        self.assertEqual(open(path.join(app_dir, 'vendor', 'cache', 'rspec.gem')).read(), gemfile)
+        self.assertEqual(open(path.join(app_dir, 'Gemfile')).read(), gemfile)
+        # gems the new install does not have are gone, but the question's own files stay
+        self.assertEqual(['rspec.gem'], listdir(path.join(app_dir, 'vendor', 'cache')))
+        self.assertIn('script.rb', listdir(app_dir))
+
+    def test_key_includes_tool_versions(self):
+        """ A new ruby or bundler gets its own installs """
+        key = self.cache.key(DEFAULT_GEMFILE)
+        self.cache.versions = 'ruby 3.3.0\0Bundler version 2.4.0'
+        self.assertNotEqual(key, self.cache.key(DEFAULT_GEMFILE))
+
+    def test_no_ruby_questions(self):
+        """ Batches without ruby questions never make the gem cache """
+        with patch.object(RubyAutograder, 'gem_cache', None):
+            self.assertEqual([], RubyAutograder.finish())
+            self.assertIsNone(RubyAutograder.gem_cache)
+
+    def test_failed_install(self):
+        """ A failing setup command is reported for its app dir and not cached """
+        self.cache.command = [executable, '-c', 'import sys; sys.exit("no network")']
+        app_dir = self.make_app('a', DEFAULT_GEMFILE)
+        self.cache.install(app_dir)
+        with patch('builtins.print'):
+            self.assertEqual(self.cache.wait(), [app_dir])
+        self.assertEqual(listdir(self.cache.root), [])
+
+
 main()
\ No newline at end of file
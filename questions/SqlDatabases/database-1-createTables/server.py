@@ -1,21 +1,17 @@
-import sqlite3
 import random
 import string
-import pandas as pd
-import numpy as np
+from functools import lru_cache
+from SqlDatabases import datasets, sandbox
 
-fields = {str: "TEXT", int: "INTEGER",
-          np.int64: "INTEGER", np.float64: "REAL"}
+fields = {str: "TEXT", int: "INTEGER", float: "REAL"}
 
 
-def fill_db(conn, table_name):
-    conn.cursor().execute("DROP TABLE IF EXISTS {};"
-                          .format(table_name))
+def build_table(table_name):
     num_cols = random.randint(1, 4)
-    df = pd.read_csv('../../../clientFilesCourse/faker.csv')
-    cols = ['id'] + random.sample(set(df.keys()), num_cols)
+    faker = datasets.load_faker()
+    cols = ['id'] + random.sample(list(faker), num_cols)
     types = ['INTEGER PRIMARY KEY'] + \
-        [fields[type(df[col][0])] for col in cols[1:]]
+        [fields[type(faker[col][0])] for col in cols[1:]]
 
     col_string = []
     for col, col_type in zip(cols, types):
@@ -23,16 +19,14 @@ def fill_db(conn, table_name):
 
     create_table = 'CREATE TABLE {} ({})'.format(
         table_name, ', '.join(col_string))
-    conn.cursor().execute(create_table)
 
     return cols, types, create_table
 
 
 def generate(data):
-    conn_solution = sqlite3.connect("database.db")
     table_name = ''.join(random.choice(string.ascii_lowercase)
                          for i in range(5))
-    cols, types, sol = fill_db(conn_solution, table_name)
+    cols, types, sol = build_table(table_name)
 
     display_types = types.copy()
     for index in range(len(display_types)):
@@ -44,18 +38,15 @@ def generate(data):
     data['params']['columns'] = cols
     data['params']['types'] = types
     data['params']['solution'] = sol
-    conn_solution.close()
     return data
 
 
 def parse(data):
     try:
-        table_name = data['params']['table_name']
-        conn_student = sqlite3.connect("s_database.db")
-        conn_student.cursor().execute(
-            'DROP TABLE IF EXISTS {}'.format(table_name))
-        conn_student.cursor().execute(
-            data['submitted_answers']['student_query'])
+        with sandbox.scratch() as conn_student, sandbox.limits(conn_student):
+            conn_student.execute(data['submitted_answers']['student_query'])
+    except sandbox.QueryLimitError as e:
+        data['format_errors']['student_query'] = str(e)
     except Exception as e:
         data['format_errors']['student_query'] = 'Syntax Error: {}'.format(
             str(e))
@@ -63,22 +54,13 @@ def parse(data):
 
 def grade(data):
     table_name = data['params']['table_name']
-    conn_student = sqlite3.connect("s_database.db")
-    conn_student.cursor().execute(
-        'DROP TABLE IF EXISTS {}'.format(table_name))
-    conn_student.cursor().execute(
-        data['submitted_answers']['student_query'])
-
-    student_structure = conn_student.cursor().execute(
-        'PRAGMA TABLE_INFO({})'.format(table_name)).fetchall()
-
-    conn_solution = sqlite3.connect("database.db")
-
-    solution_structure = conn_solution.cursor().execute(
-        'PRAGMA TABLE_INFO({})'.format(table_name)).fetchall()
+    with sandbox.scratch() as conn_student, sandbox.limits(conn_student):
+        conn_student.execute(data['submitted_answers']['student_query'])
+        student_structure = conn_student.execute(
+            'PRAGMA TABLE_INFO({})'.format(table_name)).fetchall()
 
     student_simp = simplify(student_structure)
-    solution_simp = simplify(solution_structure)
+    solution_simp = solution_structure(table_name, data['params']['solution'])
 
     primary_key_flag = False
     if len(student_simp) == len(solution_simp):
@@ -103,11 +85,18 @@ def grade(data):
             data['feedback']['message'] = "The statement entered did not create \
             the expected table."
 
-    conn_solution.close()
-    conn_student.close()
     return data
 
 
+# function to read the solution table's structure, running its CREATE statement once per process
+@lru_cache(maxsize=1024)
+def solution_structure(table_name, solution):
+    with sandbox.scratch() as conn_solution:
+        conn_solution.execute(solution)
+        return simplify(conn_solution.execute(
+            'PRAGMA TABLE_INFO({})'.format(table_name)).fetchall())
+
+
 def simplify(structure):
     simplified = []
     for col in structure:
@@ -1,20 +1,15 @@
+import os
 import sqlite3
 import random as rand
-import json
-import pandas as pd
+from SqlDatabases import bank, compare, datasets, fixtures, sandbox, schema
 
-# load in file with table groups
-with open("../../../clientFilesCourse/table.json", "r") as read_file:
-    tables = json.load(read_file)
+# prebuilt variants for generate(), made with `python -m SqlDatabases.bank`
+BANK = os.path.join(os.path.dirname(os.path.abspath(__file__)), bank.BANK_NAME)
 
-# open database & choose table
-conn_solution = sqlite3.connect("database.db")
-group_number = rand.randint(0, len(tables) - 1)
-table_number = rand.randint(0, len(tables[group_number]) - 1)
-table_name = tables[group_number][table_number]["table_name"]
-faker = pd.read_csv('../../../clientFilesCourse/faker.csv')
-columns = tables[group_number][table_number]["columns"]
-faker_columns = list(faker.head(0))
+# variant state, chosen by setup_variant() so that importing this module does no work
+tables, faker, faker_columns, conn_solution = None, None, None, None
+group_number, table_number, table_name = None, None, None
+columns, rows, conditions, create = None, None, None, None
 
 
 # function to replace placeholders with faker data
@@ -24,7 +19,7 @@ def fill_with_faker(table_number, rows, conditions):
         c = tables[group_number][table_number]["columns"][index]
 
         if c in faker_columns:
-            values, used, cond_vals = rand.sample(list(faker[c]), 5), [], []
+            values, used, cond_vals = datasets.sample(faker, c, 5), [], []
             for row_number in range(len(rows)):
                 if isinstance(rows[row_number][index], str) and rows[row_number][index].find("Fake") > -1:
                     rows[row_number][index] = rand.choice(values)
@@ -41,7 +36,7 @@ def fill_with_faker(table_number, rows, conditions):
                             .replace("Fake <" + c + ">", str(rand.choice(used)))
 
         if "year" in c:
-            values, used, cond_vals = rand.sample(list(faker["year"]), 5), [], []
+            values, used, cond_vals = datasets.sample(faker, "year", 5), [], []
             for row_number in range(len(rows)):
                 if isinstance(rows[row_number][index], str) and rows[row_number][index].find("Fake") > -1:
                     rows[row_number][index] = rand.choice(values)
@@ -60,65 +55,12 @@ def fill_with_faker(table_number, rows, conditions):
     return rows, conditions
 
 
-rows, conditions = fill_with_faker(table_number, tables[group_number][table_number]["rows"],
-                                   tables[group_number][table_number]["conditions"])
-
-
-# function to get rid of foreign keys
+# function to get rid of foreign keys, using the schema index rather than the CREATE string
 def rid_fk():
-    rm = []
-    for index in range(len(columns)):
-        if columns[index].find("id") > -1 and columns[index] != "id":
-            rm.append(columns[index])
-            for row in rows:
-                row.remove(row[index])
-    create = tables[group_number][table_number]["create"]
-    for column in rm:
-        columns.remove(column)
-        start_index = int(create.find(column))
-        end_index = int(start_index + len(column) + len(" INTEGER, "))
-        substring = create[start_index:end_index]
-        create = create.replace(substring, '')
-
-    flag = create.find("FOREIGN")
-    if flag > -1:
-        flag -= 2
-        create = create[0:flag]
-        create = create + ")"
-
-    return columns, rows, create
-
-
-# function to insert rows into SQL table
-def fill_db_fk(conn, table_name, table_number, rows, create):
-    conn.cursor().execute("DROP TABLE IF EXISTS {};"
-                          .format(table_name))
-    conn.cursor().execute(create)
-    num_cols = len(rows[0])
-    for outer_index in range(len(rows)):
-        row = "("
-        for inner_index in range(num_cols):
-            col_val = rows[outer_index][inner_index]
-            if isinstance(col_val, str):
-                col_val = "\"" + col_val + "\""
-            else:
-                col_val = str(col_val)
-            if inner_index == num_cols - 1:
-                row += col_val + ")"
-            else:
-                row += col_val + ", "
-        insert = "INSERT INTO " + table_name + " VALUES " + row
-        conn.cursor().execute(insert)
-    conn.commit()
-
-
-# get rid of foreign keys from tables file
-columns, rows, create = rid_fk()
-
-
-# fill databse with chosen table
-fill_db_fk(conn_solution, table_name, table_number, rows, create)
-cursor = conn_solution.cursor()
+    table = schema.load_index()[group_number][table_name]
+    keep = [index for index in range(len(columns)) if columns[index] not in table["foreign_keys"]]
+    return [columns[index] for index in keep], [[row[index] for index in keep] for row in rows], \
+        table["standalone_create"]
 
 
 # function to build default query
@@ -169,9 +111,37 @@ def choose_columns(columns):
     return columns_str, columns_q
 
 
-def generate(data):
+# function to choose a table & fill a private database with it; only generate() pays for this
+def setup_variant():
+    global tables, faker, faker_columns, conn_solution, group_number, table_number, table_name
+    global columns, rows, conditions, create
+
+    # load in file with table groups & faker data (both cached per process)
+    tables = datasets.load_tables()
+    faker = datasets.load_faker()
+    faker_columns = list(faker)
+
+    # choose table
+    group_number = rand.randint(0, len(tables) - 1)
+    table_number = rand.randint(0, len(tables[group_number]) - 1)
+    table_name = tables[group_number][table_number]["table_name"]
+    columns = tables[group_number][table_number]["columns"]
+    rows, conditions = fill_with_faker(table_number, tables[group_number][table_number]["rows"],
+                                       tables[group_number][table_number]["conditions"])
+
+    # get rid of foreign keys from tables file
+    columns, rows, create = rid_fk()
+
+    # fill a private in-memory copy of the chosen table's schema
+    conn_solution = fixtures.connect([create])
+    fixtures.insert_rows(conn_solution, table_name, rows)
+
+
+# function to build a variant live; SqlDatabases/bank.py also uses it to fill the bank
+def build_variant(data):
 
     # build question variant
+    setup_variant()
     query = build_default_query()
     condition = rand.choice(conditions)
     columns_str, data["params"]["columns_q"] = choose_columns(columns)
@@ -186,56 +156,55 @@ def generate(data):
     data["params"]["table_name"] = table_name
     data["params"]["solution"] = solution_query
     data["params"]["columns"] = columns
+    data["params"]["fixture"] = fixtures.dump(conn_solution, [table_name])
+    data["params"]["solution_fingerprint"] = compare.query_fingerprint(conn_solution, solution_query)[1]
 
     conn_solution.close()
     return data
 
 
+def generate(data):
+    # take a prebuilt variant when the question has a bank, else build one live
+    params = bank.pick(BANK)
+    if params is None:
+        return build_variant(data)
+    data["params"].update(params)
+    return data
+
+
 # function to catch invalid & blank inputs
 def parse(data):
 
     student_columns = data["submitted_answers"]["columns"]
     student_condition = data["submitted_answers"]["condition"]
     table_name = data["params"]["table_name"]
+    conn = fixtures.load(data["params"]["fixture"])
 
     try:
         student_answer = "SELECT " + student_columns + " FROM {} WHERE ".format(table_name) \
                                                                                 + student_condition
-        cursor.execute(student_answer)
+        compare.check_query(conn, student_answer)
     except sqlite3.Error as e:
         data["format_errors"]["student_feedback"] = "The SQL query entered is invalid: \"" + e.args[0] + "\""
     except Exception as e:
         data["format_errors"]["regex"] = str(e)
         data["format_errors"]["student_feedback"] = "The SQL query entered is invalid."
 
+    conn.close()
     return data
 
 
-# function to change column data in a table to disregard order
-def column_order(data_list):
-    for element in data_list:
-        for index in range(len(element)):
-            if not isinstance(element[index], str):
-                element[index] = str(element[index])
-        element = element.sort()
-        element = str(element)
-    data_list.sort()
-    return data_list
-
-
-# function that readies table data for comparioson
-def grade_helper(query):
-    results = cursor.execute(query)
-    columns = [description[0] for description in results.description]
-    results = results.fetchall()
-    return columns, column_order([list(entry) for entry in results])
+# function that runs a query once into a temp table & fingerprints it, ignoring row & column order
+def grade_helper(cursor, table_name, query):
+    columns = sandbox.materialise(cursor, table_name, query)
+    return columns, compare.table_fingerprint(cursor, table_name)
 
 
 # function to determine partial credit for rows retrieved
-def partial_rows(pa, spa):
-    results = cursor.execute(pa).fetchall()
-    results2 = cursor.execute(spa).fetchall()
-    return ([list(r)[0] for r in results] == [list(r)[0] for r in results2])
+def partial_rows(cursor, pa, spa):
+    sandbox.materialise(cursor, "partial_solution", pa)
+    sandbox.materialise(cursor, "partial_student", spa)
+    return compare.same_rows(cursor, "partial_solution", "partial_student")
 
 
 # function to determine partial credit for columns selected
@@ -246,7 +215,7 @@ def partial_cols(sol_c, stu_c):
 
 
 # function to build queries needed to test row retrieved partial credit
-def build_partial_query(condition):
+def build_partial_query(table_name, condition):
     return "SELECT * FROM {} ".format(table_name) + condition
 
 
@@ -269,27 +238,46 @@ def grade(data):
     student_condition = data["submitted_answers"]["condition"]
     student_answer = "SELECT " + student_columns + \
         " FROM {} WHERE ".format(table_name) + student_condition
-    student_partial_answer = build_partial_query("WHERE " + student_condition)
-    partial_answer = build_partial_query(solution[solution.find("WHERE"):])
-
-    # grading of student answer
-    solution_columns, data1 = grade_helper(solution)
-    student_columns, data2 = grade_helper(student_answer)
-    student_columns_for_partial = student_columns.copy()
-    data["feedback"]["columns_s"] = student_columns
-    if(data1 == data2):
-        data["score"], data["feedback"]["message"] = 1, "Correct!"
-    else:
-        row_matching = partial_rows(partial_answer, student_partial_answer)
-        column_matching = partial_cols(solution_columns, student_columns_for_partial)
-        index = feedback_list_index(row_matching, column_matching)
-        data["score"], data["feedback"]["message"] = get_score(index), feedback_list[index]
-
-    # add necessary information to data dictionary
-    data["feedback"]["student_results"] = [
-        {"data": list(entry)} for entry in cursor.execute(student_answer)]
+    student_partial_answer = build_partial_query(table_name, "WHERE " + student_condition)
+    partial_answer = build_partial_query(table_name, solution[solution.find("WHERE"):])
+    conn = fixtures.load(data["params"]["fixture"])
+    cursor = conn.cursor()
+
+    # grading of student answer, which only runs once & within the sandbox limits
+    try:
+        with sandbox.limits(conn):
+            # variants carry their solution's fingerprint, so the solution only runs for partial credit
+            student_columns, data2 = grade_helper(cursor, "student_result", student_answer)
+            data1 = data["params"].get("solution_fingerprint")
+            if data1 != data2:
+                solution_columns, data1 = grade_helper(cursor, "solution_result", solution)
+            student_columns_for_partial = student_columns.copy()
+            data["feedback"]["columns_s"] = student_columns
+            if(data1 == data2):
+                data["score"], data["feedback"]["message"] = 1, "Correct!"
+            else:
+                row_matching = partial_rows(cursor, partial_answer, student_partial_answer)
+                column_matching = partial_cols(solution_columns, student_columns_for_partial)
+                index = feedback_list_index(row_matching, column_matching)
+                data["score"], data["feedback"]["message"] = get_score(index), feedback_list[index]
+                data["feedback"]["row_diff"] = compare.diff_feedback(cursor, "solution_result", "student_result")
+
+            # add necessary information to data dictionary
+            student_results, truncated = sandbox.feedback_rows(cursor, "student_result")
+    except sandbox.QueryLimitError as e:
+        data["format_errors"]["student_feedback"] = str(e)
+        conn.close()
+        return data
+    except sqlite3.Error as e:
+        data["format_errors"]["student_feedback"] = "The SQL query entered is invalid: \"" + e.args[0] + "\""
+        conn.close()
+        return data
+    data["feedback"]["student_results"] = [{"data": entry} for entry in student_results]
+    if truncated:
+        data["feedback"]["truncated"] = truncated
     data["feedback"]["results"] = "Your Results"
 
+    conn.close()
     return data
 
 
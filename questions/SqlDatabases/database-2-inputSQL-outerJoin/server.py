@@ -1,23 +1,15 @@
+import os
 import sqlite3
 import random as rand
-import json
-import pandas as pd
-import csv
-
-# load in file with table groups
-with open("../../../clientFilesCourse/table.json", "r") as read_file:
-    tables = json.load(read_file)
-
-# randomly choose table group from list of table groups
-group_number = rand.randint(0, 1)
-conn_solution = sqlite3.connect("database.db")
-cursor = conn_solution.cursor()
-table_1_number, table_2_number = 0, rand.randint(1, len(tables[group_number])-1)
-table_1_name = tables[group_number][table_1_number]["table_name"]
-table_2_name = tables[group_number][table_2_number]["table_name"]
-order = rand.choice([0, 1, 1, 1])
-faker = pd.read_csv('../../../clientFilesCourse/faker.csv')
-faker_columns = list(faker.head(0))
+from SqlDatabases import bank, compare, datasets, fixtures, sandbox, schema
+
+# prebuilt variants for generate(), made with `python -m SqlDatabases.bank`
+BANK = os.path.join(os.path.dirname(os.path.abspath(__file__)), bank.BANK_NAME)
+
+# variant state, chosen by setup_variant() so that importing this module does no work
+tables, faker, faker_columns, conn_solution = None, None, None, None
+group_number, table_1_number, table_2_number, table_1_name, table_2_name, order = None, None, None, None, None, None
+rows_1, conditions_1, rows_2, conditions_2 = None, None, None, None
 
 # function to replace placeholders with faker data
 def fill_with_faker(table_number, rows, conditions):
@@ -26,7 +18,7 @@ def fill_with_faker(table_number, rows, conditions):
         c = tables[group_number][table_number]["columns"][index]
 
         if c in faker_columns:
-            values, used, cond_vals = rand.sample(list(faker[c]), 5), [], []
+            values, used, cond_vals = datasets.sample(faker, c, 5), [], []
             for row_number in range(len(rows)):
                 if isinstance(rows[row_number][index], str) and rows[row_number][index].find("Fake") > -1:
                     rows[row_number][index] = rand.choice(values)
@@ -43,7 +35,7 @@ def fill_with_faker(table_number, rows, conditions):
                             .replace("Fake <" + c + ">", str(rand.choice(used)))
 
         if "year" in c:
-            values, used, cond_vals = rand.sample(list(faker["year"]), 5), [], []
+            values, used, cond_vals = datasets.sample(faker, "year", 5), [], []
             for row_number in range(len(rows)):
                 if isinstance(rows[row_number][index], str) and rows[row_number][index].find("Fake") > -1:
                     rows[row_number][index] = rand.choice(values)
@@ -62,48 +54,6 @@ def fill_with_faker(table_number, rows, conditions):
     return rows, conditions
 
 
-# retrieve rows and conditions with faker values
-rows_1, conditions_1 = fill_with_faker(0, tables[group_number][table_1_number]["rows"],
-                                       tables[group_number][table_1_number]["conditions"])
-rows_2, conditions_2 = fill_with_faker(table_2_number, tables[group_number][table_2_number]["rows"],
-                                       tables[group_number][table_2_number]["conditions"])
-
-
-# function to insert rows into SQL table
-def fill_db_fk(conn, table_name, table_number, rows):
-    conn.cursor().execute("DROP TABLE IF EXISTS {};"
-                          .format(table_name))
-    conn.cursor().execute(tables[group_number][table_number]["create"])
-    num_cols = len(rows[0])
-    for outer_index in range(len(rows)):
-        row = "("
-        for inner_index in range(num_cols):
-            col_val = rows[outer_index][inner_index]
-            if isinstance(col_val, str):
-                col_val = "\"" + col_val + "\""
-            else:
-                col_val = str(col_val)
-            if inner_index == num_cols - 1:
-                row += col_val + ")"
-            else:
-                row += col_val + ", "
-        insert = "INSERT INTO " + table_name + " VALUES " + row
-        conn.cursor().execute(insert)
-    conn.commit()
-
-
-# function to change column data in a table to disregard order
-def column_order(data_list):
-    for element in data_list:
-        for index in range(len(element)):
-            if not isinstance(element[index], str):
-                element[index] = str(element[index])
-        element = element.sort()
-        element = str(element)
-    data_list.sort()
-    return data_list
-
-
 # function to get table data in a dictionary
 def get_table_data(query):
     entries = []
@@ -121,28 +71,9 @@ def default_query(table_name):
     return "select * FROM {}".format(table_name)
 
 
-# function to find primary key of parent table
+# function to find primary key of a table in the chosen group
 def find_primary_key(table_number):
-    create_string = tables[group_number][table_number]["create"]
-    create_string = create_string.replace("(", " ")
-    create_string = create_string.replace(")", " ")
-    create_string = create_string.replace(",", "")
-    create_string = create_string.split()
-    for index in range(len(create_string)):
-        if (create_string[index] == 'PRIMARY') and (create_string[index + 1] == 'KEY'):
-            return create_string[index - 2]
-
-
-# function find key to compare tables on
-def find_key(table_number):
-    create_string = tables[group_number][table_2_number]["create"]
-    create_string = create_string.replace("(", " ")
-    create_string = create_string.replace(")", " ")
-    create_string = create_string.replace(",", "")
-    create_string = create_string.split()
-    for index in range(len(create_string)):
-        if (create_string[index] == 'PRIMARY') and (create_string[index + 1] == 'KEY'):
-            return create_string[index + 2]
+    return schema.load_index()[group_number][tables[group_number][table_number]["table_name"]]["primary_key"]
 
 
 # function to randomly choose columns to select
@@ -165,16 +96,9 @@ def choose_columns(columns, fk, pk1, pk2, num_cols):
     return columns_str, columns_q
 
 
-# function to find foreign key of child table
+# function to find the foreign key in the child table that refers to the parent table
 def find_foreign_key():
-    create_string = tables[group_number][table_2_number]["create"]
-    create_string = create_string.replace("(", " ")
-    create_string = create_string.replace(")", " ")
-    create_string = create_string.replace(",", "")
-    create_string = create_string.split()
-    for index in range(len(create_string)):
-        if (create_string[index] == 'FOREIGN') and (create_string[index + 1] == 'KEY'):
-            return create_string[index + 2]
+    return schema.load_index()[group_number][table_2_name]["references"][table_1_name]
 
 
 # function to randomly choose a condition
@@ -196,11 +120,39 @@ def build_query(columns, key1, key2, condition):
                                                     t2=table_2_name, k1=key1, k2=key2, c=condition)
 
 
-def generate(data):
+# function to choose two tables & fill a private database with them; only generate() pays for this
+def setup_variant():
+    global tables, faker, faker_columns, conn_solution, group_number, table_1_number, table_2_number
+    global table_1_name, table_2_name, order, rows_1, conditions_1, rows_2, conditions_2
+
+    # load in file with table groups & faker data (both cached per process)
+    tables = datasets.load_tables()
+    faker = datasets.load_faker()
+    faker_columns = list(faker)
+
+    # randomly choose table group from list of table groups
+    group_number = rand.randint(0, 1)
+    table_1_number, table_2_number = 0, rand.randint(1, len(tables[group_number])-1)
+    table_1_name = tables[group_number][table_1_number]["table_name"]
+    table_2_name = tables[group_number][table_2_number]["table_name"]
+    conn_solution = fixtures.connect([tables[group_number][table_1_number]["create"],
+                                      tables[group_number][table_2_number]["create"]])
+    order = rand.choice([0, 1, 1, 1])
+
+    # retrieve rows and conditions with faker values
+    rows_1, conditions_1 = fill_with_faker(0, tables[group_number][table_1_number]["rows"],
+                                           tables[group_number][table_1_number]["conditions"])
+    rows_2, conditions_2 = fill_with_faker(table_2_number, tables[group_number][table_2_number]["rows"],
+                                           tables[group_number][table_2_number]["conditions"])
+
 
-    # fill databses with the two chosen table
-    fill_db_fk(conn_solution, table_1_name, table_1_number, rows_1)
-    fill_db_fk(conn_solution, table_2_name, table_2_number, rows_2)
+# function to build a variant live; SqlDatabases/bank.py also uses it to fill the bank
+def build_variant(data):
+
+    # choose the variant & fill databses with the two chosen table
+    setup_variant()
+    fixtures.insert_rows(conn_solution, table_1_name, rows_1)
+    fixtures.insert_rows(conn_solution, table_2_name, rows_2)
 
     # build a solution query & default queries
     query1 = default_query(table_1_name)
@@ -226,43 +178,53 @@ def generate(data):
     data["params"]["solution"] = solution_query
     data["params"]["foreign_key"] = fk
     data["params"]["primary_key"] = pk_1
+    data["params"]["order"] = order
+    data["params"]["fixture"] = fixtures.dump(conn_solution, [table_1_name, table_2_name])
+    data["params"]["solution_fingerprint"] = compare.query_fingerprint(conn_solution, solution_query)[1]
 
     conn_solution.close()
     return data
 
 
+def generate(data):
+    # take a prebuilt variant when the question has a bank, else build one live
+    params = bank.pick(BANK)
+    if params is None:
+        return build_variant(data)
+    data["params"].update(params)
+    return data
+
+
 # function to catch invalid & blank inputs
 def parse(data):
 
+    conn = fixtures.load(data["params"]["fixture"])
     try:
         student_answer = "SELECT " + data["submitted_answers"]["columns"] + " FROM " + \
                 data["submitted_answers"]["table_1"] + " LEFT JOIN " + data["submitted_answers"]["table_2"] \
                 + " ON " + data["submitted_answers"]["on"] + " WHERE " + data["submitted_answers"]["condition"]
-        cursor.execute(student_answer)
+        compare.check_query(conn, student_answer)
     except sqlite3.Error as e:
         data["format_errors"]["student_feedback"] = "The SQL query entered is invalid: \"" + e.args[0] + "\""
     except Exception as e:
         data["format_errors"]["query"] = str(e)
         data["format_errors"]["student_feedback"] = "The SQL query entered is invalid."
 
+    conn.close()
     return data
 
 
-# function that readies table data for comparioson
-def grade_helper(query, flag):
-    results = cursor.execute(query)
-    columns = [description[0] for description in results.description]
-    results = results.fetchall()
-    if flag == 1:
-        return column_order([list(entry) for entry in results])
-    return columns, column_order([list(entry) for entry in results])
+# function that runs a query once into a temp table & fingerprints it, ignoring row & column order
+def grade_helper(cursor, table_name, query):
+    columns = sandbox.materialise(cursor, table_name, query)
+    return columns, compare.table_fingerprint(cursor, table_name)
 
 
-# function to determine partial credit for rows retrieved
-def partial_rows(pa, spa):
-    results = cursor.execute(pa).fetchall()
-    results2 = cursor.execute(spa).fetchall()
-    return ([list(r)[0] for r in results] == [list(r)[0] for r in results2])
+# function to determine whether a partial-credit query & its student version retrieve the same rows
+def partial_rows(cursor, pa, spa):
+    sandbox.materialise(cursor, "partial_solution", pa)
+    sandbox.materialise(cursor, "partial_student", spa)
+    return compare.same_rows(cursor, "partial_solution", "partial_student")
 
 
 # function to determine partial credit for columns selected
@@ -273,7 +235,7 @@ def partial_cols(sol_c, stu_c):
 
 
 # function to determine partial credit for join statement
-def partial_join(p_k, f_k, statement):
+def partial_join(p_k, f_k, statement, table_1_name, table_2_name):
     statement = statement.replace(" ", "")
     return ((statement == "{t1}.{pk}={t2}.{fk}".format(t1=table_1_name,
                                                        t2=table_2_name,
@@ -286,7 +248,7 @@ def partial_join(p_k, f_k, statement):
 
 
 # function to determine if the table name is correct
-def partial_order(input_, number):
+def partial_order(input_, number, order, table_1_name, table_2_name):
     if number == 0:
         if order == 0:
             return(input_ == table_2_name)
@@ -309,7 +271,7 @@ def feedback_list_index(rows, cols, join, name, name_):
 
 
 # function to verify that the table names are names
-def verify_name(input_):
+def verify_name(input_, table_1_name, table_2_name):
     if input_.split(" ", 2)[0] == table_1_name or input_.split(" ", 2)[0] == table_2_name:
         return True
     return False
@@ -321,7 +283,7 @@ def get_score(index):
 
 
 # function to build queries used for partial credit grading for rows
-def build_partial_query(pk, fk, condition):
+def build_partial_query(pk, fk, condition, order, table_1_name, table_2_name):
     if order == 0:
         return "SELECT * FROM {t2} LEFT JOIN {t1} ON {t1}.{f_k} = {t2}.{p_k}"\
             .format(t1=table_2_name, t2=table_1_name, p_k=pk, f_k=fk) + condition
@@ -331,7 +293,7 @@ def build_partial_query(pk, fk, condition):
 
 
 # function to build queries used for partial credit grading for order of table names
-def build_partial_order_query(input_, input__, condition, pk, fk):
+def build_partial_order_query(input_, input__, condition, pk, fk, table_1_name, table_2_name):
     return "SELECT * FROM {t1} LEFT JOIN {t2} ON {t1_}.{p_k} = {t2_}.{f_k}"\
         .format(t1=input_, t2=input__, t1_=table_1_name, t2_=table_2_name,
                 f_k=fk, p_k=pk) + condition
@@ -401,16 +363,22 @@ def build_partial_join_query(t1_, t2_, join, condition):
 
 
 # function that builds partial queries & calls partial helper grading function
-def partial_grader(pk, fk, solution, data, solution_columns, student_columns):
-    partial_answer = build_partial_query(pk, fk, " " + solution[solution.find("WHERE"):])
+def partial_grader(cursor, pk, fk, solution, data, solution_columns, student_columns):
+    table_1_name, table_2_name = data["params"]["table_1_name"], data["params"]["table_2_name"]
+    order = data["params"]["order"]
+    partial_answer = build_partial_query(pk, fk, " " + solution[solution.find("WHERE"):],
+                                         order, table_1_name, table_2_name)
     student_partial_answer = build_partial_query(pk, fk, " WHERE " +
-                                                 data["submitted_answers"]["condition"])
+                                                 data["submitted_answers"]["condition"],
+                                                 order, table_1_name, table_2_name)
     if order == 0:
         partial_order_ = build_partial_order_query(table_2_name,
                                                    table_1_name,
                                                    " " + solution[solution.find("WHERE"):],
                                                    pk,
-                                                   fk)
+                                                   fk,
+                                                   table_1_name,
+                                                   table_2_name)
         partial_join_ = build_partial_join_query(table_2_name, table_1_name, "{t1}.{p_k}\
                 ={t2}.{f_k}".format(t1=table_1_name,
                                     t2=table_2_name,
@@ -421,7 +389,9 @@ def partial_grader(pk, fk, solution, data, solution_columns, student_columns):
                                                    table_2_name,
                                                    " " + solution[solution.find("WHERE"):],
                                                    pk,
-                                                   fk)
+                                                   fk,
+                                                   table_1_name,
+                                                   table_2_name)
         partial_join_ = build_partial_join_query(table_1_name,
                                                  table_2_name,
                                                  "{t1}.{p_k}={t2}.{f_k}".format(t1=table_1_name,
@@ -437,8 +407,11 @@ def partial_grader(pk, fk, solution, data, solution_columns, student_columns):
                                                        data["submitted_answers"]["table_2"].split(" ", 2)[0],
                                                        " " + solution[solution.find("WHERE"):],
                                                        pk,
-                                                       fk)
-    return partial_helper(partial_answer,
+                                                       fk,
+                                                       table_1_name,
+                                                       table_2_name)
+    return partial_helper(cursor,
+                          partial_answer,
                           student_partial_answer,
                           partial_order_,
                           partial_join_,
@@ -453,6 +426,7 @@ def partial_grader(pk, fk, solution, data, solution_columns, student_columns):
 
 # function to determine partial credit for join statement if aliases are used
 def partial_join_alias(pk, fk, statement, data, one, two):
+    table_1_name = data["params"]["table_1_name"]
     statement = statement.replace(" ", "")
     if one != -1:
         input_1_table_name = data["submitted_answers"]["table_1"].split(" ")[0]
@@ -533,7 +507,8 @@ def partial_join_alias(pk, fk, statement, data, one, two):
 
 
 # function that determines score and message given partial queries
-def partial_helper(partial_answer,
+def partial_helper(cursor,
+                   partial_answer,
                    student_partial_answer,
                    partial_order_,
                    partial_join_,
@@ -544,34 +519,40 @@ def partial_helper(partial_answer,
                    student_columns,
                    pk,
                    fk):
+    table_1_name, table_2_name = data["params"]["table_1_name"], data["params"]["table_2_name"]
+    order = data["params"]["order"]
     student_columns_for_partial = student_columns.copy()
     try:
-        sol_j, stu_j = grade_helper(partial_join_, 1), grade_helper(student_partial_join_, 1)
-        if(sol_j == stu_j):
+        if partial_rows(cursor, partial_join_, student_partial_join_):
             join_matching = True
         else:
             one, two = data["submitted_answers"]["table_1"].find(" "), data["submitted_answers"]["table_2"].find(" ")
             if one != -1 or two != -1:
                 join_matching = partial_join_alias(pk, fk, data["submitted_answers"]["on"], data, one, two)
             else:
-                join_matching = partial_join(pk, fk, data["submitted_answers"]["on"])
-    except Exception:
+                join_matching = partial_join(pk, fk, data["submitted_answers"]["on"], table_1_name, table_2_name)
+    except sqlite3.Error:
+        # a sandbox.QueryLimitError is not an sqlite3.Error, so it reaches grade() like grade_helper's
         join_matching = False
     try:
-        vn1, vn2 = verify_name(data["submitted_answers"]["table_1"]), verify_name(data["submitted_answers"]["table_2"])
+        vn1 = verify_name(data["submitted_answers"]["table_1"], table_1_name, table_2_name)
+        vn2 = verify_name(data["submitted_answers"]["table_2"], table_1_name, table_2_name)
         if vn1 and vn2:
-            sol_oc, stu_oc = grade_helper(partial_order_, 1), grade_helper(student_partial_order_, 1)
-            if sol_oc == stu_oc:
+            if partial_rows(cursor, partial_order_, student_partial_order_):
                 table_one_matching, table_two_matching = True, True
             else:
-                table_one_matching = partial_order(data["submitted_answers"]["table_1"].split(" ")[0], 0)
-                table_two_matching = partial_order(data["submitted_answers"]["table_2"].split(" ")[0], 1)
+                table_one_matching = partial_order(data["submitted_answers"]["table_1"].split(" ")[0], 0,
+                                                   order, table_1_name, table_2_name)
+                table_two_matching = partial_order(data["submitted_answers"]["table_2"].split(" ")[0], 1,
+                                                   order, table_1_name, table_2_name)
         else:
-            table_one_matching = partial_order(data["submitted_answers"]["table_1"].split(" ")[0], 0)
-            table_two_matching = partial_order(data["submitted_answers"]["table_2"].split(" ")[0], 1)
-    except Exception:
+            table_one_matching = partial_order(data["submitted_answers"]["table_1"].split(" ")[0], 0,
+                                                   order, table_1_name, table_2_name)
+            table_two_matching = partial_order(data["submitted_answers"]["table_2"].split(" ")[0], 1,
+                                                   order, table_1_name, table_2_name)
+    except sqlite3.Error:
         table_one_matching, table_two_matching = False, False
-    row_matching = partial_rows(partial_answer, student_partial_answer)
+    row_matching = partial_rows(cursor, partial_answer, student_partial_answer)
     column_matching = partial_cols(solution_columns, student_columns_for_partial)
     index, index_str = feedback_list_index(row_matching, column_matching, join_matching,
                                            table_one_matching, table_two_matching)
@@ -579,25 +560,45 @@ def partial_helper(partial_answer,
 
 
 def grade(data):
-    # indicate arrival in grade function
+    # indicate arrival in grade function & load the variant's tables
     data["correct_answers"]["flag"], solution = 1, data["params"]["solution"]
+    conn = fixtures.load(data["params"]["fixture"])
+    cursor = conn.cursor()
     pk, fk = data["params"]["primary_key"], data["params"]["foreign_key"]
     student_answer = "SELECT " + data["submitted_answers"]["columns"] + " FROM " + \
         data["submitted_answers"]["table_1"] + " LEFT JOIN " + data["submitted_answers"]["table_2"] \
         + " ON " + data["submitted_answers"]["on"] + " WHERE " + data["submitted_answers"]["condition"]
 
-    # check student solution and assign scores & feedback appropriately
-    solution_columns, data1 = grade_helper(solution, 0)
-    student_columns, data2 = grade_helper(student_answer, 0)
-    # student_columns_for_partial = student_columns.copy()
-    if(data1 == data2):
-        data["score"], data["feedback"]["message"] = 1, "Correct!"
-    else:
-        data["score"], data["feedback"]["message"] = \
-                partial_grader(pk, fk, solution, data, solution_columns, student_columns)
-
-    # add appropriate data for feedback
-    data["feedback"]["student_results"] = get_table_data(student_answer)
+    # check student solution, which only runs once & within the sandbox limits, and assign scores
+    try:
+        with sandbox.limits(conn):
+            # variants carry their solution's fingerprint, so the solution only runs for partial credit
+            student_columns, data2 = grade_helper(cursor, "student_result", student_answer)
+            data1 = data["params"].get("solution_fingerprint")
+            if data1 != data2:
+                solution_columns, data1 = grade_helper(cursor, "solution_result", solution)
+            if(data1 == data2):
+                data["score"], data["feedback"]["message"] = 1, "Correct!"
+            else:
+                data["score"], data["feedback"]["message"] = \
+                        partial_grader(cursor, pk, fk, solution, data, solution_columns, student_columns)
+                data["feedback"]["row_diff"] = compare.diff_feedback(cursor, "solution_result", "student_result")
+
+            # add appropriate data for feedback
+            student_results, truncated = sandbox.feedback_rows(cursor, "student_result")
+    except sandbox.QueryLimitError as e:
+        data["format_errors"]["student_feedback"] = str(e)
+        conn.close()
+        return data
+    except sqlite3.Error as e:
+        data["format_errors"]["student_feedback"] = "The SQL query entered is invalid: \"" + e.args[0] + "\""
+        conn.close()
+        return data
+    data["feedback"]["student_results"] = [{"data": ['NULL' if cell is None else cell for cell in entry]}
+                                           for entry in student_results]
+    if truncated:
+        data["feedback"]["truncated"] = truncated
     data["feedback"]["columns_s"] = student_columns
 
+    conn.close()
     return data
@@ -1,23 +1,15 @@
+import os
 import sqlite3
 import random as rand
-import json
-import pandas as pd
-import csv
-
-# load in file with table groups
-with open("../../../clientFilesCourse/table.json", "r") as read_file:
-    tables = json.load(read_file)
-
-# randomly choose table group from list of table groups
-group_number = rand.randint(0, 1)
-conn_solution = sqlite3.connect("database.db")
-cursor = conn_solution.cursor()
-table_1_number, table_2_number = 0, rand.randint(1, len(tables[group_number])-1)
-table_1_name = tables[group_number][table_1_number]["table_name"]
-table_2_name = tables[group_number][table_2_number]["table_name"]
-order = rand.choice([0, 1, 1, 1])
-faker = pd.read_csv('../../../clientFilesCourse/faker.csv')
-faker_columns = list(faker.head(0))
+from SqlDatabases import bank, compare, datasets, fixtures, sandbox, schema
+
+# prebuilt variants for generate(), made with `python -m SqlDatabases.bank`
+BANK = os.path.join(os.path.dirname(os.path.abspath(__file__)), bank.BANK_NAME)
+
+# variant state, chosen by setup_variant() so that importing this module does no work
+tables, faker, faker_columns, conn_solution = None, None, None, None
+group_number, table_1_number, table_2_number, table_1_name, table_2_name, order = None, None, None, None, None, None
+rows_1, conditions_1, rows_2, conditions_2 = None, None, None, None
 
 # function to replace placeholders with faker data
 def fill_with_faker(table_number, rows, conditions):
@@ -26,7 +18,7 @@ def fill_with_faker(table_number, rows, conditions):
         c = tables[group_number][table_number]["columns"][index]
 
         if c in faker_columns:
-            values, used, cond_vals = rand.sample(list(faker[c]), 5), [], []
+            values, used, cond_vals = datasets.sample(faker, c, 5), [], []
             for row_number in range(len(rows)):
                 if isinstance(rows[row_number][index], str) and rows[row_number][index].find("Fake") > -1:
                     rows[row_number][index] = rand.choice(values)
@@ -43,7 +35,7 @@ def fill_with_faker(table_number, rows, conditions):
                             .replace("Fake <" + c + ">", str(rand.choice(used)))
 
         if "year" in c:
-            values, used, cond_vals = rand.sample(list(faker["year"]), 5), [], []
+            values, used, cond_vals = datasets.sample(faker, "year", 5), [], []
             for row_number in range(len(rows)):
                 if isinstance(rows[row_number][index], str) and rows[row_number][index].find("Fake") > -1:
                     rows[row_number][index] = rand.choice(values)
@@ -62,49 +54,6 @@ def fill_with_faker(table_number, rows, conditions):
     return rows, conditions
 
 
-# retrieve rows and conditions with faker values
-rows_1, conditions_1 = fill_with_faker(0,
-                                       tables[group_number][table_1_number]["rows"],
-                                       tables[group_number][table_1_number]["conditions"])
-rows_2, conditions_2 = fill_with_faker(table_2_number, tables[group_number][table_2_number]["rows"],
-                                       tables[group_number][table_2_number]["conditions"])
-
-
-# function to insert rows into SQL table
-def fill_db_fk(conn, table_name, table_number, rows):
-    conn.cursor().execute("DROP TABLE IF EXISTS {};"
-                          .format(table_name))
-    conn.cursor().execute(tables[group_number][table_number]["create"])
-    num_cols = len(rows[0])
-    for outer_index in range(len(rows)):
-        row = "("
-        for inner_index in range(num_cols):
-            col_val = rows[outer_index][inner_index]
-            if isinstance(col_val, str):
-                col_val = "\"" + col_val + "\""
-            else:
-                col_val = str(col_val)
-            if inner_index == num_cols - 1:
-                row += col_val + ")"
-            else:
-                row += col_val + ", "
-        insert = "INSERT INTO " + table_name + " VALUES " + row
-        conn.cursor().execute(insert)
-    conn.commit()
-
-
-# function to change column data in a table to disregard order
-def column_order(data_list):
-    for element in data_list:
-        for index in range(len(element)):
-            if not isinstance(element[index], str):
-                element[index] = str(element[index])
-        element = element.sort()
-        element = str(element)
-    data_list.sort()
-    return data_list
-
-
 # function to get table data in a dictionary
 def get_table_data(query):
     return [{"data": list(entry)} for entry in conn_solution.cursor().execute(
@@ -116,28 +65,14 @@ def default_query(table_name):
     return "select * FROM {}".format(table_name)
 
 
-# function to find primary key of parent table
+# function to find primary key of a table in the chosen group
 def find_primary_key(table_number):
-    create_string = tables[group_number][table_number]["create"]
-    create_string = create_string.replace("(", " ")
-    create_string = create_string.replace(")", " ")
-    create_string = create_string.replace(",", "")
-    create_string = create_string.split()
-    for index in range(len(create_string)):
-        if (create_string[index] == 'PRIMARY') and (create_string[index + 1] == 'KEY'):
-            return create_string[index - 2]
+    return schema.load_index()[group_number][tables[group_number][table_number]["table_name"]]["primary_key"]
 
 
-# function to find foreign key of child table
+# function to find the foreign key in the child table that refers to the parent table
 def find_foreign_key():
-    create_string = tables[group_number][table_2_number]["create"]
-    create_string = create_string.replace("(", " ")
-    create_string = create_string.replace(")", " ")
-    create_string = create_string.replace(",", "")
-    create_string = create_string.split()
-    for index in range(len(create_string)):
-        if (create_string[index] == 'FOREIGN') and (create_string[index + 1] == 'KEY'):
-            return create_string[index + 2]
+    return schema.load_index()[group_number][table_2_name]["references"][table_1_name]
 
 
 # function to randomly choose columns to select
@@ -179,11 +114,39 @@ def build_query(columns, primary_key, foreign_key, condition):
                                                 c=condition)
 
 
-def generate(data):
+# function to choose two tables & fill a private database with them; only generate() pays for this
+def setup_variant():
+    global tables, faker, faker_columns, conn_solution, group_number, table_1_number, table_2_number
+    global table_1_name, table_2_name, order, rows_1, conditions_1, rows_2, conditions_2
+
+    # load in file with table groups & faker data (both cached per process)
+    tables = datasets.load_tables()
+    faker = datasets.load_faker()
+    faker_columns = list(faker)
+
+    # randomly choose table group from list of table groups
+    group_number = rand.randint(0, 1)
+    table_1_number, table_2_number = 0, rand.randint(1, len(tables[group_number])-1)
+    table_1_name = tables[group_number][table_1_number]["table_name"]
+    table_2_name = tables[group_number][table_2_number]["table_name"]
+    conn_solution = fixtures.connect([tables[group_number][table_1_number]["create"],
+                                      tables[group_number][table_2_number]["create"]])
+    order = rand.choice([0, 1, 1, 1])
+
+    # retrieve rows and conditions with faker values
+    rows_1, conditions_1 = fill_with_faker(0, tables[group_number][table_1_number]["rows"],
+                                           tables[group_number][table_1_number]["conditions"])
+    rows_2, conditions_2 = fill_with_faker(table_2_number, tables[group_number][table_2_number]["rows"],
+                                           tables[group_number][table_2_number]["conditions"])
 
-    # fill databses with the two chosen table
-    fill_db_fk(conn_solution, table_1_name, table_1_number, rows_1)
-    fill_db_fk(conn_solution, table_2_name, table_2_number, rows_2)
+
+# function to build a variant live; SqlDatabases/bank.py also uses it to fill the bank
+def build_variant(data):
+
+    # choose the variant & fill databses with the two chosen table
+    setup_variant()
+    fixtures.insert_rows(conn_solution, table_1_name, rows_1)
+    fixtures.insert_rows(conn_solution, table_2_name, rows_2)
 
     # build a solution query & default queries
     query1 = default_query(table_1_name)
@@ -208,30 +171,43 @@ def generate(data):
     data["params"]["solution"] = solution_query
     data["params"]["primary_key"] = primary_key
     data["params"]["foreign_key"] = foreign_key
+    data["params"]["fixture"] = fixtures.dump(conn_solution, [table_1_name, table_2_name])
+    data["params"]["solution_fingerprint"] = compare.query_fingerprint(conn_solution, solution_query)[1]
 
     conn_solution.close()
     return data
 
 
+def generate(data):
+    # take a prebuilt variant when the question has a bank, else build one live
+    params = bank.pick(BANK)
+    if params is None:
+        return build_variant(data)
+    data["params"].update(params)
+    return data
+
+
 # function to catch invalid & blank inputs
 def parse(data):
 
+    conn = fixtures.load(data["params"]["fixture"])
     try:
         student_answer = "SELECT " + data["submitted_answers"]["columns"] + " FROM {t1} \
                 JOIN {t2} ON ".format(t1=data["params"]["table_1_name"], t2=data["params"]["table_2_name"])\
                 + data["submitted_answers"]["on"] + " WHERE " + data["submitted_answers"]["condition"]
-        cursor.execute(student_answer)
+        compare.check_query(conn, student_answer)
     except sqlite3.Error as e:
         data["format_errors"]["student_feedback"] = "The SQL query entered is invalid: \"" + e.args[0] + "\""
     except Exception as e:
         data["format_errors"]["query"] = str(e)
         data["format_errors"]["student_feedback"] = "The SQL query entered is invalid."
 
+    conn.close()
     return data
 
 
 # function to build queries needed to test row retrieved partial credit
-def build_partial_query(primary_key, foreign_key, condition):
+def build_partial_query(table_1_name, table_2_name, primary_key, foreign_key, condition):
     return "SELECT * FROM {t1} \
             JOIN {t2} ON {t1}.{pk} = {t2}.{fk}".format(t1=table_1_name,
                                                              t2=table_2_name,
@@ -239,19 +215,17 @@ def build_partial_query(primary_key, foreign_key, condition):
                                                              fk=foreign_key) + condition
 
 
-# function that readies table data for comparioson
-def grade_helper(query, flag):
-    results = cursor.execute(query)
-    columns = [description[0] for description in results.description]
-    results = results.fetchall()
-    return columns, column_order([list(entry) for entry in results])
+# function that runs a query once into a temp table & fingerprints it, ignoring row & column order
+def grade_helper(cursor, table_name, query):
+    columns = sandbox.materialise(cursor, table_name, query)
+    return columns, compare.table_fingerprint(cursor, table_name)
 
 
 # function to determine partial credit for rows retrieved
-def partial_rows(pa, spa):
-    results = cursor.execute(pa).fetchall()
-    results2 = cursor.execute(spa).fetchall()
-    return ([list(r)[0] for r in results] == [list(r)[0] for r in results2])
+def partial_rows(cursor, pa, spa):
+    sandbox.materialise(cursor, "partial_solution", pa)
+    sandbox.materialise(cursor, "partial_student", spa)
+    return compare.same_rows(cursor, "partial_solution", "partial_student")
 
 
 # function to determine partial credit for columns selected
@@ -262,7 +236,7 @@ def partial_cols(sol_c, stu_c):
 
 
 # function to determine partial credit for join statement
-def partial_join(join_statement, primary_key, foreign_key):
+def partial_join(join_statement, table_1_name, table_2_name, primary_key, foreign_key):
     join_statement = join_statement.replace(" ", "")
     return (join_statement == "{t1}.{pk}={t2}.{fk}".format(pk=primary_key,
                                                            t2=table_2_name,
@@ -295,35 +269,59 @@ def grade(data):
     data["correct_answers"]["flag"] = 1
     solution = data["params"]["solution"]
     primary_key, foreign_key = data["params"]["primary_key"], data["params"]["foreign_key"]
+    table_1_name, table_2_name = data["params"]["table_1_name"], data["params"]["table_2_name"]
     student_answer = "SELECT " + data["submitted_answers"]["columns"] + \
-        " FROM {t1} JOIN {t2} ON ".format(t1=data["params"]["table_1_name"],
-                                                t2=data["params"]["table_2_name"]) \
+        " FROM {t1} JOIN {t2} ON ".format(t1=table_1_name,
+                                                t2=table_2_name) \
         + data["submitted_answers"]["on"] \
         + " WHERE " \
         + data["submitted_answers"]["condition"]
-    student_partial_answer = build_partial_query(primary_key,
+    student_partial_answer = build_partial_query(table_1_name,
+                                                 table_2_name,
+                                                 primary_key,
                                                  foreign_key,
                                                  " WHERE " + data["submitted_answers"]["condition"])
-    partial_answer = build_partial_query(primary_key, foreign_key, " " + solution[solution.find("WHERE"):])
-
-    # check student solution and assign scores appropriately
-    solution_columns, data1 = grade_helper(solution, 0)
-    student_columns, data2 = grade_helper(student_answer, 1)
-    student_columns_for_partial = student_columns.copy()
-    if(data1 == data2):
-        data["score"], data["feedback"]["message"] = 1, "Correct!"
-    else:
-        row_matching = partial_rows(partial_answer, student_partial_answer)
-        column_matching = partial_cols(solution_columns, student_columns_for_partial)
-        join_matching = partial_join(data["submitted_answers"]["on"], primary_key, foreign_key)
-        index = feedback_list_index(row_matching, column_matching, join_matching)
-        data["score"], data["feedback"]["message"] = get_score(index), feedback_list[index]
-
-    # add appropriate data for feedback
-    data["feedback"]["student_results"] = [
-        {"data": list(entry)} for entry in cursor.execute(student_answer)]
+    partial_answer = build_partial_query(table_1_name, table_2_name, primary_key, foreign_key,
+                                         " " + solution[solution.find("WHERE"):])
+    conn = fixtures.load(data["params"]["fixture"])
+    cursor = conn.cursor()
+
+    # check student solution, which only runs once & within the sandbox limits, and assign scores
+    try:
+        with sandbox.limits(conn):
+            # variants carry their solution's fingerprint, so the solution only runs for partial credit
+            student_columns, data2 = grade_helper(cursor, "student_result", student_answer)
+            data1 = data["params"].get("solution_fingerprint")
+            if data1 != data2:
+                solution_columns, data1 = grade_helper(cursor, "solution_result", solution)
+            student_columns_for_partial = student_columns.copy()
+            if(data1 == data2):
+                data["score"], data["feedback"]["message"] = 1, "Correct!"
+            else:
+                row_matching = partial_rows(cursor, partial_answer, student_partial_answer)
+                column_matching = partial_cols(solution_columns, student_columns_for_partial)
+                join_matching = partial_join(data["submitted_answers"]["on"], table_1_name, table_2_name,
+                                             primary_key, foreign_key)
+                index = feedback_list_index(row_matching, column_matching, join_matching)
+                data["score"], data["feedback"]["message"] = get_score(index), feedback_list[index]
+                data["feedback"]["row_diff"] = compare.diff_feedback(cursor, "solution_result", "student_result")
+
+            # add appropriate data for feedback
+            student_results, truncated = sandbox.feedback_rows(cursor, "student_result")
+    except sandbox.QueryLimitError as e:
+        data["format_errors"]["student_feedback"] = str(e)
+        conn.close()
+        return data
+    except sqlite3.Error as e:
+        data["format_errors"]["student_feedback"] = "The SQL query entered is invalid: \"" + e.args[0] + "\""
+        conn.close()
+        return data
+    data["feedback"]["student_results"] = [{"data": entry} for entry in student_results]
+    if truncated:
+        data["feedback"]["truncated"] = truncated
     data["feedback"]["columns_s"] = student_columns
 
+    conn.close()
     return data
 
 
@@ -0,0 +1,136 @@
+"""Prebuilt variant banks for the SqlDatabases questions.
+
+Build or rebuild a question's bank from this package's parent directory:
+
+    python -m SqlDatabases.bank ../questions/SqlDatabases/database-1-inputSQL --count 500
+
+The builder calls the question's build_variant() once per seed and keeps
+every distinct variant whose solution retrieves rows. Each variant stores
+the solution query's fingerprint, so grade() only runs the solution when a
+student's answer does not match it. Once the bank exists, generate() just
+picks a row from it, as long as the files its variants were built from
+are unchanged; a stale bank is ignored until it is rebuilt.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import sqlite3
+import sys
+import zlib
+
+from . import datasets
+
+BANK_NAME = "variants.db"
+SCHEMA = "CREATE TABLE variants (id INTEGER PRIMARY KEY, solution TEXT, solution_fingerprint TEXT, params BLOB)"
+# the digest of the inputs the bank was built from, checked by pick()
+META_SCHEMA = "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)"
+# modules of this package whose code shapes a variant's params
+PACKAGE_INPUTS = ["compare.py", "datasets.py", "fixtures.py", "schema.py"]
+
+# input digests already computed in this process, keyed on question directory
+_digests = {}
+
+
+# function to list the files a question's variants are built from: its server.py, the datasets & helpers
+def input_paths(question_dir):
+    package = os.path.dirname(os.path.abspath(__file__))
+    return [os.path.join(question_dir, "server.py"), datasets.TABLE_JSON, datasets.FAKER_CSV] + \
+        [os.path.join(package, name) for name in PACKAGE_INPUTS]
+
+
+# function to digest a question's bank inputs, only re-reading them when one changes on disk
+def inputs_digest(question_dir):
+    paths = input_paths(os.path.abspath(question_dir))
+    stamp = [(os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths]
+    known = _digests.get(question_dir)
+    if known is None or known[0] != stamp:
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, "rb") as f:
+                digest.update(f.read() + b"\0")
+        known = _digests[question_dir] = (stamp, digest.hexdigest())
+    return known[1]
+
+
+# function to pick a random variant's params from a bank in O(1), or None when there is no bank
+# or it was built from different inputs (so generate() builds a variant live)
+def pick(path):
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        try:
+            built_from = conn.execute("SELECT value FROM meta WHERE key = 'digest'").fetchone()
+        except sqlite3.OperationalError:
+            built_from = None
+        if built_from is None or built_from[0] != inputs_digest(os.path.dirname(path)):
+            return None
+        # ids run from 1 with no gaps, so MAX(id) is the bank size & a rowid lookup finds the variant
+        size = conn.execute("SELECT MAX(id) FROM variants").fetchone()[0]
+        if not size:
+            return None
+        blob = conn.execute("SELECT params FROM variants WHERE id = ?", (random.randint(1, size),)).fetchone()[0]
+    finally:
+        conn.close()
+    return json.loads(zlib.decompress(blob))
+
+
+# function to import a question's server.py the way PrairieLearn runs it, from its own directory
+def load_server(question_dir):
+    question_dir = os.path.abspath(question_dir)
+    os.chdir(question_dir)
+    spec = importlib.util.spec_from_file_location("server", os.path.join(question_dir, "server.py"))
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+# function to build up to count distinct variants, trying seeds in order so a rebuild is repeatable
+def build(server, count, max_seeds=None):
+    variants, seen = [], set()
+    for seed in range(max_seeds or count * 10):
+        if len(variants) == count:
+            break
+        random.seed(seed)
+        params = server.build_variant({"params": {}, "correct_answers": {}})["params"]
+        if not params["table_data_q"]:
+            continue
+        key = hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=16).digest()
+        if key not in seen:
+            seen.add(key)
+            variants.append(params)
+    return variants
+
+
+# function to write variants to a bank, replacing any old bank only once the new one is complete
+def write(path, variants):
+    temp = "{}.{}".format(path, os.getpid())
+    conn = sqlite3.connect(temp)
+    try:
+        conn.execute(SCHEMA)
+        conn.execute(META_SCHEMA)
+        with conn:
+            conn.execute("INSERT INTO meta VALUES ('digest', ?)", (inputs_digest(os.path.dirname(path)),))
+            conn.executemany("INSERT INTO variants VALUES (?, ?, ?, ?)",
+                             [(number, params["solution"], params["solution_fingerprint"],
+                               zlib.compress(json.dumps(params, separators=(",", ":")).encode(), 9))
+                              for number, params in enumerate(variants, 1)])
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(temp, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a SqlDatabases question's variant bank.")
+    parser.add_argument("question_dir")
+    parser.add_argument("--count", type=int, default=500, help="number of distinct variants to keep")
+    args = parser.parse_args()
+
+    path = os.path.join(os.path.abspath(args.question_dir), BANK_NAME)
+    variants = build(load_server(args.question_dir), args.count)
+    write(path, variants)
+    print("{}: {} variants, {} bytes".format(path, len(variants), os.path.getsize(path)), file=sys.stderr)
@@ -0,0 +1,43 @@
+"""Times table loading for the SqlDatabases questions.
+
+Run from this directory with `python benchmark.py`. Compares the old
+one-statement-per-row string inserts with fixtures.insert_rows().
+"""
+import time
+
+import fixtures
+
+CREATE = "CREATE TABLE cars (id INTEGER PRIMARY KEY, make TEXT, model TEXT, year INTEGER, mpg REAL)"
+SIZES = [10, 1000, 100000]
+
+
+# function to make n rows shaped like the cars table
+def make_rows(n):
+    return [[i, "Ford", "F-{}".format(i % 500), 1990 + i % 30, 15.5 + i % 10] for i in range(n)]
+
+
+# function to insert rows the way fill_db_fk used to: one hand-quoted statement per row
+def insert_per_row(conn, table_name, rows):
+    for row in rows:
+        values = ", ".join("\"" + v + "\"" if isinstance(v, str) else str(v) for v in row)
+        conn.cursor().execute("INSERT INTO " + table_name + " VALUES (" + values + ")")
+    conn.commit()
+
+
+# function to time one loader on a fresh copy of the schema
+def time_loader(loader, rows):
+    conn = fixtures.connect([CREATE])
+    start = time.perf_counter()
+    loader(conn, "cars", rows)
+    elapsed = time.perf_counter() - start
+    assert conn.execute("SELECT COUNT(*) FROM cars").fetchone()[0] == len(rows)
+    conn.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    print("{:>8} {:>12} {:>12} {:>8}".format("rows", "per-row (s)", "bulk (s)", "speedup"))
+    for n in SIZES:
+        rows = make_rows(n)
+        per_row, bulk = time_loader(insert_per_row, rows), time_loader(fixtures.insert_rows, rows)
+        print("{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x".format(n, per_row, bulk, per_row / bulk))
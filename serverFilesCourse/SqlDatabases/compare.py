@@ -0,0 +1,78 @@
+import hashlib
+from collections import Counter
+
+# fingerprints add up per-row digests, so they ignore row order but still count duplicate rows
+MODULUS = 1 << 128
+
+
+# function to put a row in column-order-insensitive form: cells stringified and sorted
+def normalise(row):
+    return tuple(sorted(str(cell) for cell in row))
+
+
+# function to hash one normalised row, stable across processes
+def row_digest(row):
+    digest = hashlib.blake2b(repr(normalise(row)).encode(), digest_size=16).digest()
+    return int.from_bytes(digest, "big")
+
+
+# function to stream rows into an order-insensitive multiset fingerprint without keeping them
+def fingerprint(rows):
+    total, count = 0, 0
+    for row in rows:
+        total = (total + row_digest(row)) % MODULUS
+        count += 1
+    return "{}:{:032x}".format(count, total)
+
+
+# function to run a query and fingerprint its results; conn can be a connection or a cursor
+def query_fingerprint(conn, query):
+    cursor = conn.execute(query)
+    columns = [description[0] for description in cursor.description]
+    return columns, fingerprint(cursor)
+
+
+# function to check a query compiles against the variant's tables without running it
+def check_query(conn, query):
+    conn.execute("EXPLAIN " + query)
+
+
+# function to read a temp table's column names, undoing the ":1" suffixes SQLite adds to repeats
+def result_columns(conn, table_name):
+    columns = []
+    for description in conn.execute("SELECT * FROM temp.{} LIMIT 0".format(table_name)).description:
+        base, _, suffix = description[0].rpartition(":")
+        columns.append(base if suffix.isdigit() and base in columns else description[0])
+    return columns
+
+
+# function to run a query exactly once, keeping its rows in a temp table for later checks
+def materialise(conn, table_name, query):
+    conn.execute("DROP TABLE IF EXISTS temp.{}".format(table_name))
+    conn.execute("CREATE TEMP TABLE {} AS {}".format(table_name, query))
+    return result_columns(conn, table_name)
+
+
+# function to fingerprint a temp table made by materialise()
+def table_fingerprint(conn, table_name):
+    return fingerprint(conn.execute("SELECT * FROM temp.{}".format(table_name)))
+
+
+# function to check inside SQLite whether two temp tables hold the same set of rows
+def same_rows(conn, table_a, table_b):
+    query = "SELECT NOT EXISTS (SELECT * FROM temp.{a} EXCEPT SELECT * FROM temp.{b}) " \
+            "AND NOT EXISTS (SELECT * FROM temp.{b} EXCEPT SELECT * FROM temp.{a})"
+    return bool(conn.execute(query.format(a=table_a, b=table_b)).fetchone()[0])
+
+
+# function to list the rows one temp table is missing and has extra compared to another
+def diff(conn, expected_table, actual_table):
+    expected = Counter(normalise(row) for row in conn.execute("SELECT * FROM temp.{}".format(expected_table)))
+    actual = Counter(normalise(row) for row in conn.execute("SELECT * FROM temp.{}".format(actual_table)))
+    return expected - actual, actual - expected
+
+
+# function to summarise a diff for the submission panel
+def diff_feedback(conn, expected_table, actual_table):
+    missing, unexpected = diff(conn, expected_table, actual_table)
+    return {"missing": sum(missing.values()), "unexpected": sum(unexpected.values())}
@@ -0,0 +1,73 @@
+import copy
+import csv
+import hashlib
+import json
+import marshal
+import os
+import random
+import tempfile
+
+CLIENT_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "clientFilesCourse")
+FAKER_CSV = os.path.normpath(os.path.join(CLIENT_FILES, "faker.csv"))
+TABLE_JSON = os.path.normpath(os.path.join(CLIENT_FILES, "table.json"))
+
+# datasets already parsed in this process, keyed on path
+_faker = {}
+_tables = {}
+
+
+# function to turn a column of csv strings into ints or floats when every value allows it
+def parse_column(values):
+    for cast in (int, float):
+        try:
+            return [cast(value) for value in values]
+        except ValueError:
+            pass
+    return values
+
+
+# function to find the on-disk cache for a csv, named so edits to the csv miss the old cache
+def cache_path(path):
+    stat = os.stat(path)
+    key = "{}:{}:{}:{}".format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, marshal.version)
+    return os.path.join(tempfile.gettempdir(),
+                        "SqlDatabases-faker-{}.marshal".format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+# function to load faker.csv as a dict of column name -> list of values
+def load_faker(path=FAKER_CSV):
+    if path in _faker:
+        return _faker[path]
+    cache = cache_path(path)
+    try:
+        with open(cache, "rb") as cache_file:
+            columns = marshal.loads(cache_file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        with open(path, newline="") as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader)
+            columns = {name: parse_column(list(values)) for name, values in zip(header, zip(*reader))}
+        # marshal (unlike pickle) only builds plain values, so a planted cache file cannot run code
+        try:
+            temp = "{}.{}".format(cache, os.getpid())
+            with open(temp, "wb") as cache_file:
+                cache_file.write(marshal.dumps(columns))
+            os.replace(temp, cache)
+        except OSError:
+            pass
+    _faker[path] = columns
+    return columns
+
+
+# function to pick k distinct values from a faker column without copying the column
+def sample(faker, column, k):
+    values = faker[column]
+    return [values[index] for index in random.sample(range(len(values)), k)]
+
+
+# function to load the table groups in table.json; callers get their own copy to fill in
+def load_tables(path=TABLE_JSON):
+    if path not in _tables:
+        with open(path, "r") as read_file:
+            _tables[path] = json.load(read_file)
+    return copy.deepcopy(_tables[path])
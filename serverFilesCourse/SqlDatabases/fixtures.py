@@ -0,0 +1,51 @@
+import sqlite3
+
+# schema templates built in this process, keyed on their CREATE statements
+_templates = {}
+
+
+# function to get (building once) an in-memory database holding the given schema
+def schema_template(creates):
+    key = tuple(creates)
+    if key not in _templates:
+        template = sqlite3.connect(":memory:", check_same_thread=False)
+        for create in creates:
+            template.execute(create)
+        template.commit()
+        _templates[key] = template
+    return _templates[key]
+
+
+# function to give a variant its own private in-memory copy of a schema template
+def connect(creates):
+    conn = sqlite3.connect(":memory:")
+    schema_template(creates).backup(conn)
+    return conn
+
+
+# function to snapshot the given tables so parse/grade can rebuild the same variant
+def dump(conn, table_names):
+    fixture = []
+    for table_name in table_names:
+        create = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (table_name,)).fetchone()[0]
+        rows = [list(row) for row in conn.execute("SELECT * FROM {}".format(table_name))]
+        fixture.append({"table_name": table_name, "create": create, "rows": rows})
+    return fixture
+
+
+# function to bulk insert rows into a table with bound parameters in one transaction
+def insert_rows(conn, table_name, rows):
+    if not rows:
+        return
+    placeholders = ", ".join("?" * len(rows[0]))
+    with conn:
+        conn.executemany("INSERT INTO {} VALUES ({})".format(table_name, placeholders), rows)
+
+
+# function to rebuild a variant's database from a fixture made by dump()
+def load(fixture):
+    conn = connect([table["create"] for table in fixture])
+    for table in fixture:
+        insert_rows(conn, table["table_name"], table["rows"])
+    return conn
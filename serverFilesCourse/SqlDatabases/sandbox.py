@@ -0,0 +1,115 @@
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from . import compare
+
+# limits on the student SQL run while grading one submission
+MAX_INSTRUCTIONS = 50000000
+MAX_SECONDS = 2.0
+MAX_ROWS = 10000
+MAX_FEEDBACK_ROWS = 200
+MAX_FEEDBACK_CELL = 200
+
+# how many SQLite VM instructions run between limit checks
+CHECK_INTERVAL = 1000
+
+# statements student SQL may not run in a scratch database: they could end its savepoint or reach the disk
+DENIED_ACTIONS = {sqlite3.SQLITE_TRANSACTION, sqlite3.SQLITE_SAVEPOINT, sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH}
+
+# idle scratch databases, shared by the threads of one grading process
+_scratch = queue.SimpleQueue()
+
+
+class QueryLimitError(Exception):
+    """Raised when student SQL goes over one of the sandbox limits."""
+
+
+# function to stop SQLite once the grading budget or deadline is used up
+@contextmanager
+def limits(conn, max_instructions=MAX_INSTRUCTIONS, max_seconds=MAX_SECONDS):
+    deadline = time.monotonic() + max_seconds
+    budget = {"instructions": max_instructions, "reason": None}
+
+    def check():
+        budget["instructions"] -= CHECK_INTERVAL
+        if budget["instructions"] < 0:
+            budget["reason"] = "The SQL query entered needs too much work to run and was stopped. " \
+                               "Check for missing join conditions."
+        elif time.monotonic() > deadline:
+            budget["reason"] = "The SQL query entered took longer than {} seconds to run and was stopped." \
+                               .format(max_seconds)
+        return budget["reason"] is not None
+
+    conn.set_progress_handler(check, CHECK_INTERVAL)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        # once a limit trips, every later statement is interrupted too, so report the limit
+        if budget["reason"] is not None:
+            raise QueryLimitError(budget["reason"]) from e
+        raise
+    finally:
+        conn.set_progress_handler(None, CHECK_INTERVAL)
+
+
+# function to run a query once into a temp table, refusing results over the row limit
+def materialise(conn, table_name, query, max_rows=MAX_ROWS):
+    # the newline keeps a trailing -- comment from swallowing the closing parenthesis
+    capped = "SELECT * FROM ({}\n) LIMIT {}".format(query.strip().rstrip(";"), max_rows + 1)
+    columns = compare.materialise(conn, table_name, capped)
+    if conn.execute("SELECT COUNT(*) FROM temp.{}".format(table_name)).fetchone()[0] > max_rows:
+        raise QueryLimitError("The SQL query entered returned more than {} rows.".format(max_rows))
+    return columns
+
+
+# function to shorten a cell for display, writing blobs as SQL hex literals so feedback stays JSON
+def shorten(cell, max_length=MAX_FEEDBACK_CELL):
+    if isinstance(cell, bytes):
+        digits = cell.hex()
+        if len(digits) > max_length:
+            return "x'{}'... ({} bytes)".format(digits[:max_length], len(cell))
+        return "x'{}'".format(digits)
+    if isinstance(cell, str) and len(cell) > max_length:
+        return cell[:max_length] + "..."
+    return cell
+
+
+# function to read a temp table for the submission panel, capping rows & cell sizes
+def feedback_rows(conn, table_name, max_rows=MAX_FEEDBACK_ROWS):
+    total = conn.execute("SELECT COUNT(*) FROM temp.{}".format(table_name)).fetchone()[0]
+    rows = [[shorten(cell) for cell in row]
+            for row in conn.execute("SELECT * FROM temp.{} LIMIT {}".format(table_name, max_rows))]
+    note = None
+    if total > max_rows:
+        note = "Showing the first {} of the {} rows your query returned.".format(max_rows, total)
+    return rows, note
+
+
+# function for SQLite's authorizer to refuse the statements in DENIED_ACTIONS
+def deny_escapes(action, *args):
+    return sqlite3.SQLITE_DENY if action in DENIED_ACTIONS else sqlite3.SQLITE_OK
+
+
+# function to lend one thread an empty in-memory database, rolled back to empty when it is returned
+@contextmanager
+def scratch():
+    try:
+        conn = _scratch.get_nowait()
+    except queue.Empty:
+        conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+    conn.execute("SAVEPOINT scratch")
+    conn.set_authorizer(deny_escapes)
+    try:
+        yield conn
+    finally:
+        conn.set_authorizer(None)
+        try:
+            conn.execute("ROLLBACK TO scratch")
+            conn.execute("RELEASE scratch")
+        except sqlite3.Error:
+            # a connection that cannot be reset is dropped rather than lent out dirty
+            conn.close()
+        else:
+            _scratch.put(conn)
@@ -0,0 +1,86 @@
+import sqlite3
+
+from . import datasets
+
+# schema indexes built in this process, keyed on the table.json path
+_indexes = {}
+
+
+class SchemaError(Exception):
+    """Raised when a table in table.json does not match its CREATE statement."""
+
+
+# function to build the standalone CREATE statement for a table with its foreign key columns left out
+def standalone_create(table_name, info):
+    definitions = []
+    for column in info["columns"]:
+        if column in info["foreign_keys"]:
+            continue
+        definition = "{} {}".format(column, info["types"][column]).strip()
+        if column == info["primary_key"]:
+            definition += " PRIMARY KEY"
+        if column in info["not_null"]:
+            definition += " NOT NULL"
+        if column in info["unique"]:
+            definition += " UNIQUE"
+        definitions.append(definition)
+    return "CREATE TABLE {} ({})".format(table_name, ", ".join(definitions))
+
+
+# function to read one table's columns & keys out of SQLite instead of splitting its CREATE string
+def index_table(conn, table):
+    table_name = table["table_name"]
+    info = {"columns": [], "types": {}, "primary_key": None, "not_null": set(), "unique": set(),
+            "foreign_keys": {}, "references": {}}
+    for _, name, declared_type, not_null, _, pk in conn.execute("PRAGMA table_info({})".format(table_name)):
+        info["columns"].append(name)
+        info["types"][name] = declared_type
+        if not_null:
+            info["not_null"].add(name)
+        if pk:
+            info["primary_key"] = name
+    for _, index_name, unique, origin, _ in conn.execute("PRAGMA index_list({})".format(table_name)):
+        index_columns = conn.execute("PRAGMA index_info({})".format(index_name)).fetchall()
+        if unique and origin == "u" and len(index_columns) == 1:
+            info["unique"].add(index_columns[0][2])
+    for row in conn.execute("PRAGMA foreign_key_list({})".format(table_name)):
+        info["foreign_keys"][row[3]] = {"table": row[2], "column": row[4]}
+        info["references"][row[2]] = row[3]
+
+    # catch edits to table.json that leave the CREATE statement & the listed columns or rows out of step
+    if info["columns"] != table["columns"]:
+        raise SchemaError("{}: CREATE statement has columns {} but table.json lists {}"
+                          .format(table_name, info["columns"], table["columns"]))
+    for row in table["rows"]:
+        if len(row) != len(info["columns"]):
+            raise SchemaError("{}: row {} does not have {} values".format(table_name, row, len(info["columns"])))
+    info["standalone_create"] = standalone_create(table_name, info)
+    return info
+
+
+# function to index every table in one table group, checking that foreign keys point inside the group
+def index_group(group):
+    conn = sqlite3.connect(":memory:")
+    try:
+        for table in group:
+            try:
+                conn.execute(table["create"])
+            except sqlite3.Error as e:
+                raise SchemaError("{}: {}".format(table["table_name"], e)) from e
+        index = {table["table_name"]: index_table(conn, table) for table in group}
+    finally:
+        conn.close()
+    for table_name, info in index.items():
+        for column, target in info["foreign_keys"].items():
+            if target["column"] not in index.get(target["table"], {}).get("columns", []):
+                raise SchemaError("{}.{}: references {}({}), which is not in the table group"
+                                  .format(table_name, column, target["table"], target["column"]))
+    return index
+
+
+# function to get (building once) a list with a dict of table name -> columns & keys per table group
+def load_index(path=datasets.TABLE_JSON):
+    if path not in _indexes:
+        _indexes[path] = [index_group(group) for group in datasets.load_tables(path)]
+    return _indexes[path]
+
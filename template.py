@@ -1,67 +1,161 @@
-import sys
+import argparse
+import csv
+import json
 import os
+import shutil
+import sys
 import uuid
 
 """
 Run this script with PATH to create all files and subfolders for a new QG.
 Good example of path: python/list-mutation/hard-question
 Bad example of path: python/list mutation/ list: mutation!!
-"""
-def question_template(quid):
-    if os.path.isdir('questions'):
-        os.chdir('questions')
-    else:
-        os.mkdir('questions')
-        os.chdir('questions')
-    for folder in quid:
-        if os.path.isdir(folder):
-            if folder == quid[-1]:
-                print("QUID already exists.")
-                return 0
-            os.chdir(folder)
-        else:
-            os.mkdir(folder)
-            os.chdir(folder)
 
-    server = open('server.py', 'w')
-    question = open('question.html', 'w')
-    info = open('info.json', 'w')
-    readme = open('README.md', 'w')
-    os.mkdir('clientFilesQuestion')
-    os.mkdir('serverFilesQuestion')
+To create many questions at once, pass a manifest instead:
+    python template.py --manifest family.csv
+where family.csv has "qid" and "title" columns (a JSON manifest is a list of
+{"qid": ..., "title": ...} objects). Every QID is checked before any
+question is created.
+"""
 
-    server.write("""import random 
+SERVER = """import random
 def generate(data):
     return data
-    """)
-    question.write("""<pl-question-panel>
+    """
+QUESTION = """<pl-question-panel>
 </pl-question-panel>
-""")
-    new_uuid = str(uuid.uuid1())
-    info.write("""{
+"""
+INFO = """{
     "uuid": "%s",
-    "title": "",
+    "title": %s,
     "topic": "",
     "tags": ["berkeley"],
     "type": "v3"
 }
-""" % (new_uuid))
-    readme.write("""# Title
+"""
+README = """# Title
 > Description
 ## Table of Contents
 ## Examples
 ## Solutions
 ## Contact <email> or find <name> on Slack for questions
-""")
+"""
+# Course files that declare a UUID, and where they live
+UUID_FILES = ["infoCourse.json", "infoCourseInstance.json", "infoAssessment.json", "info.json"]
+UUID_DIRS = ["questions", "courseInstances"]
+
+
+def existing_uuids(root="."):
+    # index every UUID in the course once, so new ones can be checked without rescanning
+    uuids = set()
+    files = [os.path.join(root, "infoCourse.json")]
+    for top in UUID_DIRS:
+        for dirpath, _, filenames in os.walk(os.path.join(root, top)):
+            files += [os.path.join(dirpath, name) for name in filenames if name in UUID_FILES]
+    for file_path in files:
+        try:
+            with open(file_path) as f:
+                uuids.add(json.load(f).get("uuid"))
+        except (OSError, ValueError, AttributeError):
+            pass
+    return uuids
+
+
+def new_uuid(uuids):
+    while True:
+        candidate = str(uuid.uuid4())
+        if candidate not in uuids:
+            uuids.add(candidate)
+            return candidate
+
+
+def check_qid(qid, root="."):
+    split_dir = qid.split("/")
+    if "" in split_dir or "." in split_dir or ".." in split_dir:
+        return "Not a valid path"
+    # whatever the segments hold, the question must land inside questions/
+    questions = os.path.realpath(os.path.join(root, "questions"))
+    if os.path.commonpath([questions, os.path.realpath(os.path.join(questions, qid))]) != questions:
+        return "Not a valid path"
+
+
+def question_template(quid, title="", root=".", uuids=None):
+    # build the question in a hidden sibling directory, then rename it into place in one step
+    target = os.path.join(root, "questions", *quid)
+    if os.path.isdir(target):
+        print("QUID already exists.")
+        return 0
+    if uuids is None:
+        uuids = existing_uuids(root)
+    parent = os.path.dirname(target)
+    os.makedirs(parent, exist_ok=True)
+    staging = os.path.join(parent, ".{}.{}".format(quid[-1], os.getpid()))
+    try:
+        os.mkdir(staging)
+        os.mkdir(os.path.join(staging, "clientFilesQuestion"))
+        os.mkdir(os.path.join(staging, "serverFilesQuestion"))
+        files = {
+            "server.py": SERVER,
+            "question.html": QUESTION,
+            "info.json": INFO % (new_uuid(uuids), json.dumps(title)),
+            "README.md": README,
+        }
+        for name, text in files.items():
+            with open(os.path.join(staging, name), "w") as f:
+                f.write(text)
+        os.rename(staging, target)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def read_manifest(manifest):
+    with open(manifest, newline="") as f:
+        if manifest.endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    return [(row["qid"].strip(), row.get("title") or "") for row in rows]
+
+
+def batch_template(rows, root="."):
+    # check the whole manifest before creating anything, so a bad row leaves no partial family
+    problems, seen = [], set()
+    for qid, _ in rows:
+        problem = check_qid(qid, root)
+        if problem is None and qid in seen:
+            problem = "Listed more than once"
+        elif problem is None and os.path.isdir(os.path.join(root, "questions", qid)):
+            problem = "QUID already exists"
+        if problem:
+            problems.append("{}: {}".format(qid, problem))
+        seen.add(qid)
+    if problems:
+        sys.exit("\n".join(problems))
+
+    uuids = existing_uuids(root)
+    for qid, title in rows:
+        # another process may have made the question since the manifest was checked
+        if question_template(qid.split("/"), title, root, uuids) == 0:
+            print("Skipped " + qid)
+            continue
+        print("Your question's QUID is: " + qid)
+
 
 def main():
-    if len(sys.argv) != 2:
+    parser = argparse.ArgumentParser(description="Create the files and subfolders for new questions")
+    parser.add_argument("path", nargs="?", help="QID of one new question")
+    parser.add_argument("--manifest", help="CSV or JSON file listing the qid and title of each new question")
+    args = parser.parse_args()
+    if args.manifest:
+        batch_template(read_manifest(args.manifest))
+        return
+    if not args.path:
         sys.exit("Please enter one valid path")
-    split_dir = sys.argv[1].split("/")
-    if '' in split_dir:
-        sys.exit("Not a valid path")
-    if question_template(split_dir) != 0: 
-        print("Your question's QUID is: " + sys.argv[1])
+    if check_qid(args.path):
+        sys.exit(check_qid(args.path))
+    if question_template(args.path.split("/")) != 0:
+        print("Your question's QUID is: " + args.path)
 
 if __name__ == "__main__":
     main()
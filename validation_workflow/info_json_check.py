@@ -1,6 +1,12 @@
 import argparse
+import hashlib
 import json
+import os
+import re
+import subprocess
 import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from os import path, walk
 
 
@@ -17,75 +23,389 @@ class bcolors:
 
 sys.tracebacklimit = 0
 
-course_info = json.load(open("infoCourse.json"))
-course_tags = course_info["tags"]
-course_topics = [topic["name"] for topic in course_info["topics"]]
 # List of categories of required tags to check for
 fields = ["assessment", "institution", "author"]
+# Results from earlier runs, keyed on a hash of the file, of infoCourse.json and of this checker,
+# and the size and mtime each file had then, so unchanged files are not even read
+CACHE_FILE = path.join(path.dirname(path.abspath(__file__)), ".info_json_cache.json")
+# Editing the checks changes this, so results the old rules produced are never reused
+with open(__file__, "rb") as f:
+    CHECKER_DIGEST = hashlib.sha256(f.read()).hexdigest()
 
+# Course files that declare a UUID, and the directories the course walk looks in
+uuid_files = [
+    "infoCourse.json",
+    "infoCourseInstance.json",
+    "infoAssessment.json",
+    "info.json",
+]
+course_dirs = ["questions", "courseInstances", "elements"]
+# Tags in a question.html that could name a course element; custom element names contain a hyphen
+element_tag = re.compile(rb"<([a-z][a-z0-9]*(?:-[a-z0-9]+)+)")
 
-def check(tags, field):
-    necessary_tags = [tag["name"] for tag in course_tags if tag.get(field, None)]
-    for n_tag in necessary_tags:
-        if n_tag in tags:
-            return
-    return f"Must add a {field} tag"
 
+def load_course(course_file="infoCourse.json"):
+    # read the course's topics and required tags once, as sets, for every file to share
+    with open(course_file, "rb") as f:
+        raw = f.read()
+    course_info = json.loads(raw)
+    course_tags = course_info.get("tags", [])
+    return {
+        "topics": frozenset(topic["name"] for topic in course_info.get("topics", [])),
+        "required_tags": {
+            field: frozenset(tag["name"] for tag in course_tags if tag.get(field, None))
+            for field in fields
+        },
+        "digest": hashlib.sha256(raw).hexdigest(),
+    }
 
-def validate_all(errors):
-    # walk through questions directory
-    for (dirpath, _, filenames) in walk("questions"):
-        for filename in filenames:
-            if filename == "info.json":
-                # build absolute path to each info.json
-                file_path = path.join(dirpath, filename)
-                validate_input(file_path, errors)
+
+def check(tags, field, course):
+    if course["required_tags"][field].isdisjoint(tags):
+        return f"Must add a {field} tag"
 
 
-def validate_input(input, errors):
-    info_dict = json.load(open(input))
-    tags = info_dict["tags"]
+def validate_info(info_dict, course):
+    tags = info_dict.get("tags", [])
     msgs = []
 
     # check topics
-    topic = info_dict["topic"]
-    if topic not in course_topics:
+    topic = info_dict.get("topic")
+    if topic not in course["topics"]:
         msgs.append(f"Topic {topic} doesn't exist")
 
     # perform various checks on tags
     for field in fields:
-        msg = check(tags, field)
+        msg = check(tags, field, course)
         # if returned message is not none, add it to list
         msgs += [msg] if msg else []
+    return msgs
+
+
+def validate_input(input, course, cache):
+    stat = os.stat(input)
+    stamp = [stat.st_mtime_ns, stat.st_size, course["digest"], CHECKER_DIGEST]
+    known = cache["files"].get(input)
+    if known and known[:4] == stamp and known[4] in cache["results"]:
+        return input, known[4], cache["results"][known[4]]
+
+    with open(input, "rb") as f:
+        raw = f.read()
+    key = hashlib.sha256(course["digest"].encode() + CHECKER_DIGEST.encode() + raw).hexdigest()
+    if key not in cache["results"]:
+        try:
+            cache["results"][key] = validate_info(json.loads(raw), course)
+        except ValueError as e:
+            cache["results"][key] = [f"Invalid JSON: {e}"]
+    cache["files"][input] = stamp + [key]
+    return input, key, cache["results"][key]
+
+
+def find_all():
+    # walk through questions directory
+    for dirpath, _, filenames in walk("questions"):
+        for filename in filenames:
+            if filename == "info.json":
+                # build path to each info.json
+                yield path.join(dirpath, filename)
+
+
+def validate_files(inputs, course, cache, jobs=None):
+    # validate files on a thread pool, yielding each result in input order as soon as it is ready
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(lambda input: validate_input(input, course, cache), inputs)
+
+
+def read_json(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def assessment_qids(assessment):
+    # zone questions name a QID directly or through a list of alternatives
+    for zone in assessment.get("zones", []):
+        for question in zone.get("questions", []):
+            if "id" in question:
+                yield question["id"]
+            for alternative in question.get("alternatives", []):
+                yield alternative["id"]
+
+
+def index_element(index, dirpath, file_path, root):
+    element = read_json(file_path)
+    index["elements"][path.basename(dirpath)] = file_path
+    dependencies = element.get("dependencies", {})
+    files = (
+        [path.join(dirpath, element["controller"])] if "controller" in element else []
+    )
+    for kind in ["elementScripts", "elementStyles"]:
+        files += [path.join(dirpath, name) for name in dependencies.get(kind, [])]
+    for kind in ["clientFilesCourseScripts", "clientFilesCourseStyles"]:
+        files += [
+            path.join(root, "clientFilesCourse", name)
+            for name in dependencies.get(kind, [])
+        ]
+    index["element_files"] += [(file_path, path.normpath(name)) for name in files]
+
+
+def index_file(index, root, dirpath, filename):
+    file_path = path.normpath(path.join(dirpath, filename))
+    top = path.relpath(dirpath, root).split(os.sep)[0]
+    if top == "questions" and filename in ["question.html", "server.py"]:
+        qid = path.relpath(dirpath, path.join(root, "questions")).replace(os.sep, "/")
+        with open(file_path, "rb") as f:
+            text = f.read()
+        index["question_text"][qid] += text
+        if filename == "question.html":
+            index["question_tags"][qid] = {
+                tag.decode() for tag in element_tag.findall(text)
+            }
+        return
+    if filename not in uuid_files:
+        return
+    if top == "elements":
+        if filename == "info.json":
+            index_element(index, dirpath, file_path, root)
+        return
+    if filename == "info.json" and top != "questions":
+        return
+    info = read_json(file_path)
+    if "uuid" in info:
+        index["uuids"][info["uuid"]].append(file_path)
+    else:
+        index["errors"][file_path].append("Missing uuid")
+    if filename == "info.json":
+        qid = path.relpath(dirpath, path.join(root, "questions")).replace(os.sep, "/")
+        index["qids"][qid] = file_path
+    elif filename == "infoAssessment.json":
+        index["assessment_refs"] += [(file_path, qid) for qid in assessment_qids(info)]
+
 
-    if len(msgs) > 0:
-        errors[input] = msgs
+def build_index(root="."):
+    # one walk of the course collects every UUID, QID and element reference that the checks need
+    index = {
+        "uuids": defaultdict(list),
+        "qids": {},
+        "assessment_refs": [],
+        "elements": {},
+        "element_files": [],
+        "question_tags": defaultdict(set),
+        "question_text": defaultdict(bytes),
+        "errors": defaultdict(list),
+    }
+    for dirpath, dirnames, filenames in walk(root):
+        if path.samefile(dirpath, root):
+            dirnames[:] = [name for name in dirnames if name in course_dirs]
+            filenames = [name for name in filenames if name == "infoCourse.json"]
+        for filename in filenames:
+            try:
+                index_file(index, root, dirpath, filename)
+            except (OSError, ValueError) as e:
+                index["errors"][path.normpath(path.join(dirpath, filename))].append(
+                    f"Could not read: {e}"
+                )
+
+    # element name -> QIDs whose question.html uses it
+    index["element_users"] = defaultdict(set)
+    for qid, tags in index["question_tags"].items():
+        for tag in tags & index["elements"].keys():
+            index["element_users"][tag].add(qid)
+    return index
+
+
+def check_course(index):
+    # answer every cross-reference check from the index, keyed on the file to fix
+    errors = defaultdict(
+        list, {key: list(msgs) for key, msgs in index["errors"].items()}
+    )
+    for uuid, files in index["uuids"].items():
+        for file_path in files if len(files) > 1 else []:
+            others = ", ".join(other for other in files if other != file_path)
+            errors[file_path].append(f"UUID {uuid} is also used by {others}")
+    for file_path, qid in index["assessment_refs"]:
+        if qid not in index["qids"]:
+            errors[file_path].append(f"Question {qid} doesn't exist")
+    for file_path, dependency in index["element_files"]:
+        if not path.isfile(dependency):
+            errors[file_path].append(f"Dependency {dependency} doesn't exist")
+    return errors
+
+
+def print_errors(input, msgs):
+    for msg in msgs:
+        print(
+            f"{bcolors.WARNING}{input}{bcolors.ENDC}: {bcolors.FAIL}{msg}{bcolors.ENDC}"
+        )
+    # Create visual spacing between error messages for each file
+    print()
+
+
+def git_changed_files(revisions):
+    # paths that differ in the given git diff range, and which of them it deletes (or renames away)
+    output = subprocess.run(
+        ["git", "diff", "--name-status", *revisions],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    changed, deleted = [], []
+    for line in output.splitlines():
+        status, *paths = line.split("\t")
+        changed += paths
+        if status[:1] in ("D", "R"):
+            deleted.append(paths[0])
+    return changed, deleted
+
+
+def owning_qid(file_path, index):
+    # the question a file belongs to is its nearest ancestor directory with an info.json
+    parts = file_path.split("/")[1:-1]
+    for end in range(len(parts), 0, -1):
+        qid = "/".join(parts[:end])
+        if qid in index["qids"]:
+            return qid
+
+
+def affected_inputs(changed, index):
+    # map each changed path to the question info.json files whose validation it can change
+    if (
+        "infoCourse.json" in changed
+        or "validation_workflow/info_json_check.py" in changed
+    ):
+        return sorted(index["qids"].values())
+    qids = set()
+    for file_path in changed:
+        parts = file_path.split("/")
+        if parts[0] == "questions":
+            qids.add(owning_qid(file_path, index))
+        elif parts[0] == "elements" and len(parts) > 2:
+            qids |= index["element_users"][parts[1]]
+        elif parts[0] == "clientFilesCourse":
+            # elements that load the file, and questions that name it in question.html or server.py
+            for element_info, dependency in index["element_files"]:
+                if dependency.replace(os.sep, "/") == file_path:
+                    qids |= index["element_users"][
+                        path.basename(path.dirname(element_info))
+                    ]
+            name = "/".join(parts[1:]).encode()
+            qids |= {
+                qid for qid, text in index["question_text"].items() if name in text
+            }
+    return sorted(index["qids"][qid] for qid in qids if qid in index["qids"])
+
+
+def empty_cache():
+    return {"results": {}, "files": {}}
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            cache = json.load(f)
+        return cache if cache.keys() == empty_cache().keys() else empty_cache()
+    except (OSError, ValueError, AttributeError):
+        return empty_cache()
+
+
+def save_cache(cache):
+    # write to a temporary file first so an interrupted run never leaves a broken cache
+    temp = f"{CACHE_FILE}.{os.getpid()}"
+    try:
+        with open(temp, "w") as f:
+            json.dump(cache, f)
+        os.replace(temp, CACHE_FILE)
+    except OSError:
+        pass
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Parsing arguments")
-    parser.add_argument("--inputs", nargs="*", help="A list of files to check")
+    parser.add_argument(
+        "--inputs", nargs="*", default=[], help="A list of files to check"
+    )
     parser.add_argument("--all", action="store_true", help="Validate all info.json's")
+    parser.add_argument(
+        "--changed",
+        nargs="?",
+        const="",
+        metavar="REVISIONS",
+        help="Validate the info.json's affected by files changed in this git diff range "
+        '(for example --changed="--staged HEAD" or --changed=origin/master...HEAD)',
+    )
+    parser.add_argument(
+        "--course",
+        action="store_true",
+        help="Check UUIDs, assessment QIDs and element files across the whole course",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Number of files to check at once"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Ignore results from earlier runs"
+    )
 
     args = parser.parse_args()
-    errors = {}
+    course = load_course()
+    previous = load_cache()
+    cache = empty_cache()
+    if not args.no_cache:
+        cache = {"results": dict(previous["results"]), "files": dict(previous["files"])}
+    inputs = find_all() if args.all else args.inputs
+
+    # Only the questions a change can affect are validated, including users of changed
+    # elements and clientFilesCourse files; changed course JSON also needs the course checks
+    index = None
+    if args.changed is not None:
+        changed, deleted = git_changed_files(args.changed.split())
+        index = build_index()
+        # deleted files count as changes, but only files that still exist are opened
+        affected = [name for name in affected_inputs(changed, index) if path.isfile(name)]
+        inputs = sorted(set(inputs) | set(affected))
+        # a deletion can leave a reference dangling anywhere in the course
+        if deleted or any(path.basename(name) in uuid_files for name in changed):
+            args.course = True
+        if not inputs and not args.course:
+            print("No files need to be checked!")
+            sys.exit(0)
+
+    # Stream each failing file's messages as soon as its result is in
+    failed, seen, seen_files = 0, {}, {}
+    for input, key, msgs in validate_files(inputs, course, cache, args.jobs):
+        seen[key], seen_files[input] = msgs, cache["files"][input]
+        if not msgs:
+            continue
+        if failed == 0:
+            print(
+                f"{bcolors.FAIL}Some of the info.json's you have edited or created are missing the required tags. Read the output below for more information.{bcolors.ENDC}\n"
+            )
+        failed += 1
+        print_errors(input, msgs)
+
+    # Cross-reference checks need every file, so they run from one index of the course
+    if args.course:
+        course_errors = check_course(index or build_index())
+        if course_errors:
+            print(
+                f"{bcolors.FAIL}Some course files have duplicate UUIDs or refer to questions or files that don't exist.{bcolors.ENDC}\n"
+            )
+        for input in sorted(course_errors):
+            print_errors(input, course_errors[input])
+        failed += len(course_errors)
+
+    # A full run keeps only results for files that still exist, so the cache stays small
     if args.all:
-        validate_all(errors)
+        save_cache({"results": seen, "files": seen_files})
     else:
-        for input in args.inputs:
-            validate_input(input, errors)
+        save_cache(
+            {
+                "results": {**previous["results"], **seen},
+                "files": {**previous["files"], **seen_files},
+            }
+        )
 
-    # If there are errors, create an error messsage and throw an exception
-    if len(errors) > 0:
-        msgs = [
-            f"{bcolors.FAIL}Some of the info.json's you have edited or created are missing the required tags. Read the output below for more information.{bcolors.ENDC}\n"
-        ]
-        for key in errors:
-            for msg in errors[key]:
-                msgs.append(
-                    f"{bcolors.WARNING}{key}{bcolors.ENDC}: {bcolors.FAIL}{msg}{bcolors.ENDC}"
-                )
-            # Create visual spacing between error messages for each file
-            msgs[-1] += "\n"
-        raise Exception("\n".join(msgs))
+    # If there are errors, throw an exception
+    if failed > 0:
+        raise Exception(
+            f"{bcolors.FAIL}{failed} file(s) failed validation{bcolors.ENDC}"
+        )
     print(f"{bcolors.OKGREEN}All checks passed!{bcolors.ENDC}")